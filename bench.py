@@ -0,0 +1,944 @@
+'''
+Benchmarks for the gateway hot paths. Runs against the simulated modem, no hardware needed.
+'''
+import os
+import math
+import time
+import wave
+import array
+import random
+import asyncio
+import argparse
+import tempfile
+import datetime
+import functools
+import statistics
+
+import serial_asyncio
+from nio import RoomSendResponse
+
+import smspdu
+from modemsim import ModemSimulator
+from pcmaudio import FilePcm, PcmAudio, PCM_PTIME
+from quectelmodem import AtResponseFramer, QuectelModemManager, at_priority, AT_PRIORITY_NAMES
+
+
+BENCH_NUMBER = '+15555550100'
+BENCH_ROOM = '!bench:localhost'
+# Call audio: a 20 ms tone every second, detected by its amplitude
+TONE_PERIOD = 1.0
+TONE_AMPLITUDE = 16000
+TONE_THRESHOLD = 4000
+# AT stress: stored messages read back by index, and the share of commands whose caller
+# gives up while they are queued or in flight
+STRESS_SMS = 10
+STRESS_CANCEL_RATE = 0.1
+# External address: what the good stand-in endpoint answers, and the HTTP timeout the slow
+# one answers after
+BENCH_EXTERNAL_ADDRESS = '203.0.113.7'
+BENCH_ADDRESS_TIMEOUT = 1.0
+# Baseline AT framing: RX timeout that ends a response, before the AT probe
+BASELINE_AT_TIMEOUT = 0.2
+# Framer: (command, chunks read from the port, expected response, expected URCs)
+FRAMER_CASES = (
+    ('AT+CSQ', [b'AT+CSQ\r\r\n+CSQ: 20,99\r\n\r\nOK\r\n'], '+CSQ: 20,99\nOK', []),
+    ('AT+CLCC', [b'AT+CLCC\r\r\n+CL', b'CC: 1,1,4,0,0,"+15555550100",145\r\n\r\nRING\r\n',
+                 b'\r\nOK\r\n'],
+     '+CLCC: 1,1,4,0,0,"+15555550100",145\nOK', ['RING']),
+    ('ATA', [b'ATA\r\r\nNO CARRIER\r\n'], 'NO CARRIER', []),
+    ('AT+CMGS=23', [b'AT+CMGS=23\r\r\n> '], '>', []),
+    ('AT+CMGS=23', [b'AT+CMGS=23\r\r\n> \r\n+CDSI: "ME",3\r\n'], '>', ['+CDSI: "ME",3']),
+)
+
+
+class BenchMatrixClient:
+    '''
+    Records room_send calls instead of talking to a homeserver
+    '''
+    def __init__(self):
+        self.sent = []
+        self.ended_calls = 0
+        self._waiters = []
+
+    async def room_send(self, room, message_type, content, **kwargs):
+        self.sent.append((time.perf_counter(), message_type, content))
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters = []
+        return RoomSendResponse('$bench%d' % (len(self.sent),), room)
+
+    async def set_displayname(self, displayname):
+        pass
+
+    async def wait_sent(self, count, timeout=60):
+        while len(self.sent) < count:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await asyncio.wait_for(waiter, timeout=timeout)
+
+
+class BenchCallForwarder:
+    '''
+    Stands in for MatrixCallForwarder without WebRTC media: sends the invite and
+    waits until the modem side ends the call
+    '''
+    def __init__(self, matrix_client, callerid, connected_cb=None, ended_cb=None,
+                 ring_time=None):
+        self._matrix_client = matrix_client
+        self._callerid = callerid
+        self._ended_cb = ended_cb
+
+    def run(self):
+        return asyncio.create_task(self._call())
+
+    async def _call(self):
+        try:
+            await self._matrix_client.room_send(BENCH_ROOM, 'm.call.invite',
+                                                {'callerid': self._callerid})
+            await asyncio.Event().wait()
+        finally:
+            self._matrix_client.ended_calls += 1
+            await self._ended_cb()
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[max(0, int(round(len(latencies) * 0.95)) - 1)]
+    print('%-22s n=%d mean %.2f ms, median %.2f ms, p95 %.2f ms, max %.2f ms' % (
+        name, len(latencies), statistics.mean(latencies), statistics.median(latencies),
+        p95, latencies[-1]
+    ))
+
+
+async def _run_gateway(run, send_queue):
+    await asyncio.gather(run(), send_queue.run())
+
+
+async def start_gateway(sim, client, tty=None, supervise=False):
+    '''
+    Runs the gateway's modem side on the simulator (opened at tty, if given), optionally
+    under the modem supervisor
+    '''
+    from matrixapi import MatrixSmsForwarder
+    from sendqueue import MatrixSendQueue
+    from supervisor import ModemSupervisor
+
+    send_queue = MatrixSendQueue(client, ':memory:')
+    manager = QuectelModemManager(
+        tty or sim.open(),
+        call_forwarder=functools.partial(BenchCallForwarder, client),
+        sms_forwarder=functools.partial(MatrixSmsForwarder, send_queue, BENCH_ROOM),
+    )
+    start = time.perf_counter()
+    if supervise:
+        run = ModemSupervisor('bench', manager.run, [tty]).run
+    else:
+        run = manager.run
+    task = asyncio.create_task(_run_gateway(run, send_queue))
+    await asyncio.wait_for(manager.ready.wait(), timeout=600)
+    return manager, task, (time.perf_counter() - start) * 1000
+
+
+async def stop_gateway(task, sim):
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    sim.close()
+
+
+class BaselineAtPort:
+    '''
+    The AT framing the gateway had before AtResponseFramer: a response ends on OK/ERROR or
+    an RX timeout, and is confirmed over by probing the modem with an AT
+    '''
+    def __init__(self, reader, writer):
+        self._modem_r = reader
+        self._modem_w = writer
+        self._last_cmd = b''
+        self._response_q = asyncio.Queue()
+
+    async def _getline(self, timeout=None):
+        rx = await asyncio.wait_for(self._modem_r.readline(), timeout=timeout)
+        return rx.strip()
+
+    async def rx_handler(self):
+        while True:
+            line = await self._getline()
+            # URCs are dropped, the latency of the responses is all that is measured
+            if not line.startswith(self._last_cmd) or line == b'':
+                continue
+
+            lines = []
+            while True:
+                try:
+                    while True:
+                        lines.append(await self._getline(timeout=BASELINE_AT_TIMEOUT))
+                        if lines[-1] in (b'OK', b'ERROR'):
+                            break
+                except asyncio.TimeoutError:
+                    pass
+
+                self._modem_w.write(b'AT\r')
+                line = await self._getline(timeout=BASELINE_AT_TIMEOUT)
+                if line == b'AT':
+                    line = await self._getline(timeout=BASELINE_AT_TIMEOUT)
+                    if line == b'OK':
+                        break
+                lines.append(line)
+
+            await self._response_q.put((b'\n'.join(lines)).decode())
+
+    async def do_cmd(self, cmd):
+        self._last_cmd = cmd.encode()
+        self._modem_w.write(b'%s\r' % (self._last_cmd,))
+        return await self._response_q.get()
+
+
+async def _at_latencies(args, do_cmd, label):
+    for cmd in ('ATA', 'ATH0', 'AT+CLCC', 'AT+CSQ'):
+        latencies = []
+        for _ in range(args.count):
+            start = time.perf_counter()
+            await do_cmd(cmd)
+            latencies.append((time.perf_counter() - start) * 1000)
+        report('%s (%s)' % (cmd, label), latencies)
+
+
+async def bench_at_latency(args):
+    '''
+    do_cmd latency with the baseline framing (RX timeout and AT probe), then with
+    AtResponseFramer, against the same simulator
+    '''
+    sim = ModemSimulator(response_delay=args.modem_delay)
+    reader, writer = await serial_asyncio.open_serial_connection(url=sim.open())
+    port = BaselineAtPort(reader, writer)
+    rx_task = asyncio.create_task(port.rx_handler())
+    await _at_latencies(args, port.do_cmd, 'baseline')
+    rx_task.cancel()
+    writer.close()
+    sim.close()
+
+    sim = ModemSimulator(response_delay=args.modem_delay)
+    manager = QuectelModemManager(sim.open())
+    rx_task = await manager._open()
+    await _at_latencies(args, manager.do_cmd, 'framer')
+    rx_task.cancel()
+    sim.close()
+
+
+async def bench_framer(args):
+    '''
+    Feeds canned reads of the AT port to AtResponseFramer, and checks how it splits them
+    into the response and URCs
+    '''
+    for cmd, chunks, expected, expected_urcs in FRAMER_CASES:
+        responses, urcs = [], []
+        framer = AtResponseFramer(responses.append, urcs.append)
+        framer.expect(cmd)
+        for chunk in chunks:
+            framer.feed(chunk)
+        if responses != [expected] or urcs != expected_urcs:
+            raise AssertionError('%s %r: response %r and URCs %r, expected %r and %r' % (
+                cmd, b''.join(chunks), responses, urcs, [expected], expected_urcs
+            ))
+    print('framer: %d cases OK' % (len(FRAMER_CASES),))
+
+
+def _check_stress_response(sim, cmd, result):
+    '''
+    Returns whether result is the response to cmd
+    '''
+    lines = result.split('\n')
+    if cmd.startswith('AT+CMGR='):
+        return (len(lines) == 3 and lines[0].startswith('+CMGR:') and
+                smspdu.decode_deliver(lines[1]).text == 'Stress message %s' % (cmd[8:],))
+    return {
+        'AT+CSQ': ['+CSQ: %d,99' % (sim.csq,), 'OK'],
+        'AT+CLCC': ['OK'],
+        'AT+CREG?': sim._at_reg_query('CREG'),
+        'AT+QPINC?': sim._at_qpinc(),
+        'AT': ['OK'],
+    }[cmd] == lines
+
+
+async def _stress_client(args, sim, manager, results):
+    for _ in range(args.count):
+        cmd = random.choice(['AT+CMGR=%d' % (random.randrange(STRESS_SMS),), 'AT+CSQ',
+                             'AT+CLCC', 'AT+CREG?', 'AT+QPINC?', 'AT'])
+        start = time.perf_counter()
+        try:
+            if random.random() < STRESS_CANCEL_RATE:
+                # Gives up at some point while queued, or in flight
+                result = await asyncio.wait_for(manager.do_cmd(cmd),
+                                                timeout=random.uniform(0, args.modem_delay * 4))
+            else:
+                result = await manager.do_cmd(cmd)
+        except asyncio.TimeoutError:
+            results['cancelled'] += 1
+            continue
+        results[AT_PRIORITY_NAMES[at_priority(cmd)]].append((time.perf_counter() - start) * 1000)
+        if not _check_stress_response(sim, cmd, result):
+            results['mismatched'].append((cmd, result))
+
+
+async def bench_at_stress(args):
+    '''
+    Many coroutines issuing AT commands at once, some giving up half way, while the
+    simulated modem interleaves URCs. Every response is checked against its command.
+    '''
+    sim = ModemSimulator(response_delay=args.modem_delay, noise=0.2)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for idx in range(STRESS_SMS):
+        sim.sms[idx] = smspdu.encode_deliver(BENCH_NUMBER, 'Stress message %d' % (idx,), now)[0]
+    manager = QuectelModemManager(sim.open())
+    rx_task = await manager._open()
+
+    results = {name: [] for name in AT_PRIORITY_NAMES}
+    results.update(cancelled=0, mismatched=[])
+    start = time.perf_counter()
+    await asyncio.gather(*(_stress_client(args, sim, manager, results)
+                           for _ in range(args.stress_clients)))
+    elapsed = time.perf_counter() - start
+    total = args.count * args.stress_clients
+    print('AT stress: %d commands from %d coroutines in %.2f s, %d given up, %d mismatched' % (
+        total, args.stress_clients, elapsed, results['cancelled'], len(results['mismatched'])
+    ))
+    for cmd, result in results['mismatched'][:10]:
+        print('  %s -> %r' % (cmd, result))
+    for name in AT_PRIORITY_NAMES:
+        if results[name]:
+            report('AT-%s-priority' % (name,), results[name])
+
+    rx_task.cancel()
+    sim.close()
+
+
+async def bench_cold_start(args):
+    latencies = []
+    for _ in range(args.count):
+        sim = ModemSimulator(response_delay=args.modem_delay)
+        _, task, elapsed = await start_gateway(sim, BenchMatrixClient())
+        latencies.append(elapsed)
+        await stop_gateway(task, sim)
+    report('cold-start-to-ready', latencies)
+
+
+async def bench_ring(args):
+    sim = ModemSimulator(response_delay=args.modem_delay)
+    client = BenchMatrixClient()
+    _, task, _ = await start_gateway(sim, client)
+
+    latencies = []
+    for _ in range(args.count):
+        sent = len(client.sent)
+        start = time.perf_counter()
+        sim.ring(BENCH_NUMBER)
+        await client.wait_sent(sent + 1)
+        latencies.append((client.sent[-1][0] - start) * 1000)
+
+        sim.remote_hangup()
+        await asyncio.sleep(0.05)
+    report('RING-to-invite', latencies)
+
+    await stop_gateway(task, sim)
+
+
+async def bench_sms(args):
+    sim = ModemSimulator(response_delay=args.modem_delay)
+    client = BenchMatrixClient()
+    _, task, _ = await start_gateway(sim, client)
+
+    latencies = []
+    for i in range(args.count):
+        sent = len(client.sent)
+        start = time.perf_counter()
+        sim.receive_sms(BENCH_NUMBER, 'Benchmark message %d' % (i,))
+        await client.wait_sent(sent + 1)
+        latencies.append((client.sent[-1][0] - start) * 1000)
+    report('SMS-URC-to-room_send', latencies)
+
+    await stop_gateway(task, sim)
+
+
+async def bench_sms_throughput(args):
+    sim = ModemSimulator(response_delay=args.modem_delay)
+    client = BenchMatrixClient()
+    _, task, _ = await start_gateway(sim, client)
+
+    expected = [('Burst message %d ' % (i,)).ljust(args.sms_length, 'x')
+                for i in range(args.count)]
+    start = time.perf_counter()
+    for text in expected:
+        sim.receive_sms(BENCH_NUMBER, text)
+
+    # Wait until every message body made it into some room_send
+    while True:
+        bodies = set()
+        for _, _, content in client.sent:
+            bodies.update(content.get('body', '').split('\n'))
+        if bodies.issuperset(expected):
+            break
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    print('SMS throughput: %d messages in %.2f s (%.1f msg/s, %d room_sends)' % (
+        args.count, elapsed, args.count / elapsed, len(client.sent)
+    ))
+
+    await stop_gateway(task, sim)
+
+
+async def bench_sms_send(args):
+    '''
+    Outbound SMS from the room: messages per minute through AT+CMGS, and the latency from
+    queueing to the modem taking the last part, and to the delivery report in the room
+    '''
+    from matrixapi import MatrixSmsForwarder
+    from sendqueue import MatrixSendQueue
+    from smsqueue import SmsSendQueue
+
+    sim = ModemSimulator(response_delay=args.modem_delay, report_delay=0.05)
+    client = BenchMatrixClient()
+    send_queue = MatrixSendQueue(client, ':memory:')
+    manager = QuectelModemManager(sim.open())
+    sms_queue = SmsSendQueue(':memory:', manager, send_queue, args.sms_rate)
+    manager.attach_forwarders(
+        functools.partial(BenchCallForwarder, client),
+        functools.partial(MatrixSmsForwarder, send_queue, BENCH_ROOM),
+        status_report_cb=sms_queue.on_status_report
+    )
+    task = asyncio.ensure_future(asyncio.gather(manager.run(), send_queue.run(),
+                                                sms_queue.run()))
+    await asyncio.wait_for(manager.ready.wait(), timeout=600)
+
+    # When the modem took each part
+    accepted = []
+    send_sms_pdu = manager.send_sms_pdu
+
+    async def timed_send_sms_pdu(pdu, length):
+        reference = await send_sms_pdu(pdu, length)
+        accepted.append(time.perf_counter())
+        return reference
+    manager.send_sms_pdu = timed_send_sms_pdu
+
+    # Short, concatenated and UCS-2 messages
+    texts = ['Short message %d' % (i,) if i % 3 == 0 else
+             ('Long message %d ' % (i,)).ljust(300, 'x') if i % 3 == 1 else
+             'Unicode message %d \u2713' % (i,)
+             for i in range(args.count)]
+    queued = {}
+    sent = len(client.sent)
+    start = time.perf_counter()
+    for i, text in enumerate(texts):
+        queued['$event%d' % (i,)] = time.perf_counter()
+        sms_queue.send(BENCH_ROOM, '$event%d' % (i,), [BENCH_NUMBER], text)
+
+    delivered = {}
+    while len(delivered) < len(texts):
+        await client.wait_sent(sent + 1)
+        for when, _, content in client.sent[sent:]:
+            event_id = content.get('m.relates_to', {}).get('m.in_reply_to', {}).get('event_id')
+            if event_id in queued and content['body'].endswith('delivered'):
+                delivered[event_id] = when
+        sent = len(client.sent)
+    elapsed = accepted[-1] - start
+
+    parts = sum(len(smspdu.encode_submit(BENCH_NUMBER, text)) for text in texts)
+    print('SMS send: %d messages (%d parts) in %.2f s (%.1f msg/min, %d sent by the modem)' % (
+        len(texts), parts, elapsed, len(texts) / elapsed * 60, len(sim.sent_sms)
+    ))
+    report('SMS-queue-to-sent', [(when - start) * 1000 for when in accepted])
+    report('SMS-queue-to-delivered', [(delivered[event_id] - queued[event_id]) * 1000
+                                      for event_id in queued])
+
+    await stop_gateway(task, sim)
+
+
+async def bench_recovery(args):
+    '''
+    Outages of the modem device, during a call: the device node (a symlink to the
+    simulator's pty) goes away, and comes back as a freshly booted modem after
+    --outage_seconds. Measures the time until the modem is ready again.
+    '''
+    from supervisor import DEVICE_POLL_INTERVAL
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tty = os.path.join(tmp, 'ttyMODEM')
+        sim = ModemSimulator(response_delay=args.modem_delay)
+        os.symlink(sim.open(), tty)
+        client = BenchMatrixClient()
+        manager, task, _ = await start_gateway(sim, client, tty=tty, supervise=True)
+
+        latencies = []
+        for _ in range(args.count):
+            sent = len(client.sent)
+            sim.ring(BENCH_NUMBER)
+            await client.wait_sent(sent + 1)
+
+            ended_calls = client.ended_calls
+            os.unlink(tty)
+            sim.close()
+            await asyncio.sleep(args.outage_seconds)
+            if client.ended_calls != ended_calls + 1:
+                print('The call was not hung up on the Matrix side')
+
+            sim = ModemSimulator(response_delay=args.modem_delay)
+            os.symlink(sim.open(), tty)
+            start = time.perf_counter()
+            await asyncio.wait_for(manager.ready.wait(), timeout=600)
+            latencies.append((time.perf_counter() - start) * 1000)
+        report('device-back-to-ready', latencies)
+        print('(includes up to %.0f ms of polling for the device)' % (
+            DEVICE_POLL_INTERVAL * 1000,
+        ))
+
+        await stop_gateway(task, sim)
+
+
+class ToneTimingPcm(FilePcm):
+    '''
+    Records when each tone is read from the capture file, and when it comes back to
+    the playback
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = []
+        self.received = []
+
+    @staticmethod
+    def _is_tone(data):
+        return max(map(abs, array.array('h', bytes(data)))) > TONE_THRESHOLD
+
+    async def read(self):
+        data = await super().read()
+        if self._is_tone(data):
+            self.sent.append(time.perf_counter())
+        return data
+
+    def write(self, data):
+        # Only the first frame of each tone counts
+        if len(self.received) < len(self.sent) and self._is_tone(data):
+            self.received.append(time.perf_counter())
+        super().write(data)
+
+
+def write_tones(path, seconds, sample_rate=8000):
+    samples = array.array('h', bytes(int(seconds * sample_rate) * 2))
+    tone_samples = int(PCM_PTIME * sample_rate)
+    for start in range(sample_rate // 2, len(samples), int(TONE_PERIOD * sample_rate)):
+        for i in range(min(tone_samples, len(samples) - start)):
+            samples[start + i] = int(TONE_AMPLITUDE * math.sin(2 * math.pi * 1000 * i /
+                                                                sample_rate))
+    with wave.open(path + '.wav', 'wb') as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(sample_rate)
+        out.writeframes(samples.tobytes())
+    with open(path + '.raw', 'wb') as out:
+        out.write(samples.tobytes())
+
+
+async def run_loopback_call(audio, seconds, codecs=None):
+    '''
+    Calls an in-process peer that sends the received audio straight back. Returns the
+    CPU time used during the call.
+    '''
+    from aiortc import RTCPeerConnection
+    from callfactory import DEFAULT_CODECS, set_codec_preferences, apply_codec_parameters
+    codecs = codecs or DEFAULT_CODECS
+
+    gateway, peer = RTCPeerConnection(), RTCPeerConnection()
+
+    @gateway.on('track')
+    def on_gateway_track(track):
+        audio.play(track)
+
+    @peer.on('track')
+    def on_peer_track(track):
+        peer.addTrack(track)
+
+    gateway.addTrack(audio.track)
+    set_codec_preferences(gateway, codecs)
+    await gateway.setLocalDescription(apply_codec_parameters(await gateway.createOffer(),
+                                                             codecs))
+    await peer.setRemoteDescription(gateway.localDescription)
+    await peer.setLocalDescription(await peer.createAnswer())
+    await gateway.setRemoteDescription(peer.localDescription)
+    await audio.start()
+
+    cpu_before = time.process_time()
+    await asyncio.sleep(seconds)
+    cpu = time.process_time() - cpu_before
+
+    await gateway.close()
+    await peer.close()
+    await audio.stop()
+    return cpu
+
+
+async def bench_call_audio(args):
+    '''
+    CPU of a call's audio path (both peers in-process) per codec, with the direct PCM
+    tracks and with libav's MediaPlayer/MediaRecorder, and the round trip of a tone
+    through the PCM tracks
+    '''
+    from callfactory import FfmpegAudio, parse_codecs
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tones = os.path.join(tmp, 'tones')
+        write_tones(tones, args.call_seconds + 1)
+
+        for codec in args.bench_codecs.split(','):
+            pcm = ToneTimingPcm(tones + '.raw', os.path.join(tmp, 'pcm.out'))
+            cpu = await run_loopback_call(PcmAudio(pcm), args.call_seconds,
+                                          parse_codecs(codec))
+            print('Call audio (pcm, %s): %.1f%% of a core' % (
+                codec, cpu / args.call_seconds * 100,
+            ))
+            report('tone round trip (%s)' % (codec,),
+                   [(received - sent) * 1000 for sent, received in zip(pcm.sent, pcm.received)])
+
+        audio = FfmpegAudio(tones + '.wav', os.path.join(tmp, 'ffmpeg.wav'), format='wav')
+        cpu = await run_loopback_call(audio, args.call_seconds)
+        print('Call audio (ffmpeg, opus): %.1f%% of a core' % (cpu / args.call_seconds * 100,))
+
+
+def write_noise(path, seconds, sample_rate=8000):
+    '''
+    Noise in syllable-sized bursts: as hard on Opus as speech, unlike silence or tones
+    '''
+    rng = random.Random(0)
+    samples = array.array('h', bytes(int(seconds * sample_rate) * 2))
+    for i in range(len(samples)):
+        envelope = 0.5 + 0.5 * math.sin(2 * math.pi * 4 * i / sample_rate)
+        samples[i] = int(rng.gauss(0, 4000) * envelope)
+    with open(path, 'wb') as out:
+        out.write(samples.tobytes())
+
+
+async def run_relayed_call(audio, relay, rate_controller, during):
+    '''
+    Calls an in-process peer through relay (see lossyrelay.py), with the gateway's Opus
+    encoder under rate_controller (None for aiortc's own). Returns what during (called
+    with both peer connections) returns.
+    '''
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+    from callfactory import advertise_address, set_codec_preferences
+    from ratecontrol import encoding_with
+    from udpports import gather_on
+
+    gateway, peer = RTCPeerConnection(), RTCPeerConnection()
+    gateway.addTrack(audio.track)
+    set_codec_preferences(gateway, ('opus',))
+    # Each side only knows the relay's end facing the other
+    with gather_on(['127.0.0.1']):
+        await gateway.setLocalDescription(await gateway.createOffer())
+        await peer.setRemoteDescription(RTCSessionDescription(
+            sdp=advertise_address(gateway.localDescription.sdp, *relay.right), type='offer'
+        ))
+        await peer.setLocalDescription(await peer.createAnswer())
+    with encoding_with(rate_controller):
+        await gateway.setRemoteDescription(RTCSessionDescription(
+            sdp=advertise_address(peer.localDescription.sdp, *relay.left), type='answer'
+        ))
+    await audio.start()
+    control_task = asyncio.create_task(rate_controller.run(gateway)) if rate_controller else None
+    try:
+        return await during(gateway, peer)
+    finally:
+        if control_task:
+            control_task.cancel()
+        await gateway.close()
+        await peer.close()
+        await audio.stop()
+
+
+async def bench_rate_control(args):
+    '''
+    Opus sent through a relay that turns lossy, then congested (bandwidth limited), then
+    clean again, with and without the rate control: bitrate and packet rate sent, loss
+    at the receiving peer, and the encoder settings at the end of each phase
+    '''
+    from aiortc.stats import RTCInboundRtpStreamStats, RTCOutboundRtpStreamStats
+    from lossyrelay import LossyRelay
+    from ratecontrol import OpusRateControl, format_settings
+
+    phases = (
+        ('clean', {}),
+        ('5% loss', {'loss': 0.05}),
+        ('%d bit/s' % (args.relay_bandwidth,), {'bandwidth': args.relay_bandwidth}),
+        ('clean again', {}),
+    )
+
+    def counters(gateway_stats, peer_stats):
+        sent = [stats for stats in gateway_stats.values()
+                if isinstance(stats, RTCOutboundRtpStreamStats)]
+        received = [stats for stats in peer_stats.values()
+                    if isinstance(stats, RTCInboundRtpStreamStats)]
+        return (sent[0].bytesSent if sent else 0, sent[0].packetsSent if sent else 0,
+                received[0].packetsReceived if received else 0,
+                received[0].packetsLost if received else 0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        noise = os.path.join(tmp, 'noise.raw')
+        write_noise(noise, args.phase_seconds * len(phases) + 5)
+
+        for rate_control in (None, OpusRateControl(max_frame_ms=args.opus_max_frame_ms)):
+            print('Rate control %s:' % ('on' if rate_control else 'off (aiortc encoder)',))
+            relay = LossyRelay(delay=0.02, jitter=0.005, seed=1)
+            await relay.start()
+            controller = rate_control.controller(BENCH_ROOM, 'bench') if rate_control else None
+
+            async def during(gateway, peer):
+                await asyncio.sleep(1)
+                before = counters(await gateway.getStats(), await peer.getStats())
+                for name, impairments in phases:
+                    relay.loss = impairments.get('loss', 0.0)
+                    relay.bandwidth = impairments.get('bandwidth')
+                    await asyncio.sleep(args.phase_seconds)
+                    after = counters(await gateway.getStats(), await peer.getStats())
+                    sent_bytes, sent, received, lost = (a - b for a, b in zip(after, before))
+                    before = after
+                    print('  %-14s sent %5.1f kbit/s, %4.1f packets/s, lost %5.1f%%%s' % (
+                        name, sent_bytes * 8 / args.phase_seconds / 1000,
+                        sent / args.phase_seconds, lost / max(received + lost, 1) * 100,
+                        ' (%s)' % (format_settings(controller.settings),) if controller else ''
+                    ))
+
+            try:
+                await run_relayed_call(PcmAudio(FilePcm(noise, os.path.join(tmp, 'out.raw'))),
+                                       relay, controller, during)
+            finally:
+                relay.close()
+
+
+async def bench_external_address(args):
+    '''
+    External address lookup against local stand-ins of the "what is my IP" endpoints: one
+    failing, one slower than the timeout, one answering junk and a good one. Then without
+    the good one: the first call gets the fallback address, and the background refresh
+    picks up the external one once the good endpoint is back.
+    '''
+    from aiohttp import web
+    from externaladdr import (
+        ExternalAddressError, ExternalAddressResolver, HttpAddressSource, LocalAddressSource
+    )
+
+    good_up = True
+
+    async def fail(request):
+        return web.Response(status=500, text='Internal Server Error')
+
+    async def slow(request):
+        await asyncio.sleep(BENCH_ADDRESS_TIMEOUT * 2)
+        return web.Response(text=BENCH_EXTERNAL_ADDRESS)
+
+    async def junk(request):
+        return web.Response(text='<html>Your IP is %s</html>' % (BENCH_EXTERNAL_ADDRESS,))
+
+    async def good(request):
+        await asyncio.sleep(0.05)
+        if not good_up:
+            return web.Response(status=503, text='Service Unavailable')
+        return web.Response(text=BENCH_EXTERNAL_ADDRESS + '\n')
+
+    app = web.Application()
+    for handler in (fail, slow, junk, good):
+        app.router.add_get('/' + handler.__name__, handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    base = 'http://127.0.0.1:%d/' % (site._server.sockets[0].getsockname()[1],)
+    bad_urls = [base + name for name in ('fail', 'slow', 'junk')]
+
+    try:
+        source = HttpAddressSource(bad_urls + [base + 'good'], timeout=BENCH_ADDRESS_TIMEOUT)
+        latencies = []
+        for _ in range(args.count):
+            start = time.perf_counter()
+            address = await source.get()
+            latencies.append((time.perf_counter() - start) * 1000)
+            if address != BENCH_EXTERNAL_ADDRESS:
+                raise AssertionError('Looked up %r' % (address,))
+        report('address-lookup', latencies)
+
+        start = time.perf_counter()
+        try:
+            address = await HttpAddressSource(bad_urls, timeout=BENCH_ADDRESS_TIMEOUT).get()
+        except ExternalAddressError as e:
+            print('Without a good endpoint: failed after %.0f ms (%s)' % (
+                (time.perf_counter() - start) * 1000, e
+            ))
+        else:
+            raise AssertionError('Looked up %r without a good endpoint' % (address,))
+
+        good_up = False
+        resolver = ExternalAddressResolver(
+            HttpAddressSource(bad_urls + [base + 'good'], timeout=BENCH_ADDRESS_TIMEOUT),
+            fallback=LocalAddressSource('127.0.0.1'), retry_interval=0.2
+        )
+        resolver.start()
+        try:
+            address = await resolver.get()
+            print('While the endpoints fail: calls get %s' % (address,))
+            good_up = True
+            start = time.perf_counter()
+            while resolver.address != BENCH_EXTERNAL_ADDRESS:
+                await asyncio.sleep(0.05)
+            print('Once the good endpoint is back: %s, %.0f ms later' % (
+                await resolver.get(), (time.perf_counter() - start) * 1000
+            ))
+        finally:
+            resolver.stop()
+    finally:
+        await runner.cleanup()
+
+
+async def bench_ring_during_sms(args):
+    '''
+    RING-to-invite while the outbound SMS queue sends continuously, with the network
+    taking --sms_send_delay to take each part (the modem's port is held meanwhile)
+    '''
+    from matrixapi import MatrixSmsForwarder
+    from sendqueue import MatrixSendQueue
+    from smsqueue import SmsSendQueue
+
+    sim = ModemSimulator(response_delay=args.modem_delay, report_delay=0.05,
+                         send_delay=args.sms_send_delay)
+    client = BenchMatrixClient()
+    send_queue = MatrixSendQueue(client, ':memory:')
+    manager = QuectelModemManager(sim.open())
+    sms_queue = SmsSendQueue(':memory:', manager, send_queue, rate_per_minute=0)
+    manager.attach_forwarders(
+        functools.partial(BenchCallForwarder, client),
+        functools.partial(MatrixSmsForwarder, send_queue, BENCH_ROOM),
+        status_report_cb=sms_queue.on_status_report
+    )
+    run = asyncio.ensure_future(manager.run())
+    task = asyncio.ensure_future(asyncio.gather(run, send_queue.run(), sms_queue.run()))
+    await asyncio.wait_for(manager.ready.wait(), timeout=600)
+
+    # More than the rings take to send, in 3-part messages
+    for i in range(args.count * 2):
+        sms_queue.send(BENCH_ROOM, '$event%d' % (i,), [BENCH_NUMBER],
+                       ('Long message %d ' % (i,)).ljust(400, 'x'))
+    await asyncio.sleep(args.sms_send_delay / 2)
+
+    latencies = []
+    for _ in range(args.count):
+        invites = sum(1 for _, message_type, _ in client.sent
+                      if message_type == 'm.call.invite')
+        start = time.perf_counter()
+        sim.ring(BENCH_NUMBER)
+        while sum(1 for _, message_type, _ in client.sent
+                  if message_type == 'm.call.invite') == invites:
+            if run.done():
+                raise AssertionError('The modem failed: %r' % (run.exception(),))
+            await client.wait_sent(len(client.sent) + 1, timeout=600)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        # The next call would get the same index: it rings once the hangup is handled
+        ended = client.ended_calls
+        sim.remote_hangup()
+        while client.ended_calls == ended:
+            await asyncio.sleep(0.05)
+        # Rings land at random points of the sends
+        await asyncio.sleep(random.uniform(0, args.sms_send_delay))
+    print('Ring during SMS sends: %d parts sent meanwhile, %.1f s per part' % (
+        len(sim.sent_sms), args.sms_send_delay
+    ))
+    report('RING-to-invite', latencies)
+
+    await stop_gateway(task, sim)
+
+
+def rss_kib():
+    with open('/proc/self/statm', 'r') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+async def bench_modems(args):
+    '''
+    Memory and idle CPU cost of each additional modem on one event loop (modem side
+    only: the simulators run in-process, and no standby calls are prepared)
+    '''
+    import matrixapi  # Import everything up front, so it isn't counted per modem
+    rss_before = rss_kib()
+
+    sims = [ModemSimulator(response_delay=args.modem_delay) for _ in range(args.count)]
+    gateways = await asyncio.gather(*(start_gateway(sim, BenchMatrixClient()) for sim in sims))
+    rss_after = rss_kib()
+
+    cpu_before = time.process_time()
+    await asyncio.sleep(args.idle_seconds)
+    cpu = time.process_time() - cpu_before
+
+    print('%d modems: %.0f KiB RSS per modem, %.3f%% of a core per idle modem' % (
+        args.count, (rss_after - rss_before) / args.count,
+        cpu / args.idle_seconds / args.count * 100
+    ))
+
+    for (_, task, _), sim in zip(gateways, sims):
+        await stop_gateway(task, sim)
+
+
+BENCHMARKS = {
+    'at': bench_at_latency,
+    'framer': bench_framer,
+    'at-stress': bench_at_stress,
+    'cold-start': bench_cold_start,
+    'ring': bench_ring,
+    'sms': bench_sms,
+    'sms-throughput': bench_sms_throughput,
+    'sms-send': bench_sms_send,
+    'modems': bench_modems,
+    'call-audio': bench_call_audio,
+    'rate-control': bench_rate_control,
+    'recovery': bench_recovery,
+    'external-address': bench_external_address,
+    'ring-during-sms': bench_ring_during_sms,
+}
+
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description='Gateway benchmarks')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='Benchmarks to run: %s (default: all)' % (', '.join(BENCHMARKS),))
+    parser.add_argument('--count', help='Iterations per measurement', type=int, default=20)
+    parser.add_argument('--modem_delay', help='Simulated modem turnaround (seconds)',
+                        type=float, default=0.005)
+    parser.add_argument('--stress_clients', help='Coroutines issuing AT commands at once in '
+                        'the AT stress benchmark', type=int, default=20)
+    parser.add_argument('--sms_length', help='Characters per SMS in the throughput benchmark '
+                        '(over 160 makes concatenated messages)', type=int, default=100)
+    parser.add_argument('--sms_rate', help='Outbound SMS parts per minute in the send '
+                        'benchmark (0 for no pacing)', type=int, default=0)
+    parser.add_argument('--sms_send_delay', help='Time the network takes to take each SMS '
+                        'part in the ring during SMS benchmark (seconds)', type=float,
+                        default=2)
+    parser.add_argument('--idle_seconds', help='Idle period to sample CPU usage over',
+                        type=float, default=10)
+    parser.add_argument('--outage_seconds', help='Modem device outage in the recovery '
+                        'benchmark', type=float, default=2)
+    parser.add_argument('--call_seconds', help='Duration of the call audio benchmark',
+                        type=float, default=10)
+    parser.add_argument('--bench_codecs', help='Codecs to compare in the call audio benchmark',
+                        default='opus,PCMU,PCMA')
+    parser.add_argument('--phase_seconds', help='Duration of each network phase in the rate '
+                        'control benchmark', type=float, default=20)
+    parser.add_argument('--relay_bandwidth', help='Bandwidth limit (bit/s) of the congested '
+                        'phase in the rate control benchmark', type=int, default=20000)
+    parser.add_argument('--opus_max_frame_ms', help='Longest Opus frames in the rate control '
+                        'benchmark (the in-process peer of older aiortc, like 1.3.1, only '
+                        'decodes 20 ms)', type=int, default=60)
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_cmdline()
+    for name in args.benchmarks or BENCHMARKS:
+        await BENCHMARKS[name](args)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
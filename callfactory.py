@@ -0,0 +1,289 @@
+import time
+import asyncio
+import logging
+
+from aioice.candidate import candidate_foundation, candidate_priority
+from aiortc import (
+    RTCConfiguration, RTCIceCandidate, RTCPeerConnection, RTCRtpSender, RTCSessionDescription
+)
+from aiortc import sdp
+from aiortc.contrib.media import MediaPlayer, MediaRecorder
+
+from externaladdr import local_addresses
+from pcmaudio import AlsaPcm, FilePcm, PcmAudio, PCM_SAMPLE_RATE, PLAYOUT_MS
+from udpports import UdpPortPool, gather_on
+
+
+ALSA_DEVICE = 'GsmModemCard'
+AUDIO_BACKENDS = ('alsa', 'ffmpeg', 'file')
+# An idle standby is rebuilt after this long, so it never goes stale
+STANDBY_MAX_AGE = 30 * 60
+# aiortc's own order. PCMU/PCMA first saves the Opus resampling and encoding of the
+# narrowband GSM audio, if the peer accepts them
+DEFAULT_CODECS = ('opus', 'PCMU', 'PCMA')
+# Opus, asking the peer to send (and telling it we only capture) narrowband mono
+OPUS_NARROWBAND = 'opus-nb'
+OPUS_NARROWBAND_FMTP = {'maxplaybackrate': 8000, 'sprop-maxcapturerate': 8000, 'stereo': 0}
+
+logger = logging.getLogger('CallFactory')
+
+
+def _codec_name(codec):
+    return 'opus' if codec == OPUS_NARROWBAND else codec
+
+
+def parse_codecs(value):
+    '''
+    Parses a codec preference list (comma separated, or a list from the config file),
+    e.g. "PCMU,PCMA,opus-nb". Codecs that aren't listed aren't offered.
+    '''
+    if isinstance(value, str):
+        value = value.split(',')
+    supported = {capability.mimeType.split('/')[1].lower(): capability.mimeType.split('/')[1]
+                 for capability in RTCRtpSender.getCapabilities('audio').codecs}
+    codecs = []
+    for codec in (codec.strip() for codec in value):
+        if codec.lower() == OPUS_NARROWBAND:
+            codec = OPUS_NARROWBAND
+        elif codec.lower() in supported:
+            codec = supported[codec.lower()]
+        else:
+            raise ValueError('Unsupported codec %r (supported: %s, %s)' % (
+                codec, ', '.join(supported.values()), OPUS_NARROWBAND
+            ))
+        if codec not in codecs:
+            codecs.append(codec)
+    if not codecs:
+        raise ValueError('No codecs given')
+    if 'opus' in codecs and OPUS_NARROWBAND in codecs:
+        raise ValueError('Only one of opus and %s can be given' % (OPUS_NARROWBAND,))
+    return tuple(codecs)
+
+
+def set_codec_preferences(pc, codecs):
+    '''
+    Offers only the given codecs, in their order, on the peer connection's transceivers
+    '''
+    capabilities = {capability.mimeType.split('/')[1]: capability
+                    for capability in RTCRtpSender.getCapabilities('audio').codecs}
+    for transceiver in pc.getTransceivers():
+        transceiver.setCodecPreferences([capabilities[_codec_name(codec)]
+                                         for codec in codecs])
+
+
+def apply_codec_parameters(offer, codecs):
+    '''
+    Adds the fmtp parameters of the codec options to an offer
+    '''
+    if OPUS_NARROWBAND not in codecs:
+        return offer
+    description = sdp.SessionDescription.parse(offer.sdp)
+    for media in description.media:
+        for codec in media.rtp.codecs:
+            if codec.mimeType.lower() == 'audio/opus':
+                codec.parameters.update(OPUS_NARROWBAND_FMTP)
+    return RTCSessionDescription(sdp=str(description), type=offer.type)
+
+
+def advertise_address(offer_sdp, address, port):
+    '''
+    Replaces the gathered ICE candidates of every media section with one host candidate
+    at the forwarded address (IPv4 or IPv6) and port
+    '''
+    description = sdp.SessionDescription.parse(offer_sdp)
+    candidate = RTCIceCandidate(
+        component=1, foundation=candidate_foundation('host', 'udp', address), ip=address,
+        port=port, priority=candidate_priority(1, 'host'), protocol='udp', type='host'
+    )
+    for media in description.media:
+        media.host = media.rtcp_host = address
+        media.port = media.rtcp_port = port
+        media.ice_candidates = [candidate]
+        media.ice_candidates_complete = True
+    return str(description)
+
+
+def negotiated_codec(answer_sdp):
+    '''
+    The codec the answer picked for audio (the first one it lists)
+    '''
+    for media in sdp.SessionDescription.parse(answer_sdp).media:
+        if media.kind == 'audio' and media.rtp.codecs:
+            return media.rtp.codecs[0].mimeType.split('/')[1]
+    return None
+
+
+class FfmpegAudio:
+    '''
+    The call's audio through libav's demuxer and muxer (with the same interface as
+    PcmAudio)
+    '''
+    def __init__(self, capture_device, playback_device, format='alsa'):
+        self._player = MediaPlayer(capture_device, format=format)
+        self._recorder = MediaRecorder(playback_device, format=format)
+        self.track = self._player.audio
+
+    def play(self, track):
+        self._recorder.addTrack(track)
+
+    async def start(self):
+        await self._recorder.start()
+
+    async def stop(self):
+        await self._recorder.stop()
+        # HACK: not sure why there isn't a public stop method
+        self._player._stop(self._player.audio)
+
+
+class PreparedCall:
+    '''
+    A peer connection with its local offer already created, and the audio devices open
+    '''
+    def __init__(self, pc, audio, udp_port):
+        self.pc = pc
+        self.audio = audio
+        self.udp_port = udp_port
+        self.prepared_at = time.monotonic()
+
+    @property
+    def sdp(self):
+        return self.pc.localDescription.sdp
+
+    async def close(self):
+        await self.pc.close()
+        await self.audio.stop()
+
+
+class CallFactory:
+    '''
+    Keeps one call fully prepared before RING arrives, and hands it out the moment a call
+    comes in. The modem sound card can only be opened once, so the standby is rebuilt in
+    the background when the previous call releases it.
+    '''
+    def __init__(self, port_pool, alsa_device=ALSA_DEVICE, max_standby_age=STANDBY_MAX_AGE,
+                 audio_backend='alsa', sample_rate=PCM_SAMPLE_RATE, playout_ms=PLAYOUT_MS,
+                 codecs=DEFAULT_CODECS, ice_interface=None):
+        self._port_pool = port_pool
+        # Interface (or address) to gather ICE candidates on, all of them if None
+        self._ice_interface = ice_interface
+        self._alsa_device = alsa_device
+        self._audio_backend = audio_backend
+        self._sample_rate = sample_rate
+        self._playout_ms = playout_ms
+        self._codecs = codecs
+        self._max_standby_age = max_standby_age
+        self._standby = None
+        self._recycle_handle = None
+        # Cleared while a handed out call (or a standby being rebuilt) holds the sound card
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def start(self):
+        if self._standby is None:
+            self._replenish()
+
+    def _replenish(self):
+        self._standby = asyncio.create_task(self._prepare())
+        self._standby.add_done_callback(self._standby_done)
+
+    def _standby_done(self, task):
+        if task.cancelled():
+            return
+        if task.exception():
+            logger.warning('Preparing standby call failed: %r' % (task.exception(),))
+            return
+        self._recycle_handle = asyncio.get_running_loop().call_later(
+            self._max_standby_age, self._recycle, task
+        )
+
+    def _recycle(self, task):
+        if self._standby is not task:
+            return
+        logger.info('Rebuilding idle standby call')
+        self._standby = None
+        # Until the old standby lets go of the sound card, calls wait for its replacement
+        # instead of preparing another one
+        self._idle.clear()
+        asyncio.create_task(self.release(task.result()))
+
+    async def _close_then_replenish(self, call):
+        try:
+            await call.close()
+        finally:
+            self._port_pool.release(call.udp_port)
+            self._replenish()
+
+    def _open_audio(self):
+        if self._audio_backend == 'ffmpeg':
+            return FfmpegAudio(self._alsa_device, self._alsa_device)
+        if self._audio_backend == 'file':
+            # The device names a pair of files or named pipes: <device>.in is played to
+            # the peer, and the peer's audio is written to <device>.out
+            pcm = FilePcm(self._alsa_device + '.in', self._alsa_device + '.out',
+                          self._sample_rate)
+        else:
+            pcm = AlsaPcm(self._alsa_device, self._sample_rate, self._playout_ms)
+        return PcmAudio(pcm, self._sample_rate)
+
+    async def _prepare(self):
+        start = time.monotonic()
+        udp_port = self._port_pool.lease()
+        try:
+            # Do not use any STUN/TURN servers (we use manual port forwarding)
+            pc = RTCPeerConnection(RTCConfiguration(iceServers=[]))
+            audio = self._open_audio()
+
+            @pc.on("track")
+            def on_track(track):
+                logger.info("Receiving track %s" % (track.kind,))
+                audio.play(track)
+
+            pc.addTrack(audio.track)
+            set_codec_preferences(pc, self._codecs)
+            offer = apply_codec_parameters(await pc.createOffer(), self._codecs)
+            addresses = local_addresses(self._ice_interface) if self._ice_interface else None
+            with UdpPortPool.bind_to(udp_port), gather_on(addresses):
+                await pc.setLocalDescription(offer)
+        except BaseException:
+            self._port_pool.release(udp_port)
+            raise
+
+        logger.info('Standby call ready on UDP port %d (%.0f ms)' % (
+            udp_port, (time.monotonic() - start) * 1000
+        ))
+        return PreparedCall(pc, audio, udp_port)
+
+    async def take(self):
+        '''
+        Returns the standby call (preparing one now if there is none ready)
+        '''
+        await self._idle.wait()
+        self._idle.clear()
+        if self._recycle_handle:
+            self._recycle_handle.cancel()
+            self._recycle_handle = None
+        if self._standby is None or (self._standby.done() and self._standby.exception()):
+            self._replenish()
+
+        standby, self._standby = self._standby, None
+        try:
+            return await asyncio.shield(standby)
+        except asyncio.CancelledError:
+            # The call went away before the standby was ready. Keep it for the next one
+            if self._standby is None:
+                self._standby = standby
+            self._idle.set()
+            raise
+        except Exception:
+            self._idle.set()
+            raise
+
+    async def release(self, call):
+        '''
+        Closes a call that was handed out (or a stale standby), and prepares the next
+        standby
+        '''
+        try:
+            await self._close_then_replenish(call)
+        finally:
+            self._idle.set()
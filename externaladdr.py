@@ -0,0 +1,226 @@
+import time
+import fcntl
+import socket
+import struct
+import asyncio
+import logging
+import ipaddress
+
+import aiohttp
+
+
+DEFAULT_ADDRESS_URLS = (
+    'http://checkip.amazonaws.com',
+    'https://api.ipify.org',
+    'https://ifconfig.me/ip',
+)
+ADDRESS_TTL = 10 * 60
+ADDRESS_REFRESH_INTERVAL = 5 * 60
+ADDRESS_RETRY_INTERVAL = 10
+ADDRESS_HTTP_TIMEOUT = 5
+SIOCGIFADDR = 0x8915
+# Any address outside the host: finding the route to it sends nothing
+ROUTE_PROBE_ADDRESS = '192.0.2.1'
+
+logger = logging.getLogger('ExternalAddr')
+
+
+class ExternalAddressError(Exception):
+    pass
+
+
+def interface_address(ifname):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            ifreq = fcntl.ioctl(sock.fileno(), SIOCGIFADDR,
+                                struct.pack('256s', ifname.encode()[:15]))
+        except OSError as e:
+            raise ExternalAddressError('No address on interface %s: %s' % (ifname, e))
+    return socket.inet_ntoa(ifreq[20:24])
+
+
+def local_addresses(spec):
+    '''
+    The addresses named by spec: an IP address, or the name of a local interface
+    '''
+    try:
+        return [str(ipaddress.ip_address(spec))]
+    except ValueError:
+        return [interface_address(spec)]
+
+
+def route_address(destination=ROUTE_PROBE_ADDRESS):
+    '''
+    The local address that packets to destination leave from (the default route's)
+    '''
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.connect((destination, 9))
+        except OSError as e:
+            raise ExternalAddressError('No route to %s: %s' % (destination, e))
+        return sock.getsockname()[0]
+
+
+class StaticAddressSource:
+    def __init__(self, address):
+        self._address = str(ipaddress.ip_address(address))
+
+    async def get(self):
+        return self._address
+
+    def __str__(self):
+        return 'static %s' % (self._address,)
+
+
+class InterfaceAddressSource:
+    def __init__(self, ifname):
+        self._ifname = ifname
+
+    async def get(self):
+        return interface_address(self._ifname)
+
+    def __str__(self):
+        return 'interface %s' % (self._ifname,)
+
+
+class LocalAddressSource:
+    '''
+    The address of a local interface (or an address) given to local_addresses, or
+    without one, the address of the default route
+    '''
+    def __init__(self, spec=None):
+        self._spec = spec
+
+    async def get(self):
+        if self._spec:
+            return local_addresses(self._spec)[0]
+        return route_address()
+
+    def __str__(self):
+        return 'local %s' % (self._spec or 'default route',)
+
+
+class HttpAddressSource:
+    '''
+    Races several "what is my IP" endpoints, and takes the first valid answer
+    '''
+    def __init__(self, urls=DEFAULT_ADDRESS_URLS, timeout=ADDRESS_HTTP_TIMEOUT):
+        self._urls = list(urls)
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+
+    async def _get_one(self, session, url):
+        async with session.get(url) as req:
+            req.raise_for_status()
+            return str(ipaddress.ip_address((await req.text()).strip()))
+
+    async def get(self):
+        errors = []
+        async with aiohttp.ClientSession(timeout=self._timeout) as session:
+            tasks = [asyncio.ensure_future(self._get_one(session, url)) for url in self._urls]
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    try:
+                        return await next_done
+                    except Exception as e:
+                        errors.append(e)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        raise ExternalAddressError('All address endpoints failed: %s' % (
+            '; '.join('%s %s' % (type(e).__name__, e) for e in errors),
+        ))
+
+    def __str__(self):
+        return 'http %s' % (', '.join(self._urls),)
+
+
+class ExternalAddressResolver:
+    '''
+    Keeps the external address cached and refreshed in the background, so that call
+    setup never waits on a lookup. A stale address is served while it revalidates.
+    Failed lookups are retried with exponential backoff. Until one succeeds, calls get
+    the address of the fallback source, if there is one.
+    '''
+    def __init__(self, source, ttl=ADDRESS_TTL, refresh_interval=ADDRESS_REFRESH_INTERVAL,
+                 fallback=None, retry_interval=ADDRESS_RETRY_INTERVAL):
+        self._source = source
+        self._fallback = fallback
+        self._ttl = ttl
+        self._refresh_interval = refresh_interval
+        self._retry_interval = retry_interval
+        self._address = None
+        self._updated = 0
+        self._refresh_task = None
+        self._background_task = None
+
+    @property
+    def address(self):
+        return self._address
+
+    def _is_fresh(self):
+        return self._address is not None and time.monotonic() - self._updated < self._ttl
+
+    async def _refresh(self):
+        address = await self._source.get()
+        if address != self._address:
+            logger.info('External address: %s (from %s)' % (address, self._source))
+        self._address = address
+        self._updated = time.monotonic()
+        return address
+
+    def refresh(self):
+        '''
+        Starts a refresh, unless one is already in flight. Returns its task
+        '''
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh())
+            self._refresh_task.add_done_callback(self._refresh_done)
+        return self._refresh_task
+
+    def _refresh_done(self, task):
+        if not task.cancelled() and task.exception():
+            logger.warning('External address refresh failed: %r' % (task.exception(),))
+
+    async def _background_refresh(self):
+        retry_interval = self._retry_interval
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                await asyncio.sleep(retry_interval)
+                retry_interval = min(retry_interval * 2, self._refresh_interval)
+            else:
+                retry_interval = self._retry_interval
+                await asyncio.sleep(self._refresh_interval)
+
+    def start(self):
+        self._background_task = asyncio.create_task(self._background_refresh())
+
+    def stop(self):
+        if self._background_task:
+            self._background_task.cancel()
+            self._background_task = None
+
+    async def get(self):
+        if self._is_fresh():
+            return self._address
+
+        if self._address is not None:
+            # Stale: serve it now, revalidate in the background
+            self.refresh()
+            return self._address
+
+        try:
+            return await asyncio.shield(self.refresh())
+        except Exception as e:
+            if self._fallback is None:
+                raise
+            address = await self._fallback.get()
+            logger.warning('No external address yet (%r), advertising %s (from %s)' % (
+                e, address, self._fallback
+            ))
+            return address
@@ -0,0 +1,437 @@
+'''
+A small in-process stand-in for a Matrix homeserver, for load testing the gateway offline.
+Implements just what the gateway uses (login, filters, sync with timeline and to-device
+events, room_send, room state, profile, media upload, key upload), with injected latency
+and failures, and a scripted peer that answers or rejects the gateway's calls.
+'''
+import json
+import time
+import uuid
+import random
+import asyncio
+import logging
+import argparse
+import collections
+
+from aiohttp import web
+
+
+DEFAULT_ROOM = '!gateway:fake'
+DEFAULT_PEER = '@peer:fake'
+DEFAULT_TIMELINE_LIMIT = 10
+MAX_SYNC_TIMEOUT = 30
+ONE_TIME_KEY_COUNT = 50
+CALL_ACTIONS = ('answer', 'reject', 'ignore')
+
+logger = logging.getLogger('FakeHomeserver')
+
+
+def _error(status, errcode, error, **extra):
+    return web.json_response(dict({'errcode': errcode, 'error': error}, **extra),
+                             status=status)
+
+
+class CallScript:
+    '''
+    How the peer in the room responds to a call invite: answer it (with a real aiortc peer
+    connection sending silence) and hang up after call_seconds, reject it, or ignore it.
+    With trickle, the answer's ICE candidates are sent in an m.call.candidates event.
+    '''
+    def __init__(self, action='answer', answer_delay=0.5, call_seconds=5.0, trickle=False):
+        if action not in CALL_ACTIONS:
+            raise ValueError('Unknown call action %r' % (action,))
+        self.action = action
+        self.answer_delay = answer_delay
+        self.call_seconds = call_seconds
+        self.trickle = trickle
+
+
+class FakeHomeserver:
+    def __init__(self, rooms=(DEFAULT_ROOM,), peer=DEFAULT_PEER, latency=0.0, jitter=0.0,
+                 failure_rate=0.0, rate_limit_rate=0.0, call_script=None, server_name='fake',
+                 member_update_latency=0.0):
+        self.server_name = server_name
+        self.peer = peer
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.rate_limit_rate = rate_limit_rate
+        # Time to write each m.room.member event. A display name change writes one per
+        # joined room, one after the other
+        self.member_update_latency = member_update_latency
+        self.call_script = call_script or CallScript()
+        # (room, event) of every room event, the sync token is an index into it
+        self._events = []
+        self._state = {room: [] for room in rooms}
+        self._members = {room: set() for room in rooms}
+        self._to_device = collections.defaultdict(list)
+        self._tokens = {}
+        self._filters = {}
+        self._txns = {}
+        self._displaynames = {}
+        # (content type, data) of uploaded media, by media ID
+        self.media = {}
+        self._changed = asyncio.Condition()
+        self._listeners = []
+        # Peer connections of the answered calls, by call ID
+        self._calls = {}
+        self._tasks = set()
+        self._runner = None
+        self.requests = collections.Counter()
+
+        for room in rooms:
+            self._add_state(room, peer, 'm.room.create', '', {'creator': peer})
+            self.join(room, peer)
+
+    def add_listener(self, callback):
+        '''
+        callback(room, event) is called for every event a client sends to a room
+        '''
+        self._listeners.append(callback)
+
+    def _make_event(self, sender, event_type, content, state_key=None):
+        event = {
+            'event_id': '$%d-%s' % (len(self._events), uuid.uuid4().hex[:8]),
+            'sender': sender,
+            'type': event_type,
+            'content': content,
+            'origin_server_ts': int(time.time() * 1000),
+            'unsigned': {'age': 0},
+        }
+        if state_key is not None:
+            event['state_key'] = state_key
+        return event
+
+    def _add_state(self, room, sender, event_type, state_key, content):
+        event = self._make_event(sender, event_type, content, state_key)
+        self._state[room] = [e for e in self._state[room]
+                             if (e['type'], e['state_key']) != (event_type, state_key)]
+        self._state[room].append(event)
+        self._append(room, event)
+
+    def _append(self, room, event):
+        self._events.append((room, event))
+        asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    def join(self, room, user):
+        self._members[room].add(user)
+        self._add_state(room, user, 'm.room.member', user, {'membership': 'join'})
+
+    def send_event(self, room, sender, event_type, content):
+        '''
+        Sends a room event as sender (e.g. the peer)
+        '''
+        event = self._make_event(sender, event_type, content)
+        self._append(room, event)
+        return event['event_id']
+
+    def send_to_device(self, user, sender, event_type, content):
+        self._to_device[user].append({'sender': sender, 'type': event_type, 'content': content})
+        asyncio.ensure_future(self._notify())
+
+    async def _delay(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        self.requests[request.match_info.route.name or request.path] += 1
+        await self._delay()
+        if request.match_info.route.name not in ('login', None):
+            auth = request.headers.get('Authorization', '')
+            token = auth[len('Bearer '):] if auth.startswith('Bearer ') else \
+                request.query.get('access_token')
+            if token not in self._tokens:
+                return _error(401, 'M_UNKNOWN_TOKEN', 'Unknown access token')
+            request['user'] = self._tokens[token]
+            request['token'] = token
+        return await handler(request)
+
+    async def _login(self, request):
+        body = await request.json()
+        user = body.get('identifier', {}).get('user') or body.get('user')
+        if not user:
+            return _error(400, 'M_BAD_JSON', 'No user')
+        if not user.startswith('@'):
+            user = '@%s:%s' % (user, self.server_name)
+        token = uuid.uuid4().hex
+        self._tokens[token] = user
+        for room in self._state:
+            if user not in self._members[room]:
+                self.join(room, user)
+        return web.json_response({
+            'user_id': user, 'access_token': token,
+            'device_id': body.get('device_id') or uuid.uuid4().hex[:10].upper(),
+        })
+
+    async def _upload_filter(self, request):
+        filter_id = str(len(self._filters))
+        self._filters[filter_id] = await request.json()
+        return web.json_response({'filter_id': filter_id})
+
+    async def _joined_rooms(self, request):
+        return web.json_response({
+            'joined_rooms': [room for room, members in self._members.items()
+                             if request['user'] in members]
+        })
+
+    def _timeline_limit(self, sync_filter):
+        if sync_filter is None:
+            return DEFAULT_TIMELINE_LIMIT
+        if not sync_filter.startswith('{'):
+            sync_filter = self._filters.get(sync_filter)
+        else:
+            sync_filter = json.loads(sync_filter)
+        return ((sync_filter or {}).get('room', {}).get('timeline', {})
+                .get('limit', DEFAULT_TIMELINE_LIMIT))
+
+    def _sync_response(self, user, since, full_state, limit):
+        rooms = [room for room, members in self._members.items() if user in members]
+        join = {}
+        for room in rooms:
+            events = [event for pos, (event_room, event) in enumerate(self._events)
+                      if event_room == room and pos >= since]
+            limited = len(events) > limit
+            join[room] = {
+                'timeline': {'events': events[-limit:], 'limited': limited,
+                             'prev_batch': str(since)},
+                'state': {'events': list(self._state[room]) if full_state else []},
+                'ephemeral': {'events': []},
+                'account_data': {'events': []},
+                'summary': {'m.joined_member_count': len(self._members[room])},
+            }
+        to_device, self._to_device[user] = self._to_device[user], []
+        return {
+            'next_batch': str(len(self._events)),
+            'rooms': {'join': join, 'invite': {}, 'leave': {}},
+            'to_device': {'events': to_device},
+            'device_one_time_keys_count': {'signed_curve25519': ONE_TIME_KEY_COUNT},
+            'device_lists': {'changed': [], 'left': []},
+        }
+
+    def _has_news(self, user, since):
+        return (self._to_device[user] or
+                any(user in self._members[room] for room, _ in self._events[since:]))
+
+    async def _sync(self, request):
+        user = request['user']
+        since = request.query.get('since')
+        full_state = request.query.get('full_state') == 'true' or since is None
+        since = int(since or 0)
+        timeout = min(int(request.query.get('timeout', 0)) / 1000, MAX_SYNC_TIMEOUT)
+        limit = self._timeline_limit(request.query.get('filter'))
+
+        if not full_state and not self._has_news(user, since) and timeout:
+            async with self._changed:
+                try:
+                    await asyncio.wait_for(
+                        self._changed.wait_for(lambda: self._has_news(user, since)), timeout
+                    )
+                except asyncio.TimeoutError:
+                    pass
+        return web.json_response(self._sync_response(user, since, full_state, limit))
+
+    async def _room_send(self, request):
+        room = request.match_info['room']
+        if room not in self._members or request['user'] not in self._members[room]:
+            return _error(403, 'M_FORBIDDEN', 'Not in room %s' % (room,))
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            return _error(429, 'M_LIMIT_EXCEEDED', 'Too many requests', retry_after_ms=100)
+        if roll < self.rate_limit_rate + self.failure_rate:
+            return _error(500, 'M_UNKNOWN', 'Injected failure')
+
+        key = (request['token'], request.match_info['txn'])
+        if key not in self._txns:
+            event = self._make_event(request['user'], request.match_info['type'],
+                                     await request.json())
+            self._txns[key] = event['event_id']
+            self._append(room, event)
+            for listener in self._listeners:
+                listener(room, event)
+            self._on_client_event(room, event)
+        return web.json_response({'event_id': self._txns[key]})
+
+    async def _set_displayname(self, request):
+        user = request.match_info['user']
+        displayname = self._displaynames[user] = (await request.json()).get('displayname')
+        for room, members in self._members.items():
+            if user in members:
+                await asyncio.sleep(self.member_update_latency)
+                self._add_state(room, user, 'm.room.member', user,
+                                {'membership': 'join', 'displayname': displayname})
+        return web.json_response({})
+
+    async def _put_state(self, request):
+        room, event_type = request.match_info['room'], request.match_info['type']
+        if room not in self._members or request['user'] not in self._members[room]:
+            return _error(403, 'M_FORBIDDEN', 'Not in room %s' % (room,))
+        if event_type == 'm.room.member':
+            await asyncio.sleep(self.member_update_latency)
+        self._add_state(room, request['user'], event_type, request.match_info['state_key'],
+                        await request.json())
+        return web.json_response({'event_id': self._state[room][-1]['event_id']})
+
+    async def _upload(self, request):
+        media_id = uuid.uuid4().hex
+        self.media[media_id] = (request.content_type, await request.read())
+        return web.json_response({'content_uri': 'mxc://%s/%s' % (self.server_name, media_id)})
+
+    async def _keys_upload(self, request):
+        return web.json_response({'one_time_key_counts': {
+            'signed_curve25519': ONE_TIME_KEY_COUNT
+        }})
+
+    async def _keys_query(self, request):
+        return web.json_response({'device_keys': {}, 'failures': {}})
+
+    async def _keys_claim(self, request):
+        return web.json_response({'one_time_keys': {}, 'failures': {}})
+
+    async def _send_to_device(self, request):
+        messages = (await request.json()).get('messages', {})
+        for user, devices in messages.items():
+            for content in devices.values():
+                self.send_to_device(user, request['user'], request.match_info['type'], content)
+        return web.json_response({})
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _on_client_event(self, room, event):
+        if event['sender'] == self.peer:
+            return
+        call_id = event['content'].get('call_id')
+        if event['type'] == 'm.call.invite':
+            self._spawn(self._respond_to_call(room, event['content']))
+        elif event['type'] == 'm.call.hangup' and call_id in self._calls:
+            self._spawn(self._calls.pop(call_id).close())
+
+    async def _respond_to_call(self, room, invite):
+        script = self.call_script
+        call_id = invite['call_id']
+        if script.action == 'ignore':
+            return
+        await asyncio.sleep(script.answer_delay)
+        if script.action == 'reject':
+            self.send_event(room, self.peer, 'm.call.hangup', {'call_id': call_id, 'version': 0})
+            return
+
+        from aiortc import RTCPeerConnection, RTCSessionDescription
+        from aiortc.mediastreams import AudioStreamTrack
+
+        pc = self._calls[call_id] = RTCPeerConnection()
+        await pc.setRemoteDescription(RTCSessionDescription(**invite['offer']))
+        pc.addTrack(AudioStreamTrack())
+        await pc.setLocalDescription(await pc.createAnswer())
+        sdp = pc.localDescription.sdp
+        if script.trickle:
+            lines = sdp.split('\r\n')
+            candidates = [line[len('a='):] for line in lines if line.startswith('a=candidate:')]
+            sdp = '\r\n'.join(line for line in lines if not line.startswith('a=candidate:'))
+        self.send_event(room, self.peer, 'm.call.answer', {
+            'call_id': call_id, 'version': 0, 'answer': {'type': 'answer', 'sdp': sdp},
+        })
+        if script.trickle:
+            self.send_event(room, self.peer, 'm.call.candidates', {
+                'call_id': call_id, 'version': 0,
+                'candidates': [{'candidate': c, 'sdpMid': '0', 'sdpMLineIndex': 0}
+                               for c in candidates],
+            })
+
+        await asyncio.sleep(script.call_seconds)
+        if call_id in self._calls:
+            self.send_event(room, self.peer, 'm.call.hangup', {'call_id': call_id, 'version': 0})
+            await self._calls.pop(call_id).close()
+
+    def app(self):
+        app = web.Application(middlewares=[self._middleware])
+        prefix = '/_matrix/client/{version}'
+        app.router.add_post(prefix + '/login', self._login, name='login')
+        app.router.add_post(prefix + '/user/{user}/filter', self._upload_filter, name='filter')
+        app.router.add_get(prefix + '/joined_rooms', self._joined_rooms, name='joined_rooms')
+        app.router.add_get(prefix + '/sync', self._sync, name='sync')
+        app.router.add_put(prefix + '/rooms/{room}/send/{type}/{txn}', self._room_send,
+                           name='room_send')
+        app.router.add_put(prefix + '/rooms/{room}/state/{type}/{state_key:.*}',
+                           self._put_state, name='state')
+        app.router.add_put(prefix + '/profile/{user}/displayname', self._set_displayname,
+                           name='displayname')
+        app.router.add_post('/_matrix/media/{version}/upload', self._upload, name='upload')
+        app.router.add_post(prefix + '/keys/upload', self._keys_upload, name='keys_upload')
+        app.router.add_post(prefix + '/keys/query', self._keys_query, name='keys_query')
+        app.router.add_post(prefix + '/keys/claim', self._keys_claim, name='keys_claim')
+        app.router.add_put(prefix + '/sendToDevice/{type}/{txn}', self._send_to_device,
+                           name='send_to_device')
+        return app
+
+    async def start(self, host='127.0.0.1', port=0):
+        '''
+        Returns the homeserver URL
+        '''
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        logger.info('Fake homeserver on http://%s:%d' % (host, port))
+        return 'http://%s:%d' % (host, port)
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        for pc in self._calls.values():
+            await pc.close()
+        self._calls.clear()
+        if self._runner:
+            await self._runner.cleanup()
+
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description='Fake Matrix homeserver for testing')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8008)
+    parser.add_argument('--room', help='Room to create (can be repeated)', action='append')
+    parser.add_argument('--latency_ms', help='Added latency per request', type=float, default=0)
+    parser.add_argument('--jitter_ms', help='Random +/- latency per request', type=float,
+                        default=0)
+    parser.add_argument('--failure_rate', help='Fraction of room sends that fail with 500',
+                        type=float, default=0)
+    parser.add_argument('--rate_limit_rate', help='Fraction of room sends that get 429',
+                        type=float, default=0)
+    parser.add_argument('--member_update_ms', help='Time to write each member event (a '
+                        'display name change writes one per joined room)', type=float,
+                        default=0)
+    parser.add_argument('--call_action', help='How the peer responds to calls',
+                        choices=CALL_ACTIONS, default='answer')
+    parser.add_argument('--answer_delay', type=float, default=0.5)
+    parser.add_argument('--call_seconds', type=float, default=5)
+    parser.add_argument('--trickle', help='Send the answer ICE candidates separately',
+                        action='store_true')
+    return parser.parse_args()
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_cmdline()
+    server = FakeHomeserver(
+        rooms=args.room or [DEFAULT_ROOM],
+        latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+        failure_rate=args.failure_rate, rate_limit_rate=args.rate_limit_rate,
+        call_script=CallScript(args.call_action, args.answer_delay, args.call_seconds,
+                               args.trickle),
+        member_update_latency=args.member_update_ms / 1000,
+    )
+    await server.start(args.host, args.port)
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
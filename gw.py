@@ -1,17 +1,41 @@
 import os
+import json
+import time
 import asyncio
 import logging
 import argparse
 import functools
+import contextlib
 
+from nio import JoinedRoomsResponse, SyncResponse
+
+import metrics
 import qmivoice
+from loopmonitor import LoopLagMonitor, LOOP_STALL_THRESHOLD
+from callfactory import CallFactory, ALSA_DEVICE, AUDIO_BACKENDS, DEFAULT_CODECS, parse_codecs
+from externaladdr import (
+    ExternalAddressResolver, StaticAddressSource, InterfaceAddressSource, HttpAddressSource,
+    LocalAddressSource, DEFAULT_ADDRESS_URLS
+)
 from matrixapi import (
-    do_matrix_login, MatrixCallForwarder, MatrixSmsForwarder, MatrixEventHandler,
-    udp_random_port_monkeypatch
+    do_matrix_login, MatrixCallForwarder, MatrixSmsForwarder, MatrixEventHandler, SyncStats,
+    MatrixLoginError, STORE_DIR, OUTBOX_FILE, CATCHUP_TIMELINE_LIMIT, CALLERID_MODES
 )
+from pcmaudio import PCM_SAMPLE_RATE, PCM_SAMPLE_RATES, PLAYOUT_MS
 from quectelmodem import QuectelModemManager
+from ratecontrol import (
+    OpusRateControl, parse_bitrates, OPUS_FRAME_MS, OPUS_MIN_BITRATE, OPUS_MAX_BITRATE
+)
+from sendqueue import MatrixSendQueue
+from smsqueue import SmsSendQueue, SMS_RATE_PER_MINUTE
+from supervisor import ModemSupervisor
+from udpports import UdpPortPool, port_binding_loop_policy
+from voicemail import Voicemail, VOICEMAIL_MAX_SECONDS
 
 
+# Log the startup timing without the modems that aren't ready after this long
+STARTUP_TIMING_TIMEOUT = 5 * 60
+
 logger = logging.getLogger('GsmGw')
 
 
@@ -21,53 +45,322 @@ def parse_cmdline():
     parser.add_argument('--user', help='Bots username on homeserver', required=True)
     parser.add_argument('--password', help='Bots password')
     parser.add_argument('--udp_port', help='UDP port for voice (that is port forwarded)',
-                        type=int, required=True)
-    parser.add_argument('--modem_tty', help='TTY device of the modem for AT', required=True)
-    parser.add_argument('--modem_dev', help='Modem device for QMI', required=True)
+                        type=int, default=None)
+    parser.add_argument('--udp_port_range', help='Range of forwarded UDP ports for voice, '
+                        'one per concurrent call and modem, e.g. 49572-49600', default=None)
+    parser.add_argument('--external_ip', help='Static external IP to advertise for voice',
+                        default=None)
+    parser.add_argument('--external_iface',
+                        help='Advertise the address of this local interface for voice',
+                        default=None)
+    parser.add_argument('--ice_interface', help='Gather ICE candidates only on this local '
+                        'interface or address (default: --external_iface, or all interfaces)')
+    parser.add_argument('--external_ip_url', help='URL that returns our external IP '
+                        '(can be repeated, all are raced)', action='append', default=None)
+    parser.add_argument('--modem_tty', help='TTY device of the modem for AT')
+    parser.add_argument('--modem_dev', help='Modem device for QMI')
+    parser.add_argument('--config', help='JSON file describing several modems (instead of '
+                        '--modem_tty and --modem_dev)', default=None)
     parser.add_argument('--call_timeout', help='Timeout for ringing before hangup',
                         type=int, default=90)
+    parser.add_argument('--callerid_mode', help='Show the caller ID in a notice next to the '
+                        'invite, as the bot\'s display name in the room (member), or as its '
+                        'global display name', choices=CALLERID_MODES, default='notice')
+    parser.add_argument('--voicemail', help='Answer calls nobody took (or rejected) on the '
+                        'Matrix side, and post the message to the room', action='store_true')
+    parser.add_argument('--voicemail_greeting', help='Audio file played before recording a '
+                        'voicemail', default=None)
+    parser.add_argument('--voicemail_seconds', help='Longest voicemail recorded', type=int,
+                        default=VOICEMAIL_MAX_SECONDS)
     parser.add_argument('--sim_pin', help='SIM card PIN', default=None)
     parser.add_argument('--preferred_network', help='GSM/UMTS/LTE', default='LTE')
-    return parser.parse_args()
+    parser.add_argument('--audio_backend', help='Read and write the sound card directly '
+                        '(alsa), through libav (ffmpeg), or use raw PCM files or named pipes '
+                        '<alsa_device>.in/.out instead (file)', choices=AUDIO_BACKENDS,
+                        default='alsa')
+    parser.add_argument('--audio_rate', help='Sample rate of the modem PCM audio', type=int,
+                        choices=PCM_SAMPLE_RATES, default=PCM_SAMPLE_RATE)
+    parser.add_argument('--playout_ms', help='Playout buffer of the received audio (ms)',
+                        type=int, default=PLAYOUT_MS)
+    parser.add_argument('--codecs', help='Audio codecs to offer, in order of preference, '
+                        'e.g. PCMU,PCMA,opus (opus-nb is Opus asking for narrowband)',
+                        default=','.join(DEFAULT_CODECS))
+    parser.add_argument('--rate_control', help='Adapt the Opus bitrate, frame size and FEC of '
+                        'calls to the loss, jitter and round trip time the peer reports',
+                        action='store_true')
+    parser.add_argument('--opus_bitrate', help='Bitrate range (bit/s) the rate control keeps '
+                        'Opus in', default='%d-%d' % (OPUS_MIN_BITRATE, OPUS_MAX_BITRATE))
+    parser.add_argument('--opus_max_frame_ms', help='Longest Opus frames the rate control '
+                        'uses', type=int, choices=OPUS_FRAME_MS, default=OPUS_FRAME_MS[-1])
+    parser.add_argument('--uvloop', help='Run on uvloop instead of the default asyncio loop',
+                        action='store_true')
+    parser.add_argument('--loop_stall_ms', help='Log event loop stalls longer than this, with '
+                        'the stack of what blocked it (0 disables)', type=int,
+                        default=int(LOOP_STALL_THRESHOLD * 1000))
+    parser.add_argument('--sms_rate', help='Outbound SMS (message parts) a modem sends per '
+                        'minute at most', type=int, default=SMS_RATE_PER_MINUTE)
+    parser.add_argument('--metrics_port', help='Serve Prometheus metrics over HTTP on this port',
+                        type=int, default=None)
+    args = parser.parse_args()
+    if not args.config and not (args.modem_tty and args.modem_dev):
+        parser.error('either --config, or --modem_tty and --modem_dev are required')
+    if not args.udp_port and not args.udp_port_range:
+        parser.error('either --udp_port or --udp_port_range is required')
+    try:
+        args.codecs = parse_codecs(args.codecs)
+        args.opus_bitrate = parse_bitrates(args.opus_bitrate)
+        ports = len(UdpPortPool.parse(args.udp_port_range or args.udp_port))
+    except ValueError as e:
+        parser.error(str(e))
+    # Each modem holds a port for its standby call, which then becomes its call
+    modems = len(load_modem_configs(args))
+    if ports < modems:
+        parser.error('%d forwarded UDP ports for %d modems, pass a --udp_port_range of at '
+                     'least %d ports' % (ports, modems, modems))
+    return args
 
 
-async def main():
-    logging.basicConfig(level=logging.INFO)
+def load_modem_configs(args):
+    '''
+    Returns a list of per-modem settings. Settings missing from the config file
+    default to the command line ones.
+    '''
+    if args.config:
+        with open(args.config, 'r') as config:
+            modems = json.load(config)['modems']
+    else:
+        modems = [{'tty': args.modem_tty, 'dev': args.modem_dev}]
 
-    args = parse_cmdline()
+    return [{
+        'tty': modem['tty'],
+        'dev': modem['dev'],
+        'name': modem.get('name', os.path.basename(modem['tty'])),
+        'room': modem.get('room'),
+        'alsa_device': modem.get('alsa_device', ALSA_DEVICE),
+        'sim_pin': modem.get('sim_pin', args.sim_pin),
+        'preferred_network': modem.get('preferred_network', args.preferred_network),
+        'call_timeout': modem.get('call_timeout', args.call_timeout),
+        'codecs': parse_codecs(modem['codecs']) if 'codecs' in modem else args.codecs,
+    } for modem in modems]
+
+
+def make_address_resolver(args):
+    if args.external_ip:
+        return ExternalAddressResolver(StaticAddressSource(args.external_ip))
+    if args.external_iface:
+        return ExternalAddressResolver(InterfaceAddressSource(args.external_iface))
+    # Until the endpoints answer, calls advertise the address ICE gathers on
+    return ExternalAddressResolver(
+        HttpAddressSource(args.external_ip_url or DEFAULT_ADDRESS_URLS),
+        fallback=LocalAddressSource(args.ice_interface)
+    )
+
+
+class StartupTimer:
+    '''
+    Collects the duration of each startup phase, for one structured log line
+    '''
+    def __init__(self):
+        self._start = time.monotonic()
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.monotonic() - start
+
+    def log(self):
+        logger.info('Startup timing: %s total=%.2fs' % (
+            ' '.join('%s=%.2fs' % phase for phase in self.phases.items()),
+            time.monotonic() - self._start
+        ))
+
+
+async def export_signal_info(modem_name, voice):
+    try:
+        async for info in voice.signal_info():
+            for measure in ('rssi', 'rsrq', 'rsrp', 'snr'):
+                value = getattr(info, measure) if info else None
+                if value is not None:
+                    metrics.MODEM_SIGNAL_DBM.set(value, modem=modem_name, measure=measure)
+    except (qmivoice.QmiVoiceException, asyncio.TimeoutError) as e:
+        logger.warning('Modem %s: no QMI signal info: %r' % (modem_name, e))
+
+
+async def run_modem(modem_config, modem_manager, timer):
+    '''
+    Runs one modem (its QMI and AT sides), until it fails
+    '''
+    name = modem_config['name']
+    async with contextlib.AsyncExitStack() as stack:
+        with timer.phase('qmi_cid[%s]' % (name,)):
+            voice = await stack.enter_async_context(
+                qmivoice.QmiVoice(modem_config['dev']).alloc_cid()
+            )
+        signal_task = asyncio.create_task(export_signal_info(name, voice))
+        stack.callback(signal_task.cancel)
+
+        run_task = asyncio.create_task(modem_manager.run())
+        stack.callback(run_task.cancel)
+        ready_task = asyncio.create_task(modem_manager.ready.wait())
+        with timer.phase('modem_reset[%s]' % (name,)):
+            await asyncio.wait([run_task, ready_task], return_when=asyncio.FIRST_COMPLETED)
+        ready_task.cancel()
+        await run_task
+
+
+def supervise_modem(modem_config, modem_manager, timer):
+    '''
+    Runs one modem, re-opening it when it fails. A failed modem doesn't take down the
+    other modems, or the Matrix side.
+    '''
+    return ModemSupervisor(
+        modem_config['name'],
+        functools.partial(run_modem, modem_config, modem_manager, timer),
+        [modem_config['tty'], modem_config['dev']]
+    ).run()
 
-    matrix_client = await do_matrix_login(args.homeserver, args.user, args.password)
+
+async def start_matrix(args, modem_configs, timer):
+    '''
+    Logs in, and resumes syncing from the stored token (events missed while offline
+    are triaged, not handled). Returns (client, event handler, room by modem name,
+    steady state sync filter)
+    '''
+    with timer.phase('matrix_login'):
+        matrix_client = await do_matrix_login(args.homeserver, args.user, args.password)
     logger.info('Logged in.')
 
-    # Do this to sync rooms and discard missed messages
-    res = await matrix_client.sync(full_state=True)
-    joined_rooms = list(res.rooms.join.keys())
-    room = joined_rooms.pop(0)
-    logger.info('Using room: %s, other possible rooms are: %r' % (room, joined_rooms))
+    with timer.phase('matrix_rooms'):
+        res = await matrix_client.joined_rooms()
+    if not isinstance(res, JoinedRoomsResponse):
+        raise MatrixLoginError(res)
+    joined_rooms = res.rooms
+
+    rooms = {}
+    for modem_config in modem_configs:
+        room = modem_config['room'] or joined_rooms[0]
+        if room not in joined_rooms:
+            logger.warning('Modem %s: bot is not joined to room %s' % (
+                modem_config['name'], room
+            ))
+        logger.info('Modem %s: using room %s, joined rooms are: %r' % (
+            modem_config['name'], room, joined_rooms
+        ))
+        rooms[modem_config['name']] = room
 
+    sync_stats = SyncStats()
+    sync_stats.attach(matrix_client)
     matrix_handler = MatrixEventHandler(matrix_client)
-    matrix_call_fwd = functools.partial(
-        MatrixCallForwarder,
-        matrix_client, matrix_handler, room, args.user, args.udp_port,
-        call_timeout=args.call_timeout
-    )
-    matrix_sms_fwd = functools.partial(MatrixSmsForwarder, matrix_client, room)
-    modem_manager = QuectelModemManager(
-        args.modem_tty,
-        call_forwarder=matrix_call_fwd,
-        sms_forwarder=matrix_sms_fwd,
-        sim_card_pin=args.sim_pin,
-        preferred_network=args.preferred_network
-    )
 
-    udp_random_port_monkeypatch(args.udp_port)
+    # nio doesn't persist room state, so the catch-up sync asks for the state of the
+    # bridged rooms (with lazy loaded members). Its timeline starts at the stored token
+    with timer.phase('matrix_catchup'):
+        matrix_handler.start_catchup()
+        sync_filter, res = await asyncio.gather(
+            MatrixEventHandler.upload_sync_filter(matrix_client, set(rooms.values())),
+            matrix_client.sync(
+                sync_filter=MatrixEventHandler.sync_filter(set(rooms.values()),
+                                                           CATCHUP_TIMELINE_LIMIT),
+                full_state=True
+            )
+        )
+        matrix_handler.end_catchup()
+    if isinstance(res, SyncResponse):
+        await sync_stats.record(res)
+    else:
+        logger.warning('Catch-up sync failed: %r' % (res,))
+
+    return matrix_client, matrix_handler, rooms, sync_filter
+
+
+async def log_startup_timing(timer, modem_managers):
+    await asyncio.wait([asyncio.create_task(manager.ready.wait()) for manager in modem_managers],
+                       timeout=STARTUP_TIMING_TIMEOUT)
+    timer.log()
+
+
+async def main(args):
+    timer = StartupTimer()
+    if args.loop_stall_ms:
+        LoopLagMonitor(args.loop_stall_ms / 1000).start()
+    modem_configs = load_modem_configs(args)
+    address_resolver = make_address_resolver(args)
+    address_resolver.start()
+    if args.metrics_port:
+        await metrics.serve(args.metrics_port)
+    port_pool = UdpPortPool.parse(args.udp_port_range or args.udp_port)
+    voicemail = None
+    if args.voicemail:
+        voicemail = Voicemail(args.voicemail_greeting, args.voicemail_seconds, args.audio_rate)
+    rate_control = None
+    if args.rate_control:
+        rate_control = OpusRateControl(*args.opus_bitrate, args.opus_max_frame_ms)
 
-    with qmivoice.QmiVoice(args.modem_dev).alloc_cid():
-        await asyncio.gather(
-            modem_manager.run(),
-            matrix_client.sync_forever(loop_sleep_time=500, full_state=True)
+    # The modems (QMI, reset, network selection) start right away, in parallel with the
+    # Matrix login and catch-up. They hold URCs until their forwarders are attached
+    modems = []
+    for modem_config in modem_configs:
+        call_factory = CallFactory(
+            port_pool, modem_config['alsa_device'], audio_backend=args.audio_backend,
+            sample_rate=args.audio_rate, playout_ms=args.playout_ms,
+            codecs=modem_config['codecs'],
+            ice_interface=args.ice_interface or args.external_iface
         )
+        modem_manager = QuectelModemManager(
+            modem_config['tty'],
+            sim_card_pin=modem_config['sim_pin'],
+            preferred_network=modem_config['preferred_network'],
+            name=modem_config['name'],
+            operator_cache=os.path.join(STORE_DIR, 'operators-%s.json' % (modem_config['name'],))
+        )
+        call_factory.start()
+        modems.append((modem_config, modem_manager, call_factory))
+    modem_runners = [
+        asyncio.create_task(supervise_modem(modem_config, modem_manager, timer))
+        for modem_config, modem_manager, _ in modems
+    ]
+
+    matrix_client, matrix_handler, rooms, sync_filter = await start_matrix(
+        args, modem_configs, timer
+    )
+    send_queue = MatrixSendQueue(matrix_client, OUTBOX_FILE)
+
+    sms_queues = []
+    for modem_config, modem_manager, call_factory in modems:
+        room = rooms[modem_config['name']]
+        sms_queue = SmsSendQueue(
+            os.path.join(STORE_DIR, 'sms-outbox-%s.db' % (modem_config['name'],)),
+            modem_manager, send_queue, args.sms_rate
+        )
+        matrix_handler.route_sms(room, sms_queue)
+        sms_queues.append(sms_queue)
+        modem_manager.attach_forwarders(
+            functools.partial(
+                MatrixCallForwarder,
+                matrix_client, matrix_handler, room, args.user, address_resolver, call_factory,
+                call_timeout=modem_config['call_timeout'], callerid_mode=args.callerid_mode,
+                voicemail=voicemail, rate_control=rate_control
+            ),
+            functools.partial(MatrixSmsForwarder, send_queue, room),
+            status_report_cb=sms_queue.on_status_report
+        )
+    asyncio.create_task(log_startup_timing(timer, [modem[1] for modem in modems]))
+
+    await asyncio.gather(
+        *modem_runners,
+        send_queue.run(),
+        *(sms_queue.run() for sms_queue in sms_queues),
+        matrix_client.sync_forever(loop_sleep_time=500, sync_filter=sync_filter)
+    )
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    logging.basicConfig(level=logging.INFO)
+    args = parse_cmdline()
+    # The loop binds the peer connections' sockets to the leased UDP ports
+    asyncio.set_event_loop_policy(port_binding_loop_policy(args.uvloop))
+    asyncio.run(main(args))
@@ -0,0 +1,322 @@
+'''
+Load test of the whole gateway against the fake homeserver and simulated modems: the real
+sync loop, send queue, SMS and call forwarders (with WebRTC media over loopback, and the
+file audio backend), no hardware or homeserver needed.
+'''
+import io
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import functools
+
+import av
+from nio import AsyncClient, AsyncClientConfig
+
+from bench import BENCH_NUMBER, report, rss_kib, write_tones
+from callfactory import CallFactory
+from externaladdr import ExternalAddressResolver, StaticAddressSource
+from fakehomeserver import FakeHomeserver, CallScript
+from matrixapi import MatrixCallForwarder, MatrixSmsForwarder, MatrixEventHandler, CALLERID_MODES
+from modemsim import ModemSimulator
+from quectelmodem import QuectelModemManager
+from ratecontrol import OpusRateControl
+from sendqueue import MatrixSendQueue
+from udpports import UdpPortPool, port_binding_loop_policy
+from voicemail import Voicemail
+
+
+GATEWAY_USER = '@gateway:fake'
+FIRST_UDP_PORT = 40000
+# How often the modem simulators' command logs are checked for ATA and ATH
+COMMAND_POLL_INTERVAL = 0.005
+SETTLE_TIME = 0.5
+
+
+class RoomEvents:
+    '''
+    Collects when the fake homeserver received each event the gateway sent
+    '''
+    def __init__(self):
+        self.sms_received = {}
+        self._waiters = {}
+
+    def on_event(self, room, event):
+        now = time.perf_counter()
+        if event['type'] == 'm.room.message':
+            if event['content'].get('msgtype') == 'm.audio':
+                self._arrived(room, 'm.audio', now)
+            for line in event['content'].get('body', '').split('\n'):
+                self.sms_received.setdefault(line, now)
+        elif event['type'] == 'm.call.invite':
+            self._arrived(room, 'm.call.invite', now)
+
+    def _arrived(self, room, kind, now):
+        waiter = self._waiters.pop((room, kind), None)
+        if waiter and not waiter.done():
+            waiter.set_result(now)
+
+    def next_event(self, room, kind):
+        '''
+        A future of when the next event of kind (an event type, or m.audio) arrives
+        '''
+        self._waiters[room, kind] = asyncio.get_running_loop().create_future()
+        return self._waiters[room, kind]
+
+
+async def wait_for_command(sim, prefix, start_index, timeout):
+    '''
+    Returns when the modem first got a command starting with prefix
+    '''
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if any(cmd.startswith(prefix) for cmd in sim.commands[start_index:]):
+            return time.perf_counter()
+        await asyncio.sleep(COMMAND_POLL_INTERVAL)
+    raise asyncio.TimeoutError('No %s' % (prefix,))
+
+
+async def start_gateway(args, homeserver, rooms, tmp):
+    '''
+    Returns (modem simulators, tasks) of a gateway with one simulated modem per room
+    '''
+    voicemail = None
+    if args.voicemail:
+        greeting = None
+        if args.greeting_seconds:
+            write_tones(os.path.join(tmp, 'greeting'), args.greeting_seconds)
+            greeting = os.path.join(tmp, 'greeting.wav')
+        voicemail = Voicemail(greeting)
+    client = AsyncClient(homeserver, GATEWAY_USER,
+                         config=AsyncClientConfig(encryption_enabled=False))
+    await client.login('loadtest')
+    handler = MatrixEventHandler(client)
+    send_queue = MatrixSendQueue(client, ':memory:')
+    address_resolver = ExternalAddressResolver(StaticAddressSource('127.0.0.1'))
+    address_resolver.start()
+    port_pool = UdpPortPool(FIRST_UDP_PORT, FIRST_UDP_PORT + 2 * len(rooms) - 1)
+
+    sims, tasks = [], []
+    for i, room in enumerate(rooms):
+        # The file audio backend reads <device>.in and writes <device>.out
+        pcm_device = os.path.join(tmp, 'modem%d' % (i,))
+        open(pcm_device + '.in', 'wb').close()
+        call_factory = CallFactory(port_pool, pcm_device, audio_backend='file',
+                                   ice_interface=args.ice_interface)
+        call_factory.start()
+        sim = ModemSimulator(response_delay=args.modem_delay)
+        manager = QuectelModemManager(
+            sim.open(), name='modem%d' % (i,),
+            call_forwarder=functools.partial(
+                MatrixCallForwarder, client, handler, room, GATEWAY_USER, address_resolver,
+                call_factory, callerid_mode=args.callerid_mode, voicemail=voicemail,
+                rate_control=OpusRateControl() if args.rate_control else None
+            ),
+            sms_forwarder=functools.partial(MatrixSmsForwarder, send_queue, room),
+        )
+        sims.append(sim)
+        tasks.append(asyncio.create_task(manager.run()))
+        await asyncio.wait_for(manager.ready.wait(), timeout=600)
+
+    sync_filter = await MatrixEventHandler.upload_sync_filter(client, set(rooms))
+    await client.sync(full_state=True, sync_filter=sync_filter)
+    tasks.append(asyncio.create_task(send_queue.run()))
+    tasks.append(asyncio.create_task(
+        client.sync_forever(timeout=args.sync_timeout_ms, loop_sleep_time=args.sync_sleep_ms,
+                            sync_filter=sync_filter)
+    ))
+    tasks.append(asyncio.create_task(_close_on_cancel(client)))
+    return sims, tasks
+
+
+async def _close_on_cancel(client):
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await client.close()
+
+
+async def load_sms(args, sims, events):
+    expected = {}
+    start = time.perf_counter()
+    for i in range(args.sms):
+        text = 'Load test message %d' % (i,)
+        expected[text] = time.perf_counter()
+        sims[i % len(sims)].receive_sms(BENCH_NUMBER, text)
+        # Spread out over the simulators' turnaround, like a real burst from several modems
+        if i % len(sims) == len(sims) - 1:
+            await asyncio.sleep(0)
+
+    deadline = time.monotonic() + args.timeout
+    while not events.sms_received.keys() >= expected.keys() and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    received = [text for text in expected if text in events.sms_received]
+    elapsed = max(events.sms_received[text] for text in received) - start if received else 0
+    print('SMS: %d of %d delivered in %.2f s (%.1f msg/s)' % (
+        len(received), len(expected), elapsed, len(received) / elapsed if elapsed else 0
+    ))
+    if received:
+        report('SMS-inject-to-server', [(events.sms_received[text] - expected[text]) * 1000
+                                        for text in received])
+
+
+async def _calls_on_modem(args, sim, room, count, events, results):
+    for _ in range(count):
+        commands = len(sim.commands)
+        invited = events.next_event(room, 'm.call.invite')
+        start = time.perf_counter()
+        sim.ring(BENCH_NUMBER)
+        try:
+            invite_time = await asyncio.wait_for(invited, timeout=args.timeout)
+            answer_time = await wait_for_command(sim, 'ATA', commands, args.timeout)
+            if args.voicemail:
+                # The peer rejected the call, and the caller leaves a message
+                voicemail = events.next_event(room, 'm.audio')
+                await asyncio.sleep(args.greeting_seconds + args.call_seconds)
+                hangup_time = time.perf_counter()
+                sim.remote_hangup()
+                results['voicemail'].append(
+                    (await asyncio.wait_for(voicemail, timeout=args.timeout) - hangup_time) * 1000
+                )
+            else:
+                await wait_for_command(sim, 'ATH', commands, args.timeout + args.call_seconds)
+            await asyncio.sleep(args.call_gap)
+        except asyncio.TimeoutError as e:
+            results['failed'].append(str(e) or 'No invite')
+            sim.remote_hangup()
+            await asyncio.sleep(1)
+            continue
+        results['invite'].append((invite_time - start) * 1000)
+        results['answer'].append((answer_time - start) * 1000)
+
+
+async def load_calls(args, sims, rooms, events):
+    results = {'invite': [], 'answer': [], 'voicemail': [], 'failed': []}
+    counts = [args.calls // len(sims) + (i < args.calls % len(sims)) for i in range(len(sims))]
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        _calls_on_modem(args, sim, room, count, events, results)
+        for sim, room, count in zip(sims, rooms, counts)
+    ))
+    elapsed = time.perf_counter() - start
+    # The last hangups are still in flight
+    await asyncio.sleep(SETTLE_TIME)
+    print('Calls: %d of %d set up in %.2f s (%d concurrent, %.1f s each)' % (
+        len(results['answer']), args.calls, elapsed, len(sims), args.call_seconds
+    ))
+    if results['answer']:
+        report('RING-to-invite', results['invite'])
+        report('RING-to-ATA', results['answer'])
+    if results['voicemail']:
+        report('hangup-to-voicemail', results['voicemail'])
+    for failure in sorted(set(results['failed'])):
+        print('  %d calls failed: %s' % (results['failed'].count(failure), failure))
+
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description='Gateway load test against a fake homeserver')
+    parser.add_argument('--modems', help='Simulated modems (one room each)', type=int,
+                        default=4)
+    parser.add_argument('--sms', help='Incoming SMS to send through', type=int, default=2000)
+    parser.add_argument('--calls', help='Incoming calls to set up', type=int, default=100)
+    parser.add_argument('--call_seconds', help='How long the peer stays in each call',
+                        type=float, default=0.5)
+    parser.add_argument('--answer_delay', help='How long the peer takes to answer',
+                        type=float, default=0.2)
+    parser.add_argument('--call_gap', help='Pause between the hangup of a call and the next '
+                        'RING on the same modem', type=float, default=0)
+    parser.add_argument('--voicemail', help='The peer rejects the calls, and the callers leave '
+                        'a voicemail of --call_seconds', action='store_true')
+    parser.add_argument('--greeting_seconds', help='Voicemail greeting length', type=float,
+                        default=1)
+    parser.add_argument('--rate_control', help='Adapt the Opus the gateway sends to the '
+                        'peer\'s receiver reports', action='store_true')
+    parser.add_argument('--trickle', help='The peer sends its ICE candidates separately',
+                        action='store_true')
+    parser.add_argument('--callerid_mode', help='How the gateway shows the caller ID',
+                        choices=CALLERID_MODES, default='notice')
+    parser.add_argument('--member_update_ms', help='Homeserver time per member event (a '
+                        'global display name change writes one per room)', type=float,
+                        default=0)
+    parser.add_argument('--ice_interface', help='Gather the gateway\'s ICE candidates only '
+                        'on this interface or address (e.g. 127.0.0.1)')
+    parser.add_argument('--latency_ms', help='Homeserver latency per request', type=float,
+                        default=0)
+    parser.add_argument('--jitter_ms', help='Random +/- homeserver latency', type=float,
+                        default=0)
+    parser.add_argument('--failure_rate', help='Fraction of room sends that fail with 500',
+                        type=float, default=0)
+    parser.add_argument('--rate_limit_rate', help='Fraction of room sends that get 429',
+                        type=float, default=0)
+    parser.add_argument('--modem_delay', help='Simulated modem turnaround (seconds)',
+                        type=float, default=0.005)
+    parser.add_argument('--sync_timeout_ms', help='Sync long-poll timeout', type=int,
+                        default=30000)
+    parser.add_argument('--sync_sleep_ms', help='Sleep between syncs', type=int, default=0)
+    parser.add_argument('--timeout', help='Give up on a message or call after this long',
+                        type=float, default=30)
+    parser.add_argument('--uvloop', help='Run on uvloop', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args()
+
+
+async def main(args):
+    rooms = ['!modem%d:fake' % (i,) for i in range(args.modems)]
+    server = FakeHomeserver(
+        rooms=rooms, latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+        failure_rate=args.failure_rate, rate_limit_rate=args.rate_limit_rate,
+        call_script=CallScript('reject' if args.voicemail else 'answer', args.answer_delay,
+                               args.call_seconds, args.trickle),
+        member_update_latency=args.member_update_ms / 1000,
+    )
+    events = RoomEvents()
+    server.add_listener(events.on_event)
+    homeserver = await server.start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rss_start = rss_kib()
+        sims, tasks = await start_gateway(args, homeserver, rooms, tmp)
+        rss_ready = rss_kib()
+        if args.sms:
+            await load_sms(args, sims, events)
+        rss_sms = rss_kib()
+        if args.calls:
+            await load_calls(args, sims, rooms, events)
+        rss_calls = rss_kib()
+
+        print('RSS: %d KiB at start, %+d KiB with %d modems, %+d KiB after SMS, '
+              '%+d KiB after calls, peak %d KiB' % (
+                  rss_start, rss_ready - rss_start, len(sims), rss_sms - rss_ready,
+                  rss_calls - rss_sms, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+              ))
+        if server.media:
+            durations = []
+            for _, data in server.media.values():
+                with av.open(io.BytesIO(data)) as container:
+                    durations.append(container.duration / av.time_base)
+            print('Voicemail: %d recordings, %.1f s and %d bytes on average' % (
+                len(durations), sum(durations) / len(durations),
+                sum(len(data) for _, data in server.media.values()) / len(durations)
+            ))
+        print('Homeserver requests: %s' % (
+            ', '.join('%s=%d' % item for item in sorted(server.requests.items())),
+        ))
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for sim in sims:
+            sim.close()
+    await server.stop()
+
+
+if __name__ == '__main__':
+    args = parse_cmdline()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        stream=sys.stderr)
+    asyncio.set_event_loop_policy(port_binding_loop_policy(args.uvloop))
+    asyncio.run(main(args))
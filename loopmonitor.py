@@ -0,0 +1,96 @@
+'''
+Watches the event loop for stalls. The loop runs a heartbeat callback, and a thread
+notices when it stops beating, and captures what the loop is running at that moment.
+'''
+import os
+import sys
+import time
+import asyncio
+import logging
+import functools
+import threading
+import traceback
+
+import metrics
+
+
+LOOP_HEARTBEAT_INTERVAL = 0.05
+LOOP_STALL_THRESHOLD = 0.1
+STALL_STACK_LIMIT = 30
+
+logger = logging.getLogger('LoopMonitor')
+
+
+def _stack_location(stack):
+    '''
+    The innermost frame of the stack, as file:function
+    '''
+    if not stack:
+        return 'unknown'
+    frame = stack[-1]
+    return '%s:%s' % (os.path.basename(frame.filename), frame.name)
+
+
+class LoopLagMonitor:
+    '''
+    Exports the lag of every heartbeat, and logs the stack of the loop thread (and the
+    task it is running) when a stall goes over the threshold
+    '''
+    def __init__(self, threshold=LOOP_STALL_THRESHOLD, interval=LOOP_HEARTBEAT_INTERVAL):
+        self._threshold = threshold
+        self._interval = interval
+        self._loop = None
+        self._loop_thread_id = None
+        self._handle = None
+        self._thread = None
+        self._stopped = threading.Event()
+        # Written by the loop, read by the watchdog thread
+        self._last_beat = None
+        self._reported_beat = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._handle = self._loop.call_later(self._interval, self._beat)
+        self._thread = threading.Thread(target=self._watch, name='LoopLagMonitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._handle:
+            self._handle.cancel()
+
+    def _beat(self):
+        now = time.monotonic()
+        lag = max(0.0, now - self._last_beat - self._interval)
+        metrics.LOOP_LAG_SECONDS.observe(lag)
+        if self._reported_beat == self._last_beat:
+            logger.warning('Event loop stall ended after %.0f ms' % (lag * 1000,))
+        self._last_beat = now
+        self._handle = self._loop.call_later(self._interval, self._beat)
+
+    def _watch(self):
+        while not self._stopped.wait(self._threshold / 2):
+            last_beat = self._last_beat
+            stalled = time.monotonic() - last_beat - self._interval
+            if stalled < self._threshold or last_beat == self._reported_beat:
+                continue
+            self._reported_beat = last_beat
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = traceback.extract_stack(frame, limit=STALL_STACK_LIMIT) if frame else []
+            task = asyncio.current_task(self._loop)
+            # Metrics are only touched on the loop (which scrapes them), so the count goes
+            # up when the stall ends
+            try:
+                self._loop.call_soon_threadsafe(functools.partial(
+                    metrics.LOOP_STALLS.inc, location=_stack_location(stack)
+                ))
+            except RuntimeError:
+                # The loop is closed
+                return
+            logger.warning('Event loop stalled for over %.0f ms, running %s:\n%s' % (
+                stalled * 1000, task.get_name() if task else 'a callback',
+                ''.join(traceback.format_list(stack)).rstrip()
+            ))
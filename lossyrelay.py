@@ -0,0 +1,192 @@
+'''
+A UDP relay that behaves like a bad network: random and bursty loss, delay, jitter and a
+bandwidth limit with a drop-tail queue. Used to try the call media (and its rate control)
+on poor uplinks without one.
+'''
+import time
+import random
+import asyncio
+import logging
+import argparse
+
+
+# Drop-tail queue of the bandwidth limit, as the time to send what's in it
+QUEUE_SECONDS = 0.2
+
+logger = logging.getLogger('LossyRelay')
+
+
+def parse_address(spec):
+    host, _, port = spec.rpartition(':')
+    return host.strip('[]') or '0.0.0.0', int(port)
+
+
+class _Direction:
+    '''
+    The impairments of one direction, and the state of its loss model and queue
+    '''
+    def __init__(self):
+        self.bad = False
+        self.link_free = 0.0
+        self.last_delivery = 0.0
+        self.sent = 0
+        self.lost = 0
+        self.dropped = 0
+
+
+class _End(asyncio.DatagramProtocol):
+    def __init__(self, relay, peer=None):
+        self._relay = relay
+        self.transport = None
+        # The fixed address packets leaving this end go to, or the last one heard from
+        self.peer = peer
+        self._learn = peer is None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self._learn:
+            self.peer = addr
+        self._relay._received(self, data)
+
+    def send(self, data):
+        if not self.transport.is_closing():
+            self.transport.sendto(data, self.peer)
+
+    @property
+    def address(self):
+        return self.transport.get_extra_info('sockname')[:2]
+
+
+class LossyRelay:
+    '''
+    Relays datagrams between two sockets (ends): what arrives at one end is sent from the
+    other, to the address the other end last heard from (or a fixed one). So two peers
+    that are each given the address of the end facing the other talk through the relay.
+
+    loss is the fraction of packets lost, in bursts of burst packets on average
+    (Gilbert-Elliott). Packets are delayed by delay plus up to jitter seconds, in order.
+    bandwidth (bit/s, None for unlimited) paces packets, and drops them when more than
+    queue_seconds are waiting. The same impairments apply both ways, and can be changed
+    at any time.
+    '''
+    def __init__(self, loss=0.0, burst=1.0, delay=0.0, jitter=0.0, bandwidth=None,
+                 queue_seconds=QUEUE_SECONDS, seed=None):
+        self.loss = loss
+        self.burst = burst
+        self.delay = delay
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.queue_seconds = queue_seconds
+        self._random = random.Random(seed)
+        self._ends = []
+        self._directions = {}
+
+    async def start(self, left=('127.0.0.1', 0), right=('127.0.0.1', 0), left_peer=None,
+                    right_peer=None):
+        '''
+        Binds both ends. left_peer and right_peer fix where packets leaving that end go
+        '''
+        loop = asyncio.get_running_loop()
+        for address, peer in ((left, left_peer), (right, right_peer)):
+            _, end = await loop.create_datagram_endpoint(lambda: _End(self, peer),
+                                                         local_addr=address)
+            self._ends.append(end)
+            self._directions[end] = _Direction()
+
+    @property
+    def left(self):
+        return self._ends[0].address
+
+    @property
+    def right(self):
+        return self._ends[1].address
+
+    def stats(self):
+        '''
+        Packets sent, lost (randomly) and dropped (by the queue), both ways together
+        '''
+        directions = self._directions.values()
+        return (sum(direction.sent for direction in directions),
+                sum(direction.lost for direction in directions),
+                sum(direction.dropped for direction in directions))
+
+    def _lose(self, direction):
+        if self.loss <= 0:
+            direction.bad = False
+            return False
+        # Two states: every packet in the bad one is lost. Leaving it after burst packets
+        # on average, and entering it as often as it takes to lose loss of them overall
+        if direction.bad:
+            direction.bad = self._random.random() >= 1 / max(self.burst, 1)
+        else:
+            direction.bad = self._random.random() < min(
+                1.0, self.loss / (max(self.burst, 1) * (1 - min(self.loss, 0.99)))
+            )
+        return direction.bad
+
+    def _received(self, end, data):
+        out = self._ends[1] if end is self._ends[0] else self._ends[0]
+        direction = self._directions[out]
+        if out.peer is None:
+            return
+        if self._lose(direction):
+            direction.lost += 1
+            return
+
+        now = time.monotonic()
+        departure = now
+        if self.bandwidth:
+            departure = max(now, direction.link_free) + len(data) * 8 / self.bandwidth
+            if departure - now > self.queue_seconds:
+                direction.dropped += 1
+                return
+            direction.link_free = departure
+        delivery = max(departure + self.delay + self._random.uniform(0, self.jitter),
+                       direction.last_delivery)
+        direction.last_delivery = delivery
+        direction.sent += 1
+        asyncio.get_running_loop().call_later(delivery - now, out.send, data)
+
+    def close(self):
+        for end in self._ends:
+            end.transport.close()
+
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description='UDP relay simulating a bad network')
+    parser.add_argument('--listen', help='Address clients send to (host:port)', required=True)
+    parser.add_argument('--forward', help='Address to relay to (host:port)', required=True)
+    parser.add_argument('--loss', help='Fraction of packets lost', type=float, default=0.0)
+    parser.add_argument('--burst', help='Average number of packets lost in a row', type=float,
+                        default=1.0)
+    parser.add_argument('--delay_ms', help='One way delay', type=float, default=0)
+    parser.add_argument('--jitter_ms', help='Random extra delay, up to this', type=float,
+                        default=0)
+    parser.add_argument('--bandwidth', help='Bandwidth limit each way (bit/s)', type=int,
+                        default=None)
+    parser.add_argument('--queue_ms', help='Queue of the bandwidth limit', type=float,
+                        default=QUEUE_SECONDS * 1000)
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_cmdline()
+    relay = LossyRelay(args.loss, args.burst, args.delay_ms / 1000, args.jitter_ms / 1000,
+                       args.bandwidth, args.queue_ms / 1000)
+    forward = parse_address(args.forward)
+    await relay.start(left=parse_address(args.listen), right=('0.0.0.0', 0),
+                      right_peer=forward)
+    logger.info('Relaying %s:%d to %s:%d' % (relay.left + forward))
+    while True:
+        await asyncio.sleep(10)
+        logger.info('Sent %d, lost %d, dropped %d' % relay.stats())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
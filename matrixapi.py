@@ -1,25 +1,45 @@
 import os
-import re
 import json
+import time
 import random
-import aiohttp
 import asyncio
 import logging
+import functools
+import contextlib
+import collections
 
 from nio import (
     AsyncClient, AsyncClientConfig, LoginResponse, RoomMessageText, BadEvent, Event,
-    CallEvent, CallInviteEvent, CallHangupEvent, CallCandidatesEvent, CallAnswerEvent
+    SyncResponse, UploadFilterResponse, RoomSendResponse, RoomPutStateResponse, UploadResponse,
+    CallEvent, CallHangupEvent, CallCandidatesEvent, CallAnswerEvent
 )
-from aiortc import (
-    RTCIceCandidate, RTCConfiguration, RTCPeerConnection, RTCSessionDescription
-)
-from aiortc.contrib.media import MediaPlayer, MediaRecorder
+from aiortc import RTCSessionDescription
+from aiortc.sdp import candidate_from_sdp
+from aiortc.stats import RTCInboundRtpStreamStats, RTCRemoteInboundRtpStreamStats
+
+import metrics
+from callfactory import advertise_address, negotiated_codec
+from ratecontrol import encoding_with
+from smsqueue import parse_outbound_sms
+from voicemail import VOICEMAIL_MIMETYPE
 
 
-EXTERNAL_IP_GETTER_URL = 'http://checkip.amazonaws.com'
 STORE_DIR = './store'
 CREDS_FILE = os.path.join(STORE_DIR, 'creds.json')
-ALSA_DEVICE = 'GsmModemCard'
+OUTBOX_FILE = os.path.join(STORE_DIR, 'outbox.db')
+SYNC_STATS_LOG_INTERVAL = 10 * 60
+# Events per room to catch up on after a restart
+CATCHUP_TIMELINE_LIMIT = 50
+RTP_STATS_INTERVAL = 5
+# Call events for call IDs nobody is waiting for (yet) are kept this long, and at most
+# this many of them
+EARLY_CALL_EVENT_TTL = 60
+EARLY_CALL_EVENTS_MAX = 100
+# How the caller ID is shown: a notice next to the invite, the bot's display name in the
+# call's room only, or the bot's global display name (a member event in every room)
+CALLERID_MODES = ('notice', 'member', 'global')
+# Invites carry the caller ID in this (non-standard) field
+CALLERID_FIELD = 'gsm.callerid'
 
 logger = logging.getLogger('MatrixApi')
 
@@ -28,7 +48,20 @@ class MatrixLoginError(Exception):
     pass
 
 
+def _load_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _save_json(path, value):
+    with open(path, 'w') as f:
+        json.dump(value, f)
+
+
 async def do_matrix_login(homeserver, user, password):
+    # The modems start in parallel with the login, so its file I/O (and loading the E2EE
+    # store) runs in a thread, to keep the event loop free
+    loop = asyncio.get_running_loop()
     if not os.path.exists(STORE_DIR):
         os.makedirs(STORE_DIR)
         logger.info('Created store dir')
@@ -52,24 +85,23 @@ async def do_matrix_login(homeserver, user, password):
             logger.error('Login fail.')
             raise MatrixLoginError(res)
 
-        with open(CREDS_FILE, "w") as creds:
-            json.dump({
-                'device_id': res.device_id,
-                'user_id': res.user_id,
-                'access_token': res.access_token,
-            }, creds)
+        await loop.run_in_executor(None, _save_json, CREDS_FILE, {
+            'device_id': res.device_id,
+            'user_id': res.user_id,
+            'access_token': res.access_token,
+        })
         logger.info('Login success. Saved creds to %s' % (CREDS_FILE,))
         await client.close()
 
     logger.info('Using saved creds from %s' % (CREDS_FILE,))
-    with open(CREDS_FILE, "r") as creds:
-        creds = json.load(creds)
-        client = AsyncClient(homeserver=homeserver, user=creds['user_id'],
-                             store_path=STORE_DIR, config=client_config,
-                             device_id=creds['device_id'])
-        client.restore_login(user_id=creds['user_id'],
-                             device_id=creds['device_id'],
-                             access_token=creds['access_token'])
+    creds = await loop.run_in_executor(None, _load_json, CREDS_FILE)
+    client = AsyncClient(homeserver=homeserver, user=creds['user_id'],
+                         store_path=STORE_DIR, config=client_config,
+                         device_id=creds['device_id'])
+    await loop.run_in_executor(None, functools.partial(
+        client.restore_login, user_id=creds['user_id'], device_id=creds['device_id'],
+        access_token=creds['access_token']
+    ))
 
     if client.should_upload_keys:
         await client.keys_upload()
@@ -78,23 +110,148 @@ async def do_matrix_login(homeserver, user, password):
     return client
 
 
+def _is_sms_request(body):
+    try:
+        return parse_outbound_sms(body) is not None
+    except ValueError:
+        return True
+
+
+class SyncStats:
+    '''
+    Measures the size and duration of each sync response, and logs a periodic summary
+    '''
+    def __init__(self, log_interval=SYNC_STATS_LOG_INTERVAL):
+        self.syncs = 0
+        self.total_bytes = 0
+        self.total_seconds = 0.0
+        self._log_interval = log_interval
+        self._window = [0, 0, 0.0]
+        self._window_start = time.monotonic()
+
+    def attach(self, client):
+        client.add_response_callback(self.record, SyncResponse)
+
+    async def record(self, response):
+        size = 0
+        if response.transport_response is not None:
+            size = len(await response.transport_response.read())
+        self.syncs += 1
+        self.total_bytes += size
+        self.total_seconds += response.elapsed
+        metrics.SYNCS.inc()
+        metrics.SYNC_BYTES.inc(size)
+        metrics.SYNC_SECONDS.observe(response.elapsed)
+        self._window = [self._window[0] + 1, self._window[1] + size,
+                        self._window[2] + response.elapsed]
+        logger.debug('Sync: %d bytes in %.0f ms' % (size, response.elapsed * 1000))
+
+        now = time.monotonic()
+        if now - self._window_start >= self._log_interval:
+            syncs, size, elapsed = self._window
+            logger.info('Sync stats: %d syncs, %.1f KiB (%.0f bytes/sync), %.1f s in requests' % (
+                syncs, size / 1024, size / syncs, elapsed
+            ))
+            self._window = [0, 0, 0.0]
+            self._window_start = now
+
+
 class MatrixEventHandler:
     _call_event_types = ('m.call.invite', 'm.call.answer',
                          'm.call.candidates', 'm.call.hangup')
-    _call_event_classes = (CallInviteEvent, CallAnswerEvent,
-                           CallCandidatesEvent, CallHangupEvent)
+
+    @classmethod
+    def sync_filter(cls, rooms=None, timeline_limit=None):
+        '''
+        A sync filter for just the events the gateway handles: calls and messages in the
+        bridged rooms. Member events are kept so that E2EE sessions follow membership.
+        '''
+        room_filter = {
+            'timeline': {
+                'types': list(cls._call_event_types) + [
+                    'm.room.message', 'm.room.encrypted', 'm.room.member'
+                ],
+                'lazy_load_members': True,
+            },
+            'state': {'lazy_load_members': True},
+            'ephemeral': {'not_types': ['*']},
+            'account_data': {'not_types': ['*']},
+        }
+        if rooms is not None:
+            room_filter['rooms'] = list(rooms)
+        if timeline_limit is not None:
+            room_filter['timeline']['limit'] = timeline_limit
+        return {
+            'presence': {'not_types': ['*']},
+            'account_data': {'not_types': ['*']},
+            'room': room_filter,
+        }
+
+    @classmethod
+    async def upload_sync_filter(cls, client, rooms=None, timeline_limit=None):
+        '''
+        Returns the ID of the uploaded filter, or the filter itself if uploading failed
+        '''
+        sync_filter = cls.sync_filter(rooms, timeline_limit)
+        res = await client.upload_filter(**sync_filter)
+        if isinstance(res, UploadFilterResponse):
+            return res.filter_id
+        logger.warning('Uploading sync filter failed, sending it inline: %r' % (res,))
+        return sync_filter
 
     def __init__(self, client):
         self._client = client
-        self._call_events = {x: {} for x in self._call_event_classes}
+        # The event streams of the ongoing calls, by call ID
+        self._calls = {}
+        # (expiry time, event) of call events that arrived before their call was routed
+        self._early_call_events = collections.deque()
+        # Counts of events missed while offline, by type, during the catch-up sync
+        self._catchup = None
+        # The outbound SMS queue of each room's modem
+        self._sms_queues = {}
+        # IDs of the SMS requests missed while offline, by room, until the room is routed
+        self._missed_sms = collections.defaultdict(list)
         self._client.add_event_callback(self._text_msg_cb, RoomMessageText)
         self._client.add_event_callback(self._call_event_cb, CallEvent)
         self._client.add_event_callback(self._bad_event_cb, BadEvent)
 
+    def start_catchup(self):
+        self._catchup = collections.Counter()
+
+    def end_catchup(self):
+        counts, self._catchup = self._catchup, None
+        if counts:
+            logger.info('Caught up on events missed while offline: %s' % (
+                ', '.join('%d %s' % (count, type) for type, count in counts.most_common()),
+            ))
+
     async def _text_msg_cb(self, room, event):
+        if self._catchup is not None:
+            self._catchup[event.source['type']] += 1
+            logger.info('Missed while offline: [%s]:(%s) %s' % (
+                room.display_name, room.user_name(event.sender), event.body
+            ))
+            # They may be hours old, and may already have been queued before a crash, so
+            # they aren't sent. Their senders are told once the room's modem is up
+            if event.sender != self._client.user_id and _is_sms_request(event.body):
+                self._missed_sms[room.room_id].append(event.event_id)
+            return
+
         logger.debug('>>> Text: [%s]:(%s) %s' % (
             room.display_name, room.user_name(event.sender), event.body
         ))
+        sms_queue = self._sms_queues.get(room.room_id)
+        if sms_queue is None or event.sender == self._client.user_id:
+            return
+        try:
+            outbound = parse_outbound_sms(event.body)
+        except ValueError as e:
+            sms_queue.notify(room.room_id, event.event_id, 'Not sending: %s' % (e,))
+            return
+        if outbound is not None:
+            recipients, text = outbound
+            logger.info('Queueing SMS from %s to %s' % (event.sender, ', '.join(recipients)))
+            sms_queue.send(room.room_id, event.event_id, recipients, text)
 
     async def _bad_event_cb(self, room, event):
         # BUG: some remote clients send version field as string, against the schema
@@ -108,203 +265,482 @@ class MatrixEventHandler:
         logger.warning('!!! Received bad event: %r' % (event,))
 
     async def _call_event_cb(self, room, event):
-        event_type = type(event)
-        if event.call_id not in self._call_events[event_type]:
-            logger.warning('_call_event_cb called with unknown call_id, type: %s' % (
-                event_type,
-            ))
+        if self._catchup is not None:
+            # Calls don't survive a restart, so these are all stale
+            self._catchup[event.source['type']] += 1
+            return
+        if event.sender == self._client.user_id:
+            # Our own invites and hangups, echoed back by the sync
             return
-        await self._call_events[event_type][event.call_id].put(event)
 
-    def prepare_for_call_id(self, call_id):
-        for event_dict in self._call_events.values():
-            event_dict[call_id] = asyncio.Queue()
+        if event.call_id in self._calls:
+            self._calls[event.call_id].put(event)
+            return
 
-    def discard_for_call_id(self, call_id):
-        for event_dict in self._call_events.values():
-            if call_id in event_dict:
-                del event_dict[call_id]
+        self._evict_early_call_events()
+        if len(self._early_call_events) >= EARLY_CALL_EVENTS_MAX:
+            _, dropped = self._early_call_events.popleft()
+            logger.warning('Too many call events for unknown calls, dropped %s of call %s' % (
+                dropped.source['type'], dropped.call_id
+            ))
+        logger.info('Holding %s of unknown call %s' % (event.source['type'], event.call_id))
+        self._early_call_events.append((time.monotonic() + EARLY_CALL_EVENT_TTL, event))
+
+    def _evict_early_call_events(self):
+        now = time.monotonic()
+        while self._early_call_events and self._early_call_events[0][0] <= now:
+            _, event = self._early_call_events.popleft()
+            logger.info('Dropped unclaimed %s of call %s' % (
+                event.source['type'], event.call_id
+            ))
 
-    async def get_call_event(self, type, call_id):
-        return (await self._call_events[type][call_id].get())
+    def route_sms(self, room_id, sms_queue):
+        '''
+        Sends messages like "!sms +15555550100: text" in the room as SMS through sms_queue
+        '''
+        self._sms_queues[room_id] = sms_queue
+        for event_id in self._missed_sms.pop(room_id, ()):
+            sms_queue.notify(room_id, event_id, 'Not sent: the gateway was offline when this '
+                             'was written. Send it again to send it now.')
+
+    @contextlib.contextmanager
+    def route_call(self, call_id):
+        '''
+        Routes the events of a call to a CallEvents stream (starting with the ones that
+        arrived early), until the context exits
+        '''
+        self._evict_early_call_events()
+        early = [event for _, event in self._early_call_events if event.call_id == call_id]
+        self._early_call_events = collections.deque(
+            entry for entry in self._early_call_events if entry[1].call_id != call_id
+        )
+        self._calls[call_id] = call_events = CallEvents(call_id, early)
+        try:
+            yield call_events
+        finally:
+            del self._calls[call_id]
+
+
+class CallEvents:
+    '''
+    The Matrix events of one call, of all types, in the order they arrived
+    '''
+    def __init__(self, call_id, events=()):
+        self.call_id = call_id
+        self._queue = asyncio.Queue()
+        for event in events:
+            self.put(event)
+
+    def put(self, event):
+        self._queue.put_nowait(event)
+
+    async def get(self):
+        return await self._queue.get()
 
 
 class MatrixCallForwarder:
+    # The caller IDs shown as the bot's display name, by (user, room) in the member mode
+    # and by (user,) in the global one: [the name to restore, [(call, caller ID)]]. Calls
+    # can overlap (call waiting): the latest one's caller is shown until it ends, and the
+    # name is restored after the last one
+    _shown_callerids = {}
+    _displayname_locks = {}
+
     def __init__(self, matrix_client, matrix_handler, room, default_displayname,
-                 udp_port, callerid, connected_cb=None, ended_cb=None, call_timeout=90):
+                 address_resolver, call_factory, callerid, connected_cb=None,
+                 ended_cb=None, call_timeout=90, ring_time=None, callerid_mode='notice',
+                 voicemail=None, rate_control=None):
         self._matrix_client = matrix_client
         self._matrix_handler = matrix_handler
         self._room = room
         self._default_displayname = default_displayname
-        self._udp_port = udp_port
+        self._address_resolver = address_resolver
+        self._call_factory = call_factory
         self._call_timeout = call_timeout
         self._callerid = callerid
+        self._callerid_mode = callerid_mode
         self._connected_cb = connected_cb
         self._ended_cb = ended_cb
-        self._external_ip = asyncio.Future()
+        self._ring_time = ring_time or time.monotonic()
+        self._prepared = None
+        # Takes a message when the call isn't answered on the Matrix side (voicemail.Voicemail)
+        self._voicemail = voicemail
+        self._voicemail_upload = None
+        # Adapts the Opus sent to the network (ratecontrol.OpusRateControl)
+        self._rate_control = rate_control
 
     def run(self):
-        asyncio.create_task(self._get_external_ip())
-        return asyncio.create_task(self._call_with_displayname())
+        return asyncio.create_task(self._call_with_callerid())
 
-    async def _get_external_ip(self):
-        try:
-            async with aiohttp.request('GET', EXTERNAL_IP_GETTER_URL) as req:
-                ip = (await req.text()).strip()
-                self._external_ip.set_result(ip)
-                logger.info('Got external IP: %s' % (ip,))
-        except Exception as e:
-            self._external_ip.set_exception(e)
-            raise
-
-    async def _call_with_displayname(self):
+    async def _call_with_callerid(self):
+        callerid_task = asyncio.ensure_future(self._show_callerid())
         try:
-            await self._matrix_client.set_displayname(self._callerid)
-            await self._call()
+            await self._call(callerid_task)
         finally:
+            callerid_task.cancel()
             if self._ended_cb:
                 await self._ended_cb()
-            await self._matrix_client.set_displayname(self._default_displayname)
+            if self._voicemail_upload:
+                await self._voicemail_upload
+            if self._callerid_mode in ('global', 'member'):
+                await self._display_callerid(False)
+
+    async def _show_callerid(self):
+        start = time.monotonic()
+        if self._callerid_mode in ('global', 'member'):
+            await self._display_callerid(True)
+        else:
+            await self._room_send('m.room.message', {
+                'msgtype': 'm.notice',
+                'body': 'Incoming call from %s' % (self._callerid,),
+            })
+        metrics.CALL_SETUP_SECONDS.observe(time.monotonic() - start, phase='callerid')
+        logger.info('Call timing: caller ID (%s) %.0f ms' % (
+            self._callerid_mode, (time.monotonic() - start) * 1000,
+        ))
 
-    def _patch_sdp(self, sdp, external_ip, udp_port):
-        new_sdp = sdp.encode()
-        match = re.search(
-            rb'^a=candidate:[^ ]+ [0-9]+ [^ ]+ ([0-9]+) [^ ]+ [0-9]+ typ host\s?$',
-            new_sdp, flags=re.MULTILINE
+    def _room_member(self):
+        room = self._matrix_client.rooms.get(self._room)
+        return room.users.get(self._matrix_client.user_id) if room else None
+
+    async def _display_callerid(self, show):
+        '''
+        Starts (or stops) showing this call's caller ID as the bot's display name
+        '''
+        key = (self._matrix_client.user_id,)
+        if self._callerid_mode == 'member':
+            key += (self._room,)
+        lock = self._displayname_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            shown = self._shown_callerids.get(key)
+            if show:
+                if shown is None:
+                    member = self._room_member() if self._callerid_mode == 'member' else None
+                    original = (member.display_name if member and member.display_name
+                                else self._default_displayname)
+                    shown = self._shown_callerids[key] = [original, []]
+                before = shown[1][-1][1] if shown[1] else None
+                shown[1].append((self, self._callerid))
+            else:
+                if shown is None or all(call is not self for call, _ in shown[1]):
+                    return
+                before = shown[1][-1][1]
+                shown[1] = [entry for entry in shown[1] if entry[0] is not self]
+                if not shown[1]:
+                    del self._shown_callerids[key]
+            displayname = shown[1][-1][1] if shown[1] else shown[0]
+            if displayname == before:
+                return
+            if self._callerid_mode == 'global':
+                await self._matrix_client.set_displayname(displayname)
+            else:
+                await self._set_member_displayname(displayname)
+
+    async def _set_member_displayname(self, displayname):
+        '''
+        Sets the bot's display name in the call's room only
+        '''
+        user_id = self._matrix_client.user_id
+        member = self._room_member()
+        content = {'membership': 'join', 'displayname': displayname}
+        if member and member.avatar_url:
+            content['avatar_url'] = member.avatar_url
+        res = await self._matrix_client.room_put_state(self._room, 'm.room.member', content,
+                                                        state_key=user_id)
+        if not isinstance(res, RoomPutStateResponse):
+            logger.warning('Setting the display name in %s failed: %r' % (self._room, res))
+
+    async def _room_send(self, message_type, content):
+        start = time.monotonic()
+        res = await self._matrix_client.room_send(self._room, message_type, content,
+                                                  ignore_unverified_devices=True)
+        metrics.ROOM_SEND_SECONDS.observe(
+            time.monotonic() - start, type=message_type,
+            result='ok' if isinstance(res, RoomSendResponse) else 'error'
         )
-        if not match:
-            return sdp
-        magic, = match.groups()
+        return res
 
-        # Remove all existing candidates
-        new_sdp = bytearray(
-            re.sub(rb'a=candidate:.* typ host', b'', new_sdp, flags=re.DOTALL)
+    async def _send_hangup(self, call_id):
+        await self._room_send(
+            'm.call.hangup', {
+                'call_id': call_id,
+                'version': 0,
+            }
         )
 
-        # Add only external IP and forwarded udp_port
-        new_sdp[match.start(): match.start()] = (
-            'a=candidate:%s 1 udp %s %s %d typ host' % (
-                os.urandom(16).hex(), magic.decode(), external_ip, udp_port
+    async def _take_voicemail(self):
+        '''
+        Answers the GSM call and records a message, until the caller hangs up (and this is
+        cancelled). The recording is uploaded right away, in the background.
+        '''
+        logger.info('Taking a voicemail from %s' % (self._callerid,))
+        recorder = self._voicemail.recorder()
+        try:
+            if self._connected_cb:
+                await self._connected_cb()
+            await self._voicemail.take(self._prepared.audio, recorder)
+        finally:
+            recorder.close()
+            self._voicemail_upload = asyncio.ensure_future(self._send_voicemail(recorder))
+
+    async def _send_voicemail(self, recorder):
+        '''
+        Uploads a recording (encrypted if the room is), and posts it as m.audio
+        '''
+        start = time.monotonic()
+        try:
+            if not recorder.samples:
+                logger.info('Empty voicemail from %s' % (self._callerid,))
+                return
+            size = os.path.getsize(recorder.path)
+            room = self._matrix_client.rooms.get(self._room)
+            encrypted = bool(room and room.encrypted)
+            res, keys = await self._matrix_client.upload(
+                lambda got_429, got_timeouts: recorder.path, content_type=VOICEMAIL_MIMETYPE,
+                filename='voicemail.ogg', encrypt=encrypted, filesize=size
             )
-        ).encode()
+            if not isinstance(res, UploadResponse):
+                logger.warning('Uploading voicemail failed: %r' % (res,))
+                await self._room_send('m.room.message', {
+                    'msgtype': 'm.notice',
+                    'body': 'Voicemail from %s could not be uploaded' % (self._callerid,),
+                })
+                return
 
-        logger.info('Patched SDP, added ICE candidate')
-        return new_sdp.decode()
+            duration_ms = int(recorder.duration * 1000)
+            content = {
+                'msgtype': 'm.audio',
+                'body': 'Voicemail from %s (%d s)' % (self._callerid, round(recorder.duration)),
+                'info': {'mimetype': VOICEMAIL_MIMETYPE, 'size': size, 'duration': duration_ms},
+                # Shown as a voice message by clients that support it (MSC3245)
+                'org.matrix.msc1767.audio': {'duration': duration_ms},
+                'org.matrix.msc3245.voice': {},
+            }
+            if encrypted:
+                content['file'] = dict(keys, url=res.content_uri, mimetype=VOICEMAIL_MIMETYPE)
+            else:
+                content['url'] = res.content_uri
+            await self._room_send('m.room.message', content)
+            metrics.VOICEMAIL_UPLOAD_SECONDS.observe(time.monotonic() - start)
+            logger.info('Call timing: hangup-to-voicemail %.0f ms (%.1f s, %d bytes)' % (
+                (time.monotonic() - start) * 1000, recorder.duration, size
+            ))
+        finally:
+            os.unlink(recorder.path)
 
-    async def _call(self):
-        logger.info('Starting RTC call')
-        # Do not use any STUN/TURN servers (we use manual port forwarding)
-        pc = RTCPeerConnection(RTCConfiguration(iceServers=[]))
-        player = MediaPlayer(ALSA_DEVICE, format='alsa')
-        recorder = MediaRecorder(ALSA_DEVICE, format='alsa')
+    async def _export_rtp_stats(self, pc, call_id):
+        '''
+        Exports the RTP stats of the call periodically, until cancelled
+        '''
+        exported = set()
+        try:
+            while True:
+                await asyncio.sleep(RTP_STATS_INTERVAL)
+                for stats in (await pc.getStats()).values():
+                    if isinstance(stats, RTCInboundRtpStreamStats):
+                        values = {'packets_lost': stats.packetsLost, 'jitter': stats.jitter,
+                                  'packets': stats.packetsReceived}
+                        direction = 'inbound'
+                    elif isinstance(stats, RTCRemoteInboundRtpStreamStats):
+                        values = {'packets_lost': stats.packetsLost, 'jitter': stats.jitter,
+                                  'fraction_lost': stats.fractionLost,
+                                  'round_trip_time': stats.roundTripTime}
+                        direction = 'outbound'
+                    else:
+                        continue
+                    for stat, value in values.items():
+                        metrics.CALL_RTP.set(value, room=self._room, call_id=call_id,
+                                             direction=direction, stat=stat)
+                        exported.add((direction, stat))
+        finally:
+            for direction, stat in exported:
+                metrics.CALL_RTP.remove(room=self._room, call_id=call_id,
+                                        direction=direction, stat=stat)
 
-        @pc.on("track")
-        def on_track(track):
-            logger.info("Receiving track %s" % (track.kind,))
-            recorder.addTrack(track)
+    async def _answer(self, pc, answer):
+        await pc.setRemoteDescription(RTCSessionDescription(
+            sdp=answer.answer['sdp'], type=answer.answer['type']
+        ))
+        codec = negotiated_codec(answer.answer['sdp'])
+        metrics.CALL_CODECS.inc(codec=codec)
+        logger.info('Negotiated audio codec: %s' % (codec,))
+        # Playback only covers the tracks that were added (by setRemoteDescription)
+        # before it starts
+        await self._prepared.audio.start()
+
+    async def _add_candidates(self, pc, candidates):
+        for candidate in candidates:
+            line = candidate.get('candidate')
+            if not line:
+                # End of candidates
+                continue
+            try:
+                ice_candidate = candidate_from_sdp(line.split(':', 1)[1])
+            except (IndexError, ValueError) as e:
+                logger.warning('Ignoring bad ICE candidate %r: %r' % (line, e))
+                continue
+            ice_candidate.sdpMid = candidate.get('sdpMid')
+            ice_candidate.sdpMLineIndex = candidate.get('sdpMLineIndex')
+            await pc.addIceCandidate(ice_candidate)
+
+    async def _next_call_event(self, call_events, pc, held_candidates):
+        '''
+        Returns the next answer or hangup of the call. Trickled candidates are added to the
+        peer connection, or held until the answer is in.
+        '''
+        while True:
+            event = await call_events.get()
+            if isinstance(event, (CallAnswerEvent, CallHangupEvent)):
+                return event
+            if isinstance(event, CallCandidatesEvent):
+                if pc.remoteDescription:
+                    await self._add_candidates(pc, event.candidates)
+                else:
+                    held_candidates.extend(event.candidates)
+            else:
+                logger.info('Ignoring %s of the ongoing call' % (event.source['type'],))
+
+    async def _call(self, callerid_task):
+        logger.info('Starting RTC call')
+        self._prepared = await self._call_factory.take()
+        pc = self._prepared.pc
+        media_connected = asyncio.get_running_loop().create_future()
 
-        pc.addTrack(player.audio)
-        offer = await pc.createOffer()
-        await pc.setLocalDescription(offer)
-        logger.info('Created offer')
+        @pc.on("connectionstatechange")
+        def on_connectionstatechange():
+            if pc.connectionState == 'connected' and not media_connected.done():
+                media_connected.set_result(time.monotonic())
 
         hangup = False
+        outcome = 'failed'
+        rtp_stats_task = None
+        rate_control_task = None
+        rate_controller = None
         call_id = str(random.randint(0, 2**31))
-        self._matrix_handler.prepare_for_call_id(call_id)
         logger.info('Call id: %s' % (call_id,))
+        if self._rate_control:
+            rate_controller = self._rate_control.controller(self._room, call_id)
+        held_candidates = []
 
-        await self._matrix_client.room_send(
-            self._room,
-            'm.call.invite', {
-                'call_id': call_id,
-                'version': 0,
-                'lifetime': self._call_timeout * 1000,
-                'offer': {
-                    'type': 'offer',
-                    'sdp': self._patch_sdp(
-                         pc.localDescription.sdp,
-                         (await self._external_ip),
-                         self._udp_port
-                     ),
-                },
-            },
-            ignore_unverified_devices=True
-        )
-
-        try:
-            call_waiter = asyncio.as_completed((
-                self._matrix_handler.get_call_event(CallAnswerEvent, call_id),
-                self._matrix_handler.get_call_event(CallHangupEvent, call_id),
-            ))
+        with self._matrix_handler.route_call(call_id) as call_events:
             try:
-                answer = await asyncio.wait_for(
-                    next(call_waiter), timeout=self._call_timeout
-                )
-            except asyncio.exceptions.TimeoutError:
-                logger.info('Call timed out')
-                return
-
-            if not isinstance(answer, CallAnswerEvent):
-                logger.info('Call hung up. %r' % (type(answer),))
-                return
-
-            await pc.setRemoteDescription(RTCSessionDescription(
-                sdp=answer.answer['sdp'], type=answer.answer['type']
-            ))
-            await recorder.start()
-
-            if self._connected_cb:
-                await self._connected_cb()
-            logger.info('Call established. Waiting for hangup...')
-            await next(call_waiter)
-            hangup = True
-
-        finally:
-            if not hangup:
-                await self._matrix_client.room_send(
-                    self._room,
-                    'm.call.hangup', {
+                if self._callerid_mode != 'notice':
+                    # The display name has to be in place when the invite shows up
+                    await callerid_task
+                await self._room_send(
+                    'm.call.invite', {
                         'call_id': call_id,
                         'version': 0,
-                    },
-                    ignore_unverified_devices=True
+                        'lifetime': self._call_timeout * 1000,
+                        CALLERID_FIELD: self._callerid,
+                        'offer': {
+                            'type': 'offer',
+                            'sdp': advertise_address(
+                                self._prepared.sdp,
+                                (await self._address_resolver.get()),
+                                self._prepared.udp_port
+                            ),
+                        },
+                    }
                 )
-            await pc.close()
-            await recorder.stop()
-            # HACK: not sure why there isn't a public stop method
-            player._stop(player.audio)
-            self._matrix_handler.discard_for_call_id(call_id)
-            logger.info('Call finished.')
+                invite_time = time.monotonic()
+                metrics.CALL_SETUP_SECONDS.observe(invite_time - self._ring_time,
+                                                   phase='ring_to_invite')
+                logger.info('Call timing: RING-to-invite %.0f ms' % (
+                    (invite_time - self._ring_time) * 1000,
+                ))
+
+                try:
+                    answer = await asyncio.wait_for(
+                        self._next_call_event(call_events, pc, held_candidates),
+                        timeout=self._call_timeout
+                    )
+                except asyncio.exceptions.TimeoutError:
+                    logger.info('Call timed out')
+                    outcome = 'timed_out'
+                    if self._voicemail:
+                        hangup = True
+                        await self._send_hangup(call_id)
+                        outcome = 'voicemail'
+                        await self._take_voicemail()
+                    return
+
+                if not isinstance(answer, CallAnswerEvent):
+                    logger.info('Call hung up. %r' % (type(answer),))
+                    outcome = 'rejected'
+                    if self._voicemail:
+                        hangup = True
+                        outcome = 'voicemail'
+                        await self._take_voicemail()
+                    return
+
+                answer_time = time.monotonic()
+                outcome = 'answered'
+                metrics.CALL_SETUP_SECONDS.observe(answer_time - invite_time,
+                                                   phase='invite_to_answer')
+                logger.info('Call timing: invite-to-answer %.0f ms' % (
+                    (answer_time - invite_time) * 1000,
+                ))
+                # The audio sender starts as the connection does, in either of these
+                with encoding_with(rate_controller):
+                    if self._connected_cb:
+                        await asyncio.gather(self._answer(pc, answer), self._connected_cb())
+                    else:
+                        await self._answer(pc, answer)
+                    await self._add_candidates(pc, held_candidates)
+                logger.info('Call established. Waiting for hangup...')
+
+                def on_media_connected(fut):
+                    if fut.cancelled():
+                        return
+                    metrics.CALL_SETUP_SECONDS.observe(fut.result() - answer_time,
+                                                       phase='answer_to_audio')
+                    logger.info('Call timing: answer-to-audio %.0f ms' % (
+                        (fut.result() - answer_time) * 1000,
+                    ))
+                media_connected.add_done_callback(on_media_connected)
+                rtp_stats_task = asyncio.create_task(self._export_rtp_stats(pc, call_id))
+                if rate_controller:
+                    rate_control_task = asyncio.create_task(rate_controller.run(pc))
+
+                while not isinstance(
+                    await self._next_call_event(call_events, pc, held_candidates),
+                    CallHangupEvent
+                ):
+                    logger.info('Ignoring another answer to the ongoing call')
+                hangup = True
+
+            finally:
+                metrics.CALLS.inc(outcome=outcome)
+                if rtp_stats_task:
+                    rtp_stats_task.cancel()
+                if rate_control_task:
+                    rate_control_task.cancel()
+                media_connected.cancel()
+                try:
+                    if not hangup:
+                        await self._send_hangup(call_id)
+                finally:
+                    await self._call_factory.release(self._prepared)
+                    logger.info('Call finished.')
 
 
-def udp_random_port_monkeypatch(constant_port):
+class MatrixSmsForwarder:
     '''
-    HACK: Monkeypatch the loop.create_datagram_endpoint method, so that the call in
-    aioice/ice.py:get_component_candidates will use a constant UDP port (for port forwarding)
+    Hands a message to the send queue. Returns as soon as it is journaled, so the modem
+    never waits on the homeserver
     '''
-    old_func = asyncio.get_event_loop().create_datagram_endpoint
-    def wrapper(*args, **kwargs):
-        if 'local_addr' in kwargs and kwargs['local_addr'][1] == 0:
-            logger.info('Monkeypatching random bind port to a constant port')
-            kwargs['local_addr'] = (kwargs['local_addr'][0], constant_port)
-            kwargs['reuse_port'] = True
-        return old_func(*args, **kwargs)
-    asyncio.get_event_loop().create_datagram_endpoint = wrapper
-
-
-class MatrixSmsForwarder:
-    def __init__(self, matrix_client, room, msg):
-        self._matrix_client = matrix_client
+    def __init__(self, send_queue, room, msg):
+        self._send_queue = send_queue
         self._room = room
         self._msg = msg
 
     async def send(self):
-        await self._matrix_client.room_send(
+        self._send_queue.send(
             self._room,
             'm.room.message', {
                 'msgtype': 'm.text',
                 'body': self._msg,
-            },
-            ignore_unverified_devices=True
+            }
         )
 
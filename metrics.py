@@ -0,0 +1,217 @@
+'''
+In-process metrics of the gateway hot paths, served in the Prometheus text format
+'''
+import re
+import time
+import asyncio
+import logging
+import contextlib
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+REQUEST_TIMEOUT = 10
+
+REGISTRY = []
+
+logger = logging.getLogger('Metrics')
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('%s takes labels %r, got %r' % (self.name, self.labels, labels))
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % (','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs),)
+
+    def remove(self, **labels):
+        self._values.pop(self._key(labels), None)
+
+    def samples(self):
+        '''
+        Yields (name suffix, label key, extra labels, value)
+        '''
+        for key, value in self._values.items():
+            yield '', key, (), value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, key, extra, value in list(self.samples()):
+            lines.append('%s%s%s %r' % (self.name, suffix, self._format(key, extra), value))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, func, **labels):
+        '''
+        The value is read from func() when scraped
+        '''
+        self._values[self._key(labels)] = func
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield '', key, (), float(value() if callable(value) else value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        if key not in self._values:
+            self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts, _, _ = entry = self._values[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self):
+        for key, (counts, total, count) in self._values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield '_bucket', key, (('le', repr(float(bound))),), bucket_count
+            yield '_bucket', key, (('le', '+Inf'),), count
+            yield '_sum', key, (), total
+            yield '_count', key, (), count
+
+
+def render():
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+def at_command_name(cmd):
+    '''
+    The command without its arguments, e.g. AT+CMGR for AT+CMGR=3
+    '''
+    m = re.match(r'^(AT[+$#]?[A-Z]*)', cmd.upper())
+    return m.group(1) if m else 'other'
+
+
+# Event loop
+LOOP_LAG_SECONDS = Histogram('gsmgw_loop_lag_seconds', 'Event loop heartbeat lateness',
+                             buckets=(0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1, 5))
+LOOP_STALLS = Counter('gsmgw_loop_stalls_total', 'Event loop stalls over the threshold, by '
+                      'the code that was running', ('location',))
+
+# Modem
+AT_COMMAND_SECONDS = Histogram('gsmgw_at_command_seconds', 'AT command round trip time',
+                               ('modem', 'command', 'result'))
+AT_COMMAND_WAIT_SECONDS = Histogram('gsmgw_at_command_wait_seconds', 'Time AT commands are '
+                                    'queued for the port', ('modem', 'priority'))
+AT_QUEUE_DEPTH = Gauge('gsmgw_at_queue_depth', 'AT commands and URCs waiting to be handled',
+                       ('modem', 'queue'))
+MODEM_RESTARTS = Counter('gsmgw_modem_restarts_total', 'Modem failures the modem was '
+                         're-opened after', ('modem',))
+URCS = Counter('gsmgw_urcs_total', 'Unsolicited result codes received', ('modem', 'type'))
+MODEM_CSQ = Gauge('gsmgw_modem_csq', 'Signal quality reported by AT+CSQ', ('modem',))
+MODEM_SIGNAL_DBM = Gauge('gsmgw_modem_signal_dbm', 'Signal strength reported over QMI',
+                         ('modem', 'measure'))
+MODEM_RAT = Gauge('gsmgw_modem_rat', 'Registered radio access technology (1 for the current)',
+                  ('modem', 'rat'))
+
+# Outbound SMS
+SMS_OUTBOX_PENDING = Gauge('gsmgw_sms_outbox_pending', 'Outbound SMS not sent yet', ('modem',))
+SMS_SENT = Counter('gsmgw_sms_sent_total', 'Outbound SMS send attempts, by result',
+                   ('modem', 'result'))
+SMS_QUEUE_SECONDS = Histogram('gsmgw_sms_queue_seconds', 'Time from queueing an outbound SMS '
+                              'to the network taking it', ('modem',),
+                              buckets=DEFAULT_BUCKETS + (300, 900, 3600))
+SMS_DELIVERY_REPORTS = Counter('gsmgw_sms_delivery_reports_total', 'Delivery reports of '
+                               'outbound SMS, by state', ('modem', 'state'))
+
+# Matrix
+SYNC_SECONDS = Histogram('gsmgw_sync_seconds', 'Sync request time (excluding the long poll)')
+SYNC_BYTES = Counter('gsmgw_sync_bytes_total', 'Sync response body bytes')
+SYNCS = Counter('gsmgw_syncs_total', 'Sync responses')
+ROOM_SEND_SECONDS = Histogram('gsmgw_room_send_seconds', 'room_send latency',
+                              ('type', 'result'))
+SEND_QUEUE_PENDING = Gauge('gsmgw_send_queue_pending', 'Journaled room messages not sent yet')
+
+# Calls
+CALL_SETUP_SECONDS = Histogram('gsmgw_call_setup_seconds', 'Call setup time, by phase',
+                               ('phase',), buckets=DEFAULT_BUCKETS + (90, 120))
+CALLS = Counter('gsmgw_calls_total', 'Forwarded calls, by outcome', ('outcome',))
+CALL_CODECS = Counter('gsmgw_call_codecs_total', 'Answered calls, by negotiated audio codec',
+                      ('codec',))
+VOICEMAIL_UPLOAD_SECONDS = Histogram('gsmgw_voicemail_upload_seconds', 'Time from the end of '
+                                     'a voicemail recording to its m.audio event')
+CALL_RTP = Gauge('gsmgw_call_rtp', 'RTP stats of each ongoing call from getStats() (jitter is '
+                 'in RTP timestamp units, round trip time in seconds)',
+                 ('room', 'call_id', 'direction', 'stat'))
+CALL_OPUS = Gauge('gsmgw_call_opus', 'Opus encoder settings of each ongoing call chosen by the '
+                  'rate control (bitrate in bit/s, frame_ms, fec 0/1, packet_loss in %)',
+                  ('room', 'call_id', 'setting'))
+RATE_CONTROL_CHANGES = Counter('gsmgw_rate_control_changes_total', 'Opus encoder setting '
+                               'changes made by the rate control, by change', ('change',))
+
+
+async def _handle_request(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), timeout=REQUEST_TIMEOUT)
+        while (await asyncio.wait_for(reader.readline(), timeout=REQUEST_TIMEOUT)).strip():
+            pass
+
+        parts = request.decode(errors='replace').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+
+        writer.write(('HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n'
+                      'Connection: close\r\n\r\n' % (status, CONTENT_TYPE, len(body))).encode())
+        writer.write(body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError) as e:
+        logger.debug('Metrics request failed: %r' % (e,))
+    finally:
+        writer.close()
+
+
+async def serve(port, host=None):
+    server = await asyncio.start_server(_handle_request, host, port)
+    logger.info('Serving metrics on port %d' % (port,))
+    return server
@@ -0,0 +1,613 @@
+import os
+import tty
+import random
+import socket
+import struct
+import asyncio
+import logging
+import argparse
+import datetime
+
+import smspdu
+import qmivoice
+
+
+SIM_OPERATORS = (
+    ('SimNet', 'SIM', '00101', 7),
+    ('SimNet', 'SIM', '00101', 2),
+    ('OtherNet', 'OTH', '00102', 0),
+)
+SIM_NOISE_URCS = (
+    '+QIND: "csq",20,99',
+    '+QIND: SMS DONE',
+    '+QUSIM: 1',
+)
+CALL_STATE_ACTIVE = 0
+CALL_STATE_INCOMING = 4
+CALL_STATE_WAITING = 5
+CALL_DIR_MT = 1
+QMI_CALL_STATES = {
+    CALL_STATE_ACTIVE: 0x03,
+    CALL_STATE_INCOMING: 0x02,
+    CALL_STATE_WAITING: 0x07,
+}
+QMI_CALL_STATE_END = 0x09
+QMI_CALL_TYPE_VOICE = 0x00
+QMI_CALL_MODE_LTE = 0x05
+QMI_ERR_INVALID_CLIENT_ID = 0x0022
+QMI_ERR_NOT_SUPPORTED = 0x005E
+
+logger = logging.getLogger('ModemSim')
+
+
+class ModemSimulator:
+    '''
+    Fake Quectel EG25 served over a pseudo-terminal. Answers the AT commands used by
+    QuectelModemManager, and injects URCs either from a script or on demand.
+    '''
+    def __init__(self, sim_pin=None, operators=SIM_OPERATORS, csq=20,
+                 response_delay=0.0, urc_delay=0.05, noise=0.0, auto_register=True,
+                 report_delay=0.5, sms_failure_rate=0.0, send_delay=0.0):
+        self.sim_pin = sim_pin
+        self.operators = list(operators)
+        self.csq = csq
+        self.response_delay = response_delay
+        self.urc_delay = urc_delay
+        self.noise = noise
+        self.auto_register = auto_register
+        # Delivery reports of sent messages come this long after AT+CMGS
+        self.report_delay = report_delay
+        # Share of AT+CMGS that fail with a temporary error (network congestion)
+        self.sms_failure_rate = sms_failure_rate
+        # How long the network takes to take a sent PDU (AT+CMGS answers after that)
+        self.send_delay = send_delay
+
+        self.calls = {}
+        self.sms = {}
+        # The parts sent with AT+CMGS (smspdu.SmsSubmit)
+        self.sent_sms = []
+        self._message_ref = 0
+        # TPDU length of the AT+CMGS waiting for its PDU after the > prompt
+        self._cmgs_length = None
+        # While the network takes a sent PDU, commands wait (like on the real modem)
+        self._sending = False
+        self.qmi = None
+        self.commands = []
+        self._registered = None
+        # +CREG/+CGREG/+CEREG URC modes
+        self._reg_urc_modes = {}
+        self._sim_unlocked = sim_pin is None
+        self._concat_ref = 0
+        self._buf = b''
+        self._out = bytearray()
+        self._master = self._slave = None
+        self._loop = None
+
+    @property
+    def tty_path(self):
+        return os.ttyname(self._slave)
+
+    def open(self):
+        self._loop = asyncio.get_running_loop()
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self._loop.add_reader(self._master, self._on_readable)
+        logger.info('Simulated modem on %s' % (self.tty_path,))
+        return self.tty_path
+
+    def close(self):
+        if self._master is None:
+            return
+        self._loop.remove_reader(self._master)
+        self._loop.remove_writer(self._master)
+        self._out.clear()
+        os.close(self._master)
+        os.close(self._slave)
+        self._master = self._slave = None
+
+    def _write(self, data):
+        if self._master is None:
+            return
+        if not self._out:
+            self._loop.add_writer(self._master, self._on_writable)
+        self._out += data
+
+    def _on_writable(self):
+        try:
+            written = os.write(self._master, self._out)
+        except BlockingIOError:
+            return
+        del self._out[:written]
+        if not self._out:
+            self._loop.remove_writer(self._master)
+
+    def _later(self, delay, func, *args):
+        self._loop.call_later(delay, func, *args)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._master, 4096)
+        except OSError:
+            return
+        self._buf += data
+        self._process()
+
+    def _process(self):
+        while not self._sending:
+            if self._cmgs_length is not None:
+                # The PDU ends with Ctrl-Z (or is cancelled with Esc)
+                end = min((pos for pos in (self._buf.find(b'\x1a'), self._buf.find(b'\x1b'))
+                           if pos >= 0), default=-1)
+                if end < 0:
+                    break
+                pdu, cancelled = self._buf[:end].strip().decode(errors='replace'), \
+                    self._buf[end:end + 1] == b'\x1b'
+                self._buf = self._buf[end + 1:]
+                response = ['OK'] if cancelled else self._at_cmgs_pdu(pdu)
+                self._cmgs_length = None
+                if cancelled or not self.send_delay:
+                    self._later(self.response_delay, self._respond, '', response)
+                else:
+                    self._sending = True
+                    self._later(self.response_delay + self.send_delay, self._sent, response)
+                continue
+
+            if b'\r' not in self._buf:
+                break
+            cmd, self._buf = self._buf.split(b'\r', 1)
+            cmd = cmd.strip().decode(errors='replace')
+            if not cmd:
+                continue
+            self.commands.append(cmd)
+            if cmd.upper().startswith('AT+CMGS='):
+                self._cmgs_length = int(cmd[len('AT+CMGS='):])
+                self._later(self.response_delay, self._write, b'%s\r\r\n> ' % (cmd.encode(),))
+                continue
+            response = self._handle(cmd)
+            self._later(self.response_delay, self._respond, cmd, response)
+
+    def _sent(self, response):
+        self._sending = False
+        self._respond('', response)
+        self._process()
+
+    def _respond(self, cmd, response):
+        if self.noise and random.random() < self.noise:
+            self.send_urc(random.choice(SIM_NOISE_URCS))
+        lines = ''.join('\r\n%s\r\n' % (line,) for line in response)
+        self._write(('%s\r%s' % (cmd, lines)).encode())
+
+    def send_urc(self, urc):
+        self._write(('\r\n%s\r\n' % (urc,)).encode())
+
+    def inject_urc(self, urc, delay=0):
+        self._later(delay, self.send_urc, urc)
+
+    # Scenario helpers
+
+    def ring(self, number, delay=0):
+        def do_ring():
+            idx = max(self.calls, default=0) + 1
+            waiting = any(c[1] == CALL_STATE_ACTIVE for c in self.calls.values())
+            state = CALL_STATE_WAITING if waiting else CALL_STATE_INCOMING
+            self.calls[idx] = [CALL_DIR_MT, state, number]
+            self.send_urc('+CCWA: "%s",145,1' % (number,) if waiting else 'RING')
+            self._calls_changed()
+        self._later(delay, do_ring)
+
+    def remote_hangup(self, idx=None, delay=0):
+        def do_hangup():
+            for call_idx in ([idx] if idx else list(self.calls)):
+                self.calls.pop(call_idx, None)
+            self.send_urc('NO CARRIER')
+            self._promote_waiting()
+            self._calls_changed()
+        self._later(delay, do_hangup)
+
+    def receive_sms(self, number, text, delay=0):
+        '''
+        Stores the message (in several parts, if it is long) and sends +CMTI for each part
+        '''
+        def do_receive():
+            self._concat_ref = (self._concat_ref + 1) % 256
+            now = datetime.datetime.now(datetime.timezone.utc)
+            for pdu in smspdu.encode_deliver(number, text, now, self._concat_ref):
+                idx = max(self.sms, default=-1) + 1
+                self.sms[idx] = pdu
+                self.send_urc('+CMTI: "ME",%d' % (idx,))
+        self._later(delay, do_receive)
+
+    def _calls_changed(self):
+        if self.qmi:
+            self.qmi.send_call_status()
+
+    # AT command handling
+
+    def _handle(self, cmd):
+        upper = cmd.upper()
+        if upper in ('AT', 'ATE', 'ATE0', 'ATE1') or upper.startswith(
+                ('AT+QURCCFG', 'AT+QCFG', 'AT+CPMS', 'AT+CNMI', 'AT+CCWA')):
+            return ['OK']
+
+        handler = {
+            'AT+QPINC?': self._at_qpinc,
+            'AT+CSQ': self._at_csq,
+            'AT+CLCC': self._at_clcc,
+            'ATA': self._at_ata,
+            'ATH0': self._at_ath,
+            'AT+COPS?': self._at_cops_query,
+            'AT+COPS=?': self._at_cops_scan,
+        }.get(upper)
+        if handler:
+            return handler()
+
+        for cmd_name in ('CREG', 'CGREG', 'CEREG'):
+            if upper == 'AT+%s?' % (cmd_name,):
+                return self._at_reg_query(cmd_name)
+            if upper.startswith('AT+%s=' % (cmd_name,)):
+                self._reg_urc_modes[cmd_name] = int(cmd[len(cmd_name) + 4:])
+                return ['OK']
+
+        for prefix, handler in (('AT+CPIN=', self._at_cpin), ('AT+CFUN=', self._at_cfun),
+                                ('AT+COPS=', self._at_cops_set), ('AT+CMGF=', self._at_cmgf),
+                                ('AT+CMGL', self._at_cmgl), ('AT+CMGR=', self._at_cmgr),
+                                ('AT+CMGD=', self._at_cmgd), ('AT+CHLD=', self._at_chld)):
+            if upper.startswith(prefix):
+                return handler(cmd[len(prefix):])
+
+        return ['ERROR']
+
+    def _at_qpinc(self):
+        return ['+QPINC: "SC",3,10', '+QPINC: "P2",3,10', 'OK']
+
+    def _at_csq(self):
+        return ['+CSQ: %d,99' % (self.csq,), 'OK']
+
+    def _at_clcc(self):
+        return ['+CLCC: %d,%d,%d,0,0,"%s",145' % (idx, direction, state, number)
+                for idx, (direction, state, number) in sorted(self.calls.items())] + ['OK']
+
+    def _at_ata(self):
+        for call in self.calls.values():
+            if call[1] == CALL_STATE_INCOMING:
+                call[1] = CALL_STATE_ACTIVE
+                self._calls_changed()
+                return ['OK']
+        return ['NO CARRIER']
+
+    def _at_ath(self):
+        self.calls.clear()
+        self._calls_changed()
+        return ['OK']
+
+    def _at_chld(self, args):
+        if not args.startswith('1') or len(args) < 2:
+            return ['+CME ERROR: 3']
+        if self.calls.pop(int(args[1:]), None) is None:
+            return ['+CME ERROR: 3']
+        self._promote_waiting()
+        self._calls_changed()
+        return ['OK']
+
+    def _promote_waiting(self):
+        if any(c[1] == CALL_STATE_ACTIVE for c in self.calls.values()):
+            return
+        for call in self.calls.values():
+            if call[1] == CALL_STATE_WAITING:
+                call[1] = CALL_STATE_INCOMING
+                self.inject_urc('RING', self.urc_delay)
+                return
+
+    def _at_cpin(self, pin):
+        if pin != self.sim_pin:
+            return ['+CME ERROR: 16']
+        self._sim_unlocked = True
+        self.inject_urc('+CPIN: READY', self.urc_delay)
+        self.inject_urc('PB DONE', 2 * self.urc_delay)
+        return ['OK']
+
+    def _at_cfun(self, fun):
+        if fun == '0':
+            self._set_registered(None)
+            return ['OK']
+
+        self._sim_unlocked = self.sim_pin is None
+        if self._sim_unlocked:
+            self.inject_urc('+CPIN: READY', self.urc_delay)
+            self.inject_urc('PB DONE', 2 * self.urc_delay)
+        else:
+            self.inject_urc('+CPIN: SIM PIN', self.urc_delay)
+        if self.auto_register and self.operators:
+            self._later(3 * self.urc_delay, self._register, self.operators[0])
+        return ['OK']
+
+    def _register(self, operator):
+        if self._sim_unlocked:
+            self._set_registered(operator)
+        else:
+            self._later(self.urc_delay, self._register, operator)
+
+    def _reg_fields(self, cmd_name):
+        if not self._registered:
+            return '0'
+        net_type = self._registered[3]
+        if cmd_name == 'CEREG' and net_type != 7:
+            return '0'
+        return '1,"0001","0000A1B2",%d' % (net_type,)
+
+    def _set_registered(self, operator):
+        if operator == self._registered:
+            return
+        self._registered = operator
+        for cmd_name, mode in sorted(self._reg_urc_modes.items()):
+            if mode:
+                fields = self._reg_fields(cmd_name)
+                self.send_urc('+%s: %s' % (cmd_name, fields if mode == 2 else fields[0]))
+
+    def _at_reg_query(self, cmd_name):
+        fields = self._reg_fields(cmd_name)
+        mode = self._reg_urc_modes.get(cmd_name, 0)
+        return ['+%s: %d,%s' % (cmd_name, mode, fields if mode == 2 else fields[0]), 'OK']
+
+    def _at_cops_query(self):
+        if not self._registered:
+            return ['+COPS: 0', 'OK']
+        long_name, _, _, net_type = self._registered
+        return ['+COPS: 0,0,"%s",%d' % (long_name, net_type), 'OK']
+
+    def _at_cops_scan(self):
+        nets = ','.join('(1,"%s","%s","%s",%d)' % op for op in self.operators)
+        return ['+COPS: %s,,(0-4),(0-2)' % (nets,), 'OK']
+
+    def _at_cops_set(self, args):
+        if args == '2':
+            self._set_registered(None)
+            return ['OK']
+        if args.startswith('1,0,'):
+            name, net_type = args[len('1,0,'):].rsplit(',', 1)
+            for op in self.operators:
+                if op[0] == name.strip('"') and op[3] == int(net_type):
+                    self._later(self.urc_delay, self._register, op)
+                    return ['OK']
+        return ['+CME ERROR: 30']
+
+    def _at_cmgf(self, mode):
+        # Only PDU mode is simulated
+        return ['OK'] if mode == '0' else ['+CMS ERROR: 303']
+
+    def _sms_lines(self, idx):
+        pdu = self.sms[idx]
+        # Length excludes the (empty) SMSC info octet
+        return ['+CMGL: %d,0,,%d' % (idx, len(pdu) // 2 - 1), pdu]
+
+    def _at_cmgl(self, args):
+        lines = []
+        for idx in sorted(self.sms):
+            lines += self._sms_lines(idx)
+        return lines + ['OK']
+
+    def _at_cmgr(self, idx):
+        idx = int(idx)
+        if idx not in self.sms:
+            return ['+CMS ERROR: 321']
+        header, pdu = self._sms_lines(idx)
+        return ['+CMGR: ' + header.split(',', 1)[1], pdu, 'OK']
+
+    def _at_cmgs_pdu(self, pdu):
+        try:
+            # AT+CMGS gives the length without the SMSC info in front
+            tpdu = pdu[2 + 2 * int(pdu[:2], 16):]
+            submit = smspdu.decode_submit(tpdu)
+        except (ValueError, smspdu.SmsPduError):
+            return ['+CMS ERROR: 304']
+        if len(tpdu) // 2 != self._cmgs_length:
+            return ['+CMS ERROR: 304']
+        if self.sms_failure_rate and random.random() < self.sms_failure_rate:
+            return ['+CMS ERROR: 42']
+
+        self._message_ref = (self._message_ref + 1) % 256
+        self.sent_sms.append(submit)
+        if submit.status_report:
+            self._later(self.send_delay + self.report_delay, self._report_delivery,
+                        self._message_ref, submit.recipient)
+        return ['+CMGS: %d' % (self._message_ref,), 'OK']
+
+    def _report_delivery(self, reference, recipient):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        idx = max(self.sms, default=-1) + 1
+        self.sms[idx] = smspdu.encode_status_report(reference, recipient, 0, now)
+        self.send_urc('+CDSI: "ME",%d' % (idx,))
+
+    def _at_cmgd(self, args):
+        idx, _, flag = args.partition(',')
+        if flag and int(flag) > 0:
+            self.sms.clear()
+        else:
+            self.sms.pop(int(idx), None)
+        return ['OK']
+
+    # Scripting
+
+    async def run_script(self, script):
+        '''
+        Runs a scenario script. Each line is: <delay seconds> <action> [args...]
+        Actions: ring <number>, hangup, sms <number> <text>, urc <text>
+        '''
+        for line in script.splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            delay, action, *args = line.split(' ', 2)
+            await asyncio.sleep(float(delay))
+
+            if action == 'ring':
+                self.ring(args[0])
+            elif action == 'hangup':
+                self.remote_hangup()
+            elif action == 'sms':
+                number, text = ' '.join(args).split(' ', 1)
+                self.receive_sms(number, text)
+            elif action == 'urc':
+                self.send_urc(' '.join(args))
+            else:
+                logger.warning('Unknown script action: %r' % (action,))
+
+
+class QmiSimulator:
+    '''
+    Fake QMI endpoint of a simulated modem, served on one end of a socketpair. Allocates
+    client IDs, answers signal info from the simulated CSQ, and sends call status
+    indications as the simulated calls change.
+    '''
+    def __init__(self, modem_sim):
+        self._modem_sim = modem_sim
+        modem_sim.qmi = self
+        self.clients = set()
+        self.requests = []
+        self._next_cid = 1
+        self._reported_calls = set()
+        self._sock = None
+        self._loop = None
+
+    def open(self):
+        '''
+        Returns the fd to give to QmiDevice
+        '''
+        self._loop = asyncio.get_running_loop()
+        self._sock, client = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._sock.setblocking(False)
+        self._loop.add_reader(self._sock.fileno(), self._on_readable)
+        return client.detach()
+
+    def close(self):
+        if self._sock is None:
+            return
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+
+    def _send(self, msg):
+        if self._sock is None:
+            return
+        try:
+            self._sock.send(qmivoice.pack_qmux(msg, from_service=True))
+        except OSError as e:
+            logger.warning('QMI send failed: %r' % (e,))
+
+    def _on_readable(self):
+        try:
+            frame = self._sock.recv(qmivoice.QMI_READ_SIZE)
+        except BlockingIOError:
+            return
+        if not frame:
+            self.close()
+            return
+
+        msg = qmivoice.unpack_qmux(frame)
+        self.requests.append((msg.service, msg.msg_id))
+        error, tlvs = self._handle(msg)
+        tlvs[qmivoice.TLV_RESULT] = struct.pack('<HH', 1 if error else 0, error)
+        msg_type = (qmivoice.QMI_CTL_RESPONSE if msg.service == qmivoice.QMI_CTL
+                    else qmivoice.QMI_SERVICE_RESPONSE)
+        self._send(msg._replace(msg_type=msg_type, tlvs=tlvs))
+
+    def _handle(self, msg):
+        '''
+        Returns (QMI error, response TLVs)
+        '''
+        if msg.service == qmivoice.QMI_CTL:
+            service = msg.tlvs[qmivoice.TLV_REQUIRED][0]
+            if msg.msg_id == qmivoice.CTL_GET_CLIENT_ID:
+                cid = self._next_cid
+                self._next_cid = self._next_cid % 0xFE + 1
+                self.clients.add((service, cid))
+                return 0, {qmivoice.TLV_REQUIRED: bytes([service, cid])}
+            if msg.msg_id == qmivoice.CTL_RELEASE_CLIENT_ID:
+                client = tuple(msg.tlvs[qmivoice.TLV_REQUIRED][:2])
+                if client not in self.clients:
+                    return QMI_ERR_INVALID_CLIENT_ID, {}
+                self.clients.remove(client)
+                return 0, {qmivoice.TLV_REQUIRED: bytes(client)}
+
+        elif (msg.service, msg.cid) not in self.clients:
+            return QMI_ERR_INVALID_CLIENT_ID, {}
+
+        elif msg.msg_id == qmivoice.NAS_GET_SIGNAL_INFO and msg.service == qmivoice.QMI_NAS:
+            return 0, self._signal_info_tlvs()
+
+        elif (msg.service, msg.msg_id) in (
+                (qmivoice.QMI_VOICE, qmivoice.VOICE_INDICATION_REGISTER),
+                (qmivoice.QMI_NAS, qmivoice.NAS_REGISTER_INDICATIONS),
+                (qmivoice.QMI_NAS, qmivoice.NAS_CONFIG_SIGNAL_INFO)):
+            return 0, {}
+
+        return QMI_ERR_NOT_SUPPORTED, {}
+
+    def _signal_info_tlvs(self):
+        rssi = -113 + 2 * self._modem_sim.csq
+        registered = self._modem_sim._registered
+        if registered and registered[3] == 7:
+            return {qmivoice.TLV_NAS_SIGNAL_LTE: struct.pack('<bbhh', rssi, -10, rssi - 20, 100)}
+        return {qmivoice.TLV_NAS_SIGNAL_GSM: struct.pack('<b', rssi)}
+
+    def _indicate(self, service, msg_id, tlvs):
+        for client_service, cid in sorted(self.clients):
+            if client_service == service:
+                self._send(qmivoice.QmiMessage(service, cid, qmivoice.QMI_SERVICE_INDICATION, 0,
+                                               msg_id, tlvs))
+
+    def send_signal_info(self):
+        self._indicate(qmivoice.QMI_NAS, qmivoice.NAS_SIGNAL_INFO_IND, self._signal_info_tlvs())
+
+    def send_call_status(self):
+        '''
+        Indicates all current calls, and the ones that ended since the last indication
+        '''
+        calls = [(idx, QMI_CALL_STATES.get(state, QMI_CALL_STATE_END), number)
+                 for idx, (_, state, number) in sorted(self._modem_sim.calls.items())]
+        calls += [(idx, QMI_CALL_STATE_END, '')
+                  for idx in sorted(self._reported_calls - set(self._modem_sim.calls))]
+        self._reported_calls = set(self._modem_sim.calls)
+
+        info = bytes([len(calls)]) + b''.join(
+            bytes([idx, state, QMI_CALL_TYPE_VOICE, qmivoice.CALL_DIRECTION_MT,
+                   QMI_CALL_MODE_LTE, 0, 0])
+            for idx, state, _ in calls
+        )
+        numbers = bytes([len(calls)]) + b''.join(
+            bytes([idx, 0, len(number)]) + number.encode() for idx, _, number in calls
+        )
+        self._indicate(qmivoice.QMI_VOICE, qmivoice.VOICE_ALL_CALL_STATUS_IND, {
+            qmivoice.TLV_REQUIRED: info,
+            qmivoice.TLV_VOICE_REMOTE_NUMBER: numbers,
+        })
+
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description='Simulated Quectel EG25 modem on a pty')
+    parser.add_argument('--sim_pin', help='SIM card PIN to require', default=None)
+    parser.add_argument('--script', help='Scenario script file', default=None)
+    parser.add_argument('--response_delay', help='Seconds before each AT response',
+                        type=float, default=0.0)
+    parser.add_argument('--noise', help='Probability of a spurious URC per response',
+                        type=float, default=0.0)
+    return parser.parse_args()
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_cmdline()
+
+    sim = ModemSimulator(sim_pin=args.sim_pin, response_delay=args.response_delay,
+                         noise=args.noise)
+    print(sim.open(), flush=True)
+
+    if args.script:
+        with open(args.script) as script:
+            await sim.run_script(script.read())
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,250 @@
+'''
+Audio tracks that read and write the modem sound card's PCM directly, in fixed-size
+frames, without going through libav demuxing/muxing
+'''
+import os
+import time
+import asyncio
+import logging
+import fractions
+
+import av
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+
+try:
+    import alsaaudio
+except ImportError:
+    alsaaudio = None
+
+
+PCM_SAMPLE_RATE = 8000
+PCM_SAMPLE_RATES = (8000, 16000)
+PCM_PTIME = 0.020
+# Received audio is buffered this long before the sound card plays it
+PLAYOUT_MS = 60
+# Capture periods of the sound card. It is read as soon as a period is in, so this only
+# bounds how much it can fall behind before overrunning
+CAPTURE_PERIODS = 4
+SAMPLE_WIDTH = 2
+
+logger = logging.getLogger('PcmAudio')
+
+
+class PcmError(Exception):
+    pass
+
+
+def frame_samples(sample_rate):
+    return int(sample_rate * PCM_PTIME)
+
+
+def playout_frames(playout_ms):
+    '''
+    The playout buffer, in frames (at least two, so playback can continue during a write)
+    '''
+    return max(2, int(round(playout_ms / 1000 / PCM_PTIME)))
+
+
+class AlsaPcm:
+    '''
+    The capture and playback of an ALSA device, opened non-blocking with a period of one
+    frame. The playback buffer is the playout buffer.
+    '''
+    def __init__(self, device, sample_rate=PCM_SAMPLE_RATE, playout_ms=PLAYOUT_MS):
+        if alsaaudio is None:
+            raise PcmError('pyalsaaudio is not installed')
+        self._frame_bytes = frame_samples(sample_rate) * SAMPLE_WIDTH
+        kwargs = {
+            'rate': sample_rate, 'channels': 1, 'format': alsaaudio.PCM_FORMAT_S16_LE,
+            'periodsize': frame_samples(sample_rate), 'device': device,
+        }
+        self._capture = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, alsaaudio.PCM_NONBLOCK,
+                                      periods=CAPTURE_PERIODS, **kwargs)
+        try:
+            self._playback = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, alsaaudio.PCM_NONBLOCK,
+                                           periods=playout_frames(playout_ms), **kwargs)
+        except BaseException:
+            self._capture.close()
+            raise
+        self._capture_fds = [fd for fd, _ in self._capture.polldescriptors()]
+        self._captured = bytearray()
+        self.dropped = 0
+
+    async def _wait_readable(self):
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+
+        def on_readable():
+            if not readable.done():
+                readable.set_result(None)
+
+        for fd in self._capture_fds:
+            loop.add_reader(fd, on_readable)
+        try:
+            await readable
+        finally:
+            for fd in self._capture_fds:
+                loop.remove_reader(fd)
+
+    async def read(self):
+        '''
+        Returns the next captured frame. The first read starts the capture.
+        '''
+        # The device may not give us exactly the period size asked for, so reads are
+        # collected and cut into frames
+        while len(self._captured) < self._frame_bytes:
+            # A negative length is an overrun, that pyalsaaudio already recovered from
+            length, data = self._capture.read()
+            if length > 0:
+                self._captured += data
+            else:
+                await self._wait_readable()
+        frame = bytes(self._captured[:self._frame_bytes])
+        del self._captured[:self._frame_bytes]
+        return frame
+
+    def write(self, data):
+        '''
+        Queues a frame for playback, or drops it if the playout buffer is full
+        '''
+        if self._playback.write(data) <= 0:
+            self.dropped += 1
+
+    def close(self):
+        self._capture.close()
+        self._playback.close()
+
+
+class FilePcm:
+    '''
+    Stands in for a sound card with files or named pipes of raw mono s16le PCM: the
+    capture is read from one, paced by the clock (silence when it has nothing to read),
+    and the playback is written to the other
+    '''
+    def __init__(self, capture_path, playback_path, sample_rate=PCM_SAMPLE_RATE):
+        self._frame_bytes = frame_samples(sample_rate) * SAMPLE_WIDTH
+        self._capture = os.open(capture_path, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            # Fails with ENXIO on a named pipe that isn't open for reading
+            self._playback = os.open(playback_path,
+                                     os.O_WRONLY | os.O_CREAT | os.O_NONBLOCK, 0o644)
+        except BaseException:
+            os.close(self._capture)
+            raise
+        self._captured = bytearray(self._frame_bytes)
+        self._start = None
+        self._frames = 0
+        self.dropped = 0
+
+    async def read(self):
+        if self._start is None:
+            self._start = time.monotonic()
+        else:
+            self._frames += 1
+            await asyncio.sleep(self._start + self._frames * PCM_PTIME - time.monotonic())
+
+        try:
+            data = os.read(self._capture, self._frame_bytes)
+        except BlockingIOError:
+            data = b''
+        self._captured[:len(data)] = data
+        self._captured[len(data):] = bytes(self._frame_bytes - len(data))
+        return bytes(self._captured)
+
+    def write(self, data):
+        try:
+            os.write(self._playback, data)
+        except (BlockingIOError, BrokenPipeError):
+            self.dropped += 1
+
+    def close(self):
+        os.close(self._capture)
+        os.close(self._playback)
+
+
+class PcmSourceTrack(MediaStreamTrack):
+    '''
+    An audio track of the sound card's capture, one frame per read
+    '''
+    kind = 'audio'
+
+    def __init__(self, pcm, sample_rate=PCM_SAMPLE_RATE):
+        super().__init__()
+        self._pcm = pcm
+        self._sample_rate = sample_rate
+        self._samples = frame_samples(sample_rate)
+        self._time_base = fractions.Fraction(1, sample_rate)
+        self._pts = 0
+
+    async def recv(self):
+        if self.readyState != 'live':
+            raise MediaStreamError
+
+        data = await self._pcm.read()
+        frame = av.AudioFrame(format='s16', layout='mono', samples=self._samples)
+        frame.planes[0].update(data)
+        frame.pts = self._pts
+        frame.sample_rate = self._sample_rate
+        frame.time_base = self._time_base
+        self._pts += self._samples
+        return frame
+
+
+class PcmAudio:
+    '''
+    Both directions of a call's audio on one sound card: track is sent to the peer, and
+    the received track is played once started
+    '''
+    def __init__(self, pcm, sample_rate=PCM_SAMPLE_RATE):
+        self._pcm = pcm
+        self._frame_bytes = frame_samples(sample_rate) * SAMPLE_WIDTH
+        self._resampler = av.AudioResampler(format='s16', layout='mono', rate=sample_rate)
+        self._pending = bytearray(self._frame_bytes)
+        self._pending_len = 0
+        self._remote_track = None
+        self._playback_task = None
+        self.track = PcmSourceTrack(pcm, sample_rate)
+
+    def play(self, track):
+        self._remote_track = track
+
+    async def start(self):
+        if self._remote_track and not self._playback_task:
+            self._playback_task = asyncio.create_task(self._run_playback())
+
+    def _write(self, data):
+        '''
+        Cuts the received audio into frames for the sound card
+        '''
+        view = memoryview(data)
+        pos = 0
+        while pos < len(view):
+            count = min(len(view) - pos, self._frame_bytes - self._pending_len)
+            self._pending[self._pending_len:self._pending_len + count] = view[pos:pos + count]
+            self._pending_len += count
+            pos += count
+            if self._pending_len == self._frame_bytes:
+                self._pcm.write(self._pending)
+                self._pending_len = 0
+
+    async def _run_playback(self):
+        try:
+            while True:
+                frame = await self._remote_track.recv()
+                for resampled in self._resampler.resample(frame):
+                    plane = resampled.planes[0]
+                    self._write(memoryview(plane)[:resampled.samples * SAMPLE_WIDTH])
+        except MediaStreamError:
+            pass
+
+    async def stop(self):
+        self.track.stop()
+        if self._playback_task:
+            self._playback_task.cancel()
+            await asyncio.gather(self._playback_task, return_exceptions=True)
+        if self._pcm.dropped:
+            logger.info('Dropped %d frames of playback (playout buffer full)' % (
+                self._pcm.dropped,
+            ))
+        self._pcm.close()
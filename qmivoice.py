@@ -1,10 +1,65 @@
-import re
+import os
+import struct
+import asyncio
 import logging
-import subprocess
 import contextlib
+import collections
 
 
-CID_PATTERN = re.compile(rb'.*\sCID\:\s\'(\d+)\'.*', re.MULTILINE | re.DOTALL)
+QMUX_IF_TYPE = 0x01
+QMUX_HEADER = struct.Struct('<BHBBB')
+QMI_CTL_HEADER = struct.Struct('<BBHH')
+QMI_SERVICE_HEADER = struct.Struct('<BHHH')
+QMI_TLV_HEADER = struct.Struct('<BH')
+QMI_READ_SIZE = 4096
+QMI_TIMEOUT = 10
+
+QMI_CTL = 0x00
+QMI_DMS = 0x02
+QMI_NAS = 0x03
+QMI_VOICE = 0x09
+
+# QMUX control flags: sender is the host (control point) or the modem (service)
+QMUX_FLAG_SERVICE = 0x80
+# QMI message types, as encoded in the CTL and in the other services' headers
+QMI_CTL_RESPONSE = 0x01
+QMI_CTL_INDICATION = 0x02
+QMI_SERVICE_RESPONSE = 0x02
+QMI_SERVICE_INDICATION = 0x04
+QMI_CID_BROADCAST = 0xFF
+
+CTL_GET_CLIENT_ID = 0x0022
+CTL_RELEASE_CLIENT_ID = 0x0023
+VOICE_INDICATION_REGISTER = 0x0003
+VOICE_ALL_CALL_STATUS_IND = 0x002E
+NAS_REGISTER_INDICATIONS = 0x0003
+NAS_GET_SIGNAL_INFO = 0x004F
+NAS_CONFIG_SIGNAL_INFO = 0x0050
+NAS_SIGNAL_INFO_IND = 0x0051
+
+TLV_REQUIRED = 0x01
+TLV_RESULT = 0x02
+TLV_VOICE_CALL_NOTIFICATIONS = 0x13
+TLV_VOICE_REMOTE_NUMBER = 0x10
+TLV_NAS_SIGNAL_INFO = 0x19
+TLV_NAS_RSSI_THRESHOLDS = 0x10
+TLV_NAS_SIGNAL_GSM = 0x12
+TLV_NAS_SIGNAL_WCDMA = 0x13
+TLV_NAS_SIGNAL_LTE = 0x14
+
+CALL_STATES = {
+    0x01: 'origination', 0x02: 'incoming', 0x03: 'conversation', 0x04: 'cc-in-progress',
+    0x05: 'alerting', 0x06: 'hold', 0x07: 'waiting', 0x08: 'disconnecting', 0x09: 'end',
+    0x0A: 'setup',
+}
+CALL_DIRECTION_MT = 0x02
+# Signal info indications are sent when RSSI crosses these (dBm)
+RSSI_THRESHOLDS = (-105, -95, -85, -75, -65)
+
+QmiMessage = collections.namedtuple('QmiMessage', 'service cid msg_type txn msg_id tlvs')
+CallStatus = collections.namedtuple('CallStatus', 'call_id state direction mode number')
+SignalInfo = collections.namedtuple('SignalInfo', 'rat rssi rsrq rsrp snr')
+
 logger = logging.getLogger('QmiVoice')
 
 
@@ -12,37 +67,281 @@ class QmiVoiceException(Exception):
     pass
 
 
-class QmiVoice:
+class QmiError(QmiVoiceException):
+    def __init__(self, msg_id, error):
+        super().__init__('QMI message 0x%04x failed with error 0x%04x' % (msg_id, error))
+        self.msg_id = msg_id
+        self.error = error
+
+
+def pack_tlvs(tlvs):
+    return b''.join(QMI_TLV_HEADER.pack(tlv_type, len(value)) + value
+                    for tlv_type, value in tlvs.items())
+
+
+def unpack_tlvs(data):
+    tlvs = {}
+    pos = 0
+    while pos + QMI_TLV_HEADER.size <= len(data):
+        tlv_type, length = QMI_TLV_HEADER.unpack_from(data, pos)
+        pos += QMI_TLV_HEADER.size
+        tlvs[tlv_type] = data[pos:pos + length]
+        pos += length
+    return tlvs
+
+
+def pack_qmux(msg, from_service=False):
+    payload = pack_tlvs(msg.tlvs)
+    header = QMI_CTL_HEADER if msg.service == QMI_CTL else QMI_SERVICE_HEADER
+    sdu = header.pack(msg.msg_type, msg.txn, msg.msg_id, len(payload)) + payload
+    return QMUX_HEADER.pack(
+        QMUX_IF_TYPE, QMUX_HEADER.size - 1 + len(sdu),
+        QMUX_FLAG_SERVICE if from_service else 0, msg.service, msg.cid
+    ) + sdu
+
+
+def unpack_qmux(frame):
+    if_type, length, _, service, cid = QMUX_HEADER.unpack_from(frame)
+    if if_type != QMUX_IF_TYPE or length + 1 > len(frame):
+        raise QmiVoiceException('Bad QMUX frame: %s' % (frame.hex(),))
+    header = QMI_CTL_HEADER if service == QMI_CTL else QMI_SERVICE_HEADER
+    msg_type, txn, msg_id, tlv_len = header.unpack_from(frame, QMUX_HEADER.size)
+    start = QMUX_HEADER.size + header.size
+    return QmiMessage(service, cid, msg_type, txn, msg_id,
+                      unpack_tlvs(frame[start:start + tlv_len]))
+
+
+def parse_call_status(tlvs):
+    '''
+    Returns a list of CallStatus from an All Call Status indication
+    '''
+    numbers = {}
+    data = tlvs.get(TLV_VOICE_REMOTE_NUMBER, b'')
+    pos = 1
+    for _ in range(data[0] if data else 0):
+        call_id, _, length = data[pos:pos + 3]
+        numbers[call_id] = data[pos + 3:pos + 3 + length].decode(errors='replace')
+        pos += 3 + length
+
+    calls = []
+    data = tlvs.get(TLV_REQUIRED, b'')
+    for i in range(data[0] if data else 0):
+        call_id, state, _, direction, mode = data[1 + i * 7:6 + i * 7]
+        calls.append(CallStatus(call_id, CALL_STATES.get(state, state), direction, mode,
+                                numbers.get(call_id)))
+    return calls
+
+
+def parse_signal_info(tlvs):
+    '''
+    Returns the SignalInfo of the best radio access technology in a signal info message
+    '''
+    if TLV_NAS_SIGNAL_LTE in tlvs:
+        rssi, rsrq, rsrp, snr = struct.unpack('<bbhh', tlvs[TLV_NAS_SIGNAL_LTE])
+        return SignalInfo('LTE', rssi, rsrq, rsrp, snr / 10)
+    if TLV_NAS_SIGNAL_WCDMA in tlvs:
+        rssi, _ = struct.unpack('<bh', tlvs[TLV_NAS_SIGNAL_WCDMA])
+        return SignalInfo('UMTS', rssi, None, None, None)
+    if TLV_NAS_SIGNAL_GSM in tlvs:
+        return SignalInfo('GSM', struct.unpack('<b', tlvs[TLV_NAS_SIGNAL_GSM])[0],
+                          None, None, None)
+    return None
+
+
+class QmiDevice:
     '''
-    Wraps the qmicli utility by parsing its output
+    QMUX transport over the modem's QMI character device (or any message or stream fd,
+    like one end of a socketpair). Requests are matched to responses by transaction ID.
     '''
-    def __init__(self, device):
+    def __init__(self, device=None, fd=None):
         self._device = device
+        self._fd = fd
+        self._buf = bytearray()
+        self._txn = 0
+        self._pending = {}
+        self._subscribers = collections.defaultdict(list)
+        self._loop = None
+
+    def open(self):
+        self._loop = asyncio.get_running_loop()
+        if self._fd is None:
+            self._fd = os.open(self._device, os.O_RDWR | os.O_NONBLOCK | os.O_NOCTTY)
+        os.set_blocking(self._fd, False)
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    def close(self, error=None):
+        if self._fd is None:
+            return
+        self._loop.remove_reader(self._fd)
+        os.close(self._fd)
+        self._fd = None
+
+        error = error or QmiVoiceException('QMI device closed')
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+        for subscribers in self._subscribers.values():
+            for _, queue in subscribers:
+                queue.put_nowait(None)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, QMI_READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.close(QmiVoiceException(e))
+            return
+        if not data:
+            self.close()
+            return
+
+        self._buf += data
+        while len(self._buf) >= QMUX_HEADER.size:
+            if self._buf[0] != QMUX_IF_TYPE:
+                logger.warning('Dropping unframed QMI data: %s' % (self._buf.hex(),))
+                self._buf.clear()
+                return
+            size = struct.unpack_from('<H', self._buf, 1)[0] + 1
+            if len(self._buf) < size:
+                return
+            frame = bytes(self._buf[:size])
+            del self._buf[:size]
+            try:
+                self._dispatch(unpack_qmux(frame))
+            except (QmiVoiceException, struct.error) as e:
+                logger.warning('Bad QMI message: %r' % (e,))
+
+    def _dispatch(self, msg):
+        indication = QMI_CTL_INDICATION if msg.service == QMI_CTL else QMI_SERVICE_INDICATION
+        if msg.msg_type & indication:
+            for cid, queue in self._subscribers[(msg.service, msg.msg_id)]:
+                if msg.cid in (cid, QMI_CID_BROADCAST):
+                    queue.put_nowait(msg)
+            return
+
+        future = self._pending.pop((msg.service, msg.cid, msg.txn), None)
+        if future and not future.done():
+            future.set_result(msg)
+
+    async def request(self, service, cid, msg_id, tlvs=None, timeout=QMI_TIMEOUT):
+        '''
+        Sends a request and returns the TLVs of its response
+        '''
+        if self._fd is None:
+            raise QmiVoiceException('QMI device is not open')
+        # CTL transaction IDs are a single byte
+        self._txn = self._txn % 0xFF + 1
+        key = (service, cid, self._txn)
+        future = self._pending[key] = self._loop.create_future()
+        try:
+            os.write(self._fd, pack_qmux(QmiMessage(service, cid, 0, self._txn, msg_id,
+                                                    tlvs or {})))
+            msg = await asyncio.wait_for(future, timeout=timeout)
+        finally:
+            self._pending.pop(key, None)
+
+        result, error = struct.unpack('<HH', msg.tlvs.get(TLV_RESULT, b'\0\0\0\0'))
+        if result:
+            raise QmiError(msg_id, error)
+        return msg.tlvs
 
-    def _release_cid(self, cid):
-        subprocess.run(
-            ['qmicli', '-d', self._device, '--client-cid', str(cid), '--voice-noop']
-        )
+    def indications(self, service, cid, msg_id):
+        '''
+        Returns an async iterator of the TLVs of each indication, until the device is
+        closed. Indications are queued from this call on, not just once iterated.
+        '''
+        entry = (cid, asyncio.Queue())
+        self._subscribers[(service, msg_id)].append(entry)
+        return self._iter_indications(service, msg_id, entry)
 
-    @contextlib.contextmanager
-    def alloc_cid(self):
-        # HACK: Allocate this CID first, so that set_current_host_app runs on openqti
-        subprocess.run(['qmicli', '-d', self._device, '--dms-noop'])
+    async def _iter_indications(self, service, msg_id, entry):
+        try:
+            while True:
+                msg = await entry[1].get()
+                if msg is None:
+                    return
+                yield msg.tlvs
+        finally:
+            self._subscribers[(service, msg_id)].remove(entry)
+
+    async def alloc_cid(self, service):
+        tlvs = await self.request(QMI_CTL, 0, CTL_GET_CLIENT_ID,
+                                  {TLV_REQUIRED: bytes([service])})
+        return tlvs[TLV_REQUIRED][1]
+
+    async def release_cid(self, service, cid):
+        await self.request(QMI_CTL, 0, CTL_RELEASE_CLIENT_ID,
+                           {TLV_REQUIRED: bytes([service, cid])})
 
-        proc = subprocess.run(
-            ['qmicli', '-d', self._device, '--client-no-release-cid', '--voice-noop'],
-            check=True, capture_output=True
-        )
 
-        match = re.match(CID_PATTERN, proc.stdout)
-        if not match:
-            raise QmiVoiceException(proc.stdout)
-        cid = int(match.groups()[0].decode())
-        logger.info('QMI allocated voice CID: %d' % (cid,))
+class QmiVoice:
+    '''
+    Voice client on the modem's QMI device, with call state and signal info streams
+    '''
+    def __init__(self, device=None, fd=None):
+        self._qmi = QmiDevice(device, fd)
+        self.cid = None
+        self._nas_cid = None
 
+    async def _release(self, service, cid):
         try:
-            yield
+            await self._qmi.release_cid(service, cid)
+        except (QmiVoiceException, asyncio.TimeoutError) as e:
+            logger.warning('QMI releasing CID %d of service 0x%02x failed: %r' % (
+                cid, service, e
+            ))
+
+    @contextlib.asynccontextmanager
+    async def alloc_cid(self):
+        self._qmi.open()
+        try:
+            # HACK: Allocate this CID first, so that set_current_host_app runs on openqti
+            await self._release(QMI_DMS, await self._qmi.alloc_cid(QMI_DMS))
+
+            self.cid = await self._qmi.alloc_cid(QMI_VOICE)
+            logger.info('QMI allocated voice CID: %d' % (self.cid,))
+            try:
+                await self._qmi.request(QMI_VOICE, self.cid, VOICE_INDICATION_REGISTER,
+                                        {TLV_VOICE_CALL_NOTIFICATIONS: b'\x01'})
+            except QmiError as e:
+                logger.warning('QMI call notifications not enabled: %r' % (e,))
+
+            try:
+                yield self
+            finally:
+                if self._nas_cid is not None:
+                    await self._release(QMI_NAS, self._nas_cid)
+                    self._nas_cid = None
+                await self._release(QMI_VOICE, self.cid)
+                logger.info('QMI released voice CID: %d' % (self.cid,))
+                self.cid = None
         finally:
-            self._release_cid(cid)
-            logger.info('QMI released voice CID: %d' % (cid,))
+            self._qmi.close()
+
+    async def call_status(self):
+        '''
+        Yields the list of current calls (CallStatus) whenever any of them changes
+        '''
+        async for tlvs in self._qmi.indications(QMI_VOICE, self.cid, VOICE_ALL_CALL_STATUS_IND):
+            yield parse_call_status(tlvs)
+
+    async def signal_info(self):
+        '''
+        Yields the current SignalInfo, then again whenever RSSI crosses a threshold
+        '''
+        if self._nas_cid is None:
+            self._nas_cid = await self._qmi.alloc_cid(QMI_NAS)
+            await self._qmi.request(QMI_NAS, self._nas_cid, NAS_CONFIG_SIGNAL_INFO, {
+                TLV_NAS_RSSI_THRESHOLDS: bytes([len(RSSI_THRESHOLDS)]) +
+                struct.pack('<%db' % (len(RSSI_THRESHOLDS),), *RSSI_THRESHOLDS)
+            })
+            await self._qmi.request(QMI_NAS, self._nas_cid, NAS_REGISTER_INDICATIONS,
+                                    {TLV_NAS_SIGNAL_INFO: b'\x01'})
 
+        indications = self._qmi.indications(QMI_NAS, self._nas_cid, NAS_SIGNAL_INFO_IND)
+        yield parse_signal_info(await self._qmi.request(QMI_NAS, self._nas_cid,
+                                                        NAS_GET_SIGNAL_INFO))
+        async for tlvs in indications:
+            yield parse_signal_info(tlvs)
@@ -1,21 +1,38 @@
 import re
 import os
+import json
+import time
+import heapq
 import asyncio
 import logging
 import argparse
 
 import serial_asyncio
 
+import smspdu
+import metrics
+
 
 MODEM_BAUD = 115200
-AT_SHORT_TIMEOUT = 0.2
+AT_RX_CHUNK_SIZE = 4096
 AT_MEDIUM_TIMEOUT = 0.5
 AT_LONG_TIMEOUT = 5
+# After a command times out, a bare AT is sent before the next command, and everything up
+# to its OK followed by this long without another response is taken for late responses
+AT_RESYNC_QUIET = 0.5
+AT_RESYNC_TIMEOUT = 30
 MIN_ALLOWED_UNLOCK_ATTEMPTS = 3
-NETWORK_COPS_ATTEMPTS = 10
-COPS_SLEEP = 2
+# How long to wait for registration (on the preferred network type) from URCs
+REGISTRATION_TIMEOUT = 20
+# The modem answers AT+CMGS once the network took the message, and the port is held until
+# then. The modem allows 120 s, but calls can't wait that long: a later answer is picked
+# up while the port is resynced
+SMS_SEND_TIMEOUT = 10
+# Reading and deleting stored messages may wait for an AT+CMGS, and the resync after it
+SMS_STORAGE_TIMEOUT = SMS_SEND_TIMEOUT + AT_RESYNC_TIMEOUT + AT_LONG_TIMEOUT
 COPS_PASSIVE_SCAN_TIMEOUT = 4 * 60
 MANUAL_COPS_WAIT_SECONDS = 2 * 60
+OPERATOR_CACHE_MAX_AGE = 7 * 24 * 60 * 60
 
 NET_TYPES = {
     0: 'GSM',
@@ -27,37 +44,538 @@ SCANMODE_FOR_NET_TYPE = {
     'UMTS': 2,
     'LTE': 3,
 }
-STATUS_REJECTED = 2
+REGISTRATION_CMDS = ('CREG', 'CGREG', 'CEREG')
+REG_STATUS_HOME = 1
+REG_STATUS_DENIED = 3
+REG_STATUS_ROAMING = 5
+CLCC_DIR_MT = '1'
+CLCC_STATE_INCOMING = '4'
+CLCC_STATE_WAITING = '5'
+CLCC_MODE_VOICE = '0'
+CMGL_ALL = 4
+CONCAT_EVICT_INTERVAL = 30
+CMS_ERROR_INVALID_INDEX = '+CMS ERROR: 321'
+
+FINAL_RESULT_CODES = ('OK', 'ERROR', 'CONNECT', 'BUSY', 'NO ANSWER', 'NO DIALTONE')
+FINAL_RESULT_PREFIXES = ('+CME ERROR:', '+CMS ERROR:')
+AT_PROMPT = '>'
+# Intermediate responses each command may produce before its final result code.
+# Any other line that arrives mid-response is a URC.
+AT_INTERMEDIATE_RESPONSES = {
+    'AT+QPINC': ('+QPINC:',),
+    'AT+CPIN?': ('+CPIN:',),
+    'AT+COPS': ('+COPS:',),
+    'AT+CREG?': ('+CREG:',),
+    'AT+CGREG?': ('+CGREG:',),
+    'AT+CEREG?': ('+CEREG:',),
+    'AT+CSQ': ('+CSQ:',),
+    'AT+CLCC': ('+CLCC:',),
+    'AT+CPMS': ('+CPMS:',),
+    'AT+QCFG': ('+QCFG:',),
+    'AT+QURCCFG': ('+QURCCFG:',),
+    'AT+CMGL': ('+CMGL:',),
+    'AT+CMGR': ('+CMGR:',),
+    'AT+CMGS': ('+CMGS:',),
+}
+# Commands whose response header lines are followed by free-form body lines
+AT_BODY_RESPONSE_CMDS = ('AT+CMGL', 'AT+CMGR')
+# Commands for which NO CARRIER is the final result, and not a URC
+AT_CALL_CMDS = ('ATA', 'ATD')
+AT_PROMPT_CMDS = ('AT+CMGS', 'AT+CMGW')
+AT_CTRL_Z = b'\x1a'
+AT_ESC = b'\x1b'
+# Queued AT commands are sent in priority order: call control first, then modem setup,
+# then SMS, then background queries. A command that was sent always runs to its end.
+AT_PRIORITY_CALL = 0
+AT_PRIORITY_DEFAULT = 1
+AT_PRIORITY_SMS = 2
+AT_PRIORITY_BACKGROUND = 3
+AT_PRIORITY_NAMES = ('call', 'default', 'sms', 'background')
+AT_PRIORITIES = (
+    (('ATA', 'ATH', 'ATD', 'AT+CHLD', 'AT+CLCC'), AT_PRIORITY_CALL),
+    (('AT+CMGR', 'AT+CMGD', 'AT+CMGL', 'AT+CMGS'), AT_PRIORITY_SMS),
+    (('AT+CSQ', 'AT+COPS?'), AT_PRIORITY_BACKGROUND),
+)
+# Queries that don't change anything: asking one again while it is queued (not sent yet)
+# gets the answer of the queued one
+AT_IDEMPOTENT_CMDS = ('AT+CSQ', 'AT+CLCC', 'AT+COPS?', 'AT+CREG?', 'AT+CGREG?', 'AT+CEREG?',
+                      'AT+QPINC?', 'AT+CPIN?')
+URC_PREFIXES = (
+    'RING', '+CRING:', '+CLIP:', '+CCWA:', '+CMTI:', '+CDS', '+CPIN:', 'PB DONE',
+    '+QIND:', '+CREG:', '+CGREG:', '+CEREG:', 'NO CARRIER', '+QUSIM:', 'RDY',
+    '+CFUN:', 'POWERED DOWN',
+)
 
 logger = logging.getLogger('QuectelModem')
 
 
 class AtCommandError(Exception):
     pass
+class AtTimeoutError(asyncio.TimeoutError):
+    '''
+    A sent command got no response in time. late_response resolves with its response if
+    that still comes while the port is resynced (or None if it doesn't)
+    '''
+    def __init__(self, message, late_response):
+        super().__init__(message)
+        self.late_response = late_response
 class AtStateError(Exception):
     pass
 class NetworkError(Exception):
     pass
 
 
+class AtResponseFramer:
+    '''
+    Splits the raw byte stream of the AT port into command responses and URCs.
+    A response ends on a final result code (or the > prompt), not on an RX timeout.
+    '''
+    def __init__(self, response_cb, urc_cb):
+        self._response_cb = response_cb
+        self._urc_cb = urc_cb
+        self._buf = b''
+        self._cmd = None
+        self._expected = None
+        self._prompt = False
+        self._lines = []
+
+    def expect(self, cmd, prompt=None):
+        '''
+        Called right before cmd is written to the modem. The response of a prompt command
+        is the > prompt, unless prompt is False (when its data is written).
+        '''
+        self._cmd = cmd
+        self._prompt = cmd.startswith(AT_PROMPT_CMDS) if prompt is None else prompt
+        self._lines = []
+        # For an unknown command, whatever isn't a known URC is taken as its response
+        self._expected = at_intermediate_responses(cmd)
+
+    def abandon(self):
+        self._cmd = None
+        self._lines = []
+
+    def feed(self, data):
+        *lines, self._buf = re.split(rb'\r\n|\r|\n', self._buf + data)
+        for line in lines:
+            self._line(line.strip().decode(errors='replace'))
+
+        if (self._cmd is not None and self._prompt and
+                self._buf.strip() == AT_PROMPT.encode()):
+            self._buf = b''
+            self._finish(AT_PROMPT)
+
+    def _is_final(self, line):
+        if line == 'NO CARRIER':
+            return self._cmd.startswith(AT_CALL_CMDS)
+        return line in FINAL_RESULT_CODES or line.startswith(FINAL_RESULT_PREFIXES)
+
+    def _is_response(self, line):
+        if self._expected is None:
+            return not line.startswith(URC_PREFIXES)
+        if line.startswith(self._expected):
+            return True
+        # Body lines following a header line (e.g. the text of an SMS)
+        return (bool(self._lines) and self._cmd.startswith(AT_BODY_RESPONSE_CMDS) and
+                not line.startswith(URC_PREFIXES))
+
+    def _line(self, line):
+        if not line:
+            return
+
+        if self._cmd is None:
+            self._urc_cb(line)
+        elif line == self._cmd:
+            # Echo of the command
+            return
+        elif self._prompt and line == AT_PROMPT:
+            # The > prompt, with more data (e.g. a URC) already in the same read
+            self._finish(AT_PROMPT)
+        elif self._is_final(line):
+            self._finish(line)
+        elif self._is_response(line):
+            self._lines.append(line)
+        else:
+            self._urc_cb(line)
+
+    def _finish(self, final):
+        lines = self._lines + [final]
+        self.abandon()
+        self._response_cb('\n'.join(lines))
+
+
+def at_intermediate_responses(cmd):
+    '''
+    The prefixes of the response lines of cmd, or None if it isn't known
+    '''
+    prefixes = [k for k in AT_INTERMEDIATE_RESPONSES if cmd.startswith(k)]
+    return AT_INTERMEDIATE_RESPONSES[max(prefixes, key=len)] if prefixes else None
+
+
+def at_priority(cmd):
+    for prefixes, priority in AT_PRIORITIES:
+        if cmd.startswith(prefixes):
+            return priority
+    return AT_PRIORITY_DEFAULT
+
+
+class AtCommand:
+    '''
+    A queued command, and the futures of everyone waiting for its response
+    '''
+    def __init__(self, cmd, priority, timeout, data=None):
+        self.cmd = cmd
+        self.priority = priority
+        self.timeout = timeout
+        # Written after the > prompt, for AT+CMGS
+        self.data = data
+        self.queued = time.monotonic()
+        self.sent = None
+        self.waiters = []
+        # The deadline of each waiter while queued, and the response timeout once sent
+        self.expiry_timers = []
+        self.timer = None
+
+    def add_waiter(self, timeout, expire_cb):
+        '''
+        expire_cb(waiter) is called if the command is still queued after timeout (never,
+        if timeout is None)
+        '''
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self.waiters.append(waiter)
+        if timeout is not None:
+            self.expiry_timers.append(loop.call_later(timeout, expire_cb, waiter))
+        return waiter
+
+    def cancel_timers(self):
+        for timer in self.expiry_timers:
+            timer.cancel()
+        self.expiry_timers = []
+        if self.timer:
+            self.timer.cancel()
+
+    @property
+    def abandoned(self):
+        return all(waiter.done() for waiter in self.waiters)
+
+    def set_result(self, result):
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(result)
+
+    def set_exception(self, exc):
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_exception(exc)
+
+
+class AtScheduler:
+    '''
+    Owns the AT port: one command is in flight at a time, and the queued ones are sent in
+    priority order (FIFO within a priority). A command still queued after its timeout
+    fails without being sent, and a sent one gets its timeout again for the response.
+    Call control commands only time out once sent: they go next, but may have to wait
+    for the command in flight (up to SMS_SEND_TIMEOUT for AT+CMGS, or a resync after it).
+    A caller that is cancelled only stops waiting: its command, if sent, keeps the port
+    until its response, so that the response is never taken for the next command's.
+    After a response timeout, the port is resynced with a bare AT for the same reason.
+    A prompt command (AT+CMGS) keeps the port from its prompt until its data is sent.
+    '''
+    def __init__(self, write, framer, name):
+        self._write = write
+        self._framer = framer
+        self._name = name
+        self._queue = []
+        self._seq = 0
+        # Queued idempotent queries, by command
+        self._queued_queries = {}
+        self._current = None
+        # The bare AT holding the port after a timeout, until it is answered, and
+        # (command, late_response future) of the command that timed out
+        self._resync = None
+        self._late = None
+        self._closed = False
+
+    def qsize(self):
+        return len(self._queue)
+
+    def submit(self, cmd, timeout, priority=None, data=None):
+        '''
+        Returns a future of the response. data is written (followed by Ctrl-Z) when the
+        command gives the > prompt.
+        '''
+        if self._closed:
+            raise AtStateError('Modem is closed')
+        if priority is None:
+            priority = at_priority(cmd)
+        command = self._queued_queries.get(cmd)
+        if command is None:
+            command = AtCommand(cmd, priority, timeout, data)
+            if cmd in AT_IDEMPOTENT_CMDS:
+                self._queued_queries[cmd] = command
+            heapq.heappush(self._queue, (command.priority, self._seq, command))
+            self._seq += 1
+        else:
+            # The queued query serves every caller: it goes at the most urgent of their
+            # priorities, and waits for its response as long as the most patient one
+            command.timeout = max(command.timeout, timeout)
+            if priority < command.priority:
+                command.priority = priority
+                self._queue = [(entry[2].priority,) + entry[1:] for entry in self._queue]
+                heapq.heapify(self._queue)
+        waiter = command.add_waiter(
+            None if priority == AT_PRIORITY_CALL else timeout,
+            lambda waiter: self._expire(command, waiter, timeout)
+        )
+        if self._current is None:
+            self._send_next()
+        return waiter
+
+    def _dequeue(self):
+        _, _, command = heapq.heappop(self._queue)
+        if self._queued_queries.get(command.cmd) is command:
+            del self._queued_queries[command.cmd]
+        command.cancel_timers()
+        return command
+
+    def _expire(self, command, waiter, timeout):
+        '''
+        The command is still queued at a caller's deadline. Once it has no callers left,
+        it stays in the queue, and is skipped when its turn comes.
+        '''
+        if not waiter.done():
+            waiter.set_exception(asyncio.TimeoutError('%s: still queued after %.1fs' % (
+                command.cmd, timeout
+            )))
+        if command.abandoned and self._queued_queries.get(command.cmd) is command:
+            del self._queued_queries[command.cmd]
+
+    def _send_next(self):
+        while self._queue:
+            command = self._dequeue()
+            if command.abandoned:
+                continue
+            metrics.AT_COMMAND_WAIT_SECONDS.observe(
+                time.monotonic() - command.queued, modem=self._name,
+                priority=AT_PRIORITY_NAMES[command.priority]
+            )
+            self._current = command
+            command.sent = time.monotonic()
+            self._start_timer(command)
+            self._framer.expect(command.cmd)
+            self._write(b'%s\r' % (command.cmd.encode(),))
+            return
+        self._current = None
+
+    def _start_timer(self, command):
+        command.timer = asyncio.get_running_loop().call_later(
+            command.timeout, self._timeout, command
+        )
+
+    def _finish(self, result):
+        command, self._current = self._current, None
+        command.timer.cancel()
+        metrics.AT_COMMAND_SECONDS.observe(
+            time.monotonic() - command.sent, modem=self._name,
+            command=metrics.at_command_name(command.cmd), result=result
+        )
+        return command
+
+    def on_response(self, response):
+        if self._current is None:
+            logger.getChild(self._name).warning('Response without a command: %r' % (response,))
+            return
+        command = self._current
+        if command is self._resync:
+            self._resync_response(response)
+            return
+        if command.data is not None and response == AT_PROMPT:
+            command.timer.cancel()
+            self._start_timer(command)
+            self._framer.expect(command.cmd, prompt=False)
+            self._write(command.data.encode() + AT_CTRL_Z)
+            command.data = None
+            return
+        command = self._finish('ok' if response.endswith('OK') else 'error')
+        self._send_next()
+        command.set_result(response)
+
+    def _timeout(self, command):
+        self._framer.abandon()
+        if command.cmd.startswith(AT_PROMPT_CMDS) and command.data is not None:
+            # Leaves the prompt, if the modem is still in it (the data wasn't sent)
+            self._write(AT_ESC)
+        self._late = (command.cmd, asyncio.get_running_loop().create_future())
+        self._finish('timeout').set_exception(AtTimeoutError(
+            '%s: no response after %.1fs' % (command.cmd, command.timeout), self._late[1]
+        ))
+        self._start_resync()
+
+    def _start_resync(self):
+        '''
+        Holds the port with a bare AT, so that a late response of the timed out command
+        is taken for the AT's, and not for the next command's
+        '''
+        logger.getChild(self._name).info('Resyncing the AT port')
+        self._current = self._resync = AtCommand('AT', AT_PRIORITY_CALL, AT_RESYNC_TIMEOUT)
+        self._resync.sent = time.monotonic()
+        self._resync.timer = asyncio.get_running_loop().call_later(
+            AT_RESYNC_TIMEOUT, self._end_resync, False
+        )
+        self._framer.expect('AT')
+        self._write(b'AT\r')
+
+    def _resync_response(self, response):
+        # Late responses, or the AT's own: wait until they stop. One with the timed out
+        # command's response lines goes to its late_response
+        cmd, late_response = self._late
+        expected = at_intermediate_responses(cmd)
+        if (expected and not late_response.done() and
+                any(line.startswith(expected) for line in response.split('\n'))):
+            logger.getChild(self._name).info('Late response of %s: %r' % (cmd, response))
+            late_response.set_result(response)
+        else:
+            logger.getChild(self._name).debug('Resync dropped %r' % (response,))
+        self._framer.expect('AT')
+        self._resync.timer.cancel()
+        self._resync.timer = asyncio.get_running_loop().call_later(
+            AT_RESYNC_QUIET, self._end_resync, True
+        )
+
+    def _end_resync(self, answered):
+        if not answered:
+            logger.getChild(self._name).warning('No response to AT after %.1fs' % (
+                AT_RESYNC_TIMEOUT,
+            ))
+        self._framer.abandon()
+        self._current = self._resync = None
+        late_response = self._late[1]
+        if not late_response.done():
+            late_response.set_result(None)
+        self._late = None
+        self._send_next()
+
+    def close(self):
+        '''
+        Fails everything queued or in flight, when the modem goes away
+        '''
+        self._closed = True
+        commands = [command for _, _, command in self._queue]
+        if self._current:
+            commands.append(self._current)
+        self._queue, self._current, self._resync = [], None, None
+        self._queued_queries.clear()
+        for command in commands:
+            command.cancel_timers()
+            command.set_exception(AtStateError('Modem closed'))
+        if self._late and not self._late[1].done():
+            self._late[1].set_result(None)
+        self._late = None
+
+
+class OperatorCache:
+    '''
+    The network the modem last registered on, and the last scan results, kept on disk so
+    that a restart tries them before scanning again. Without a path, kept in memory only.
+    '''
+    def __init__(self, path=None, max_age=OPERATOR_CACHE_MAX_AGE):
+        self._path = path
+        self._max_age = max_age
+        self._data = self._load()
+
+    def _load(self):
+        if not self._path:
+            return {}
+        try:
+            with open(self._path, 'r') as cache:
+                return json.load(cache)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring operator cache %s: %r' % (self._path, e))
+            return {}
+
+    def _save(self):
+        if not self._path:
+            return
+        os.makedirs(os.path.dirname(self._path) or '.', exist_ok=True)
+        with open(self._path + '.tmp', 'w') as cache:
+            json.dump(self._data, cache)
+        os.replace(self._path + '.tmp', self._path)
+
+    def _get(self, key):
+        entry = self._data.get(key)
+        if not entry or time.time() - entry['time'] > self._max_age:
+            return None
+        return entry['value']
+
+    def _set(self, key, value):
+        self._data[key] = {'time': time.time(), 'value': value}
+        self._save()
+
+    @property
+    def last(self):
+        return self._get('last')
+
+    def set_last(self, operator, net_type):
+        self._set('last', [operator, net_type])
+
+    @property
+    def networks(self):
+        return self._get('networks')
+
+    def set_networks(self, networks):
+        self._set('networks', [list(network) for network in networks])
+
+
 class QuectelModemManager:
     def __init__(self, modem_tty, modem_baud=MODEM_BAUD, call_forwarder=None,
                  sms_forwarder=None, sim_card_pin=None, preferred_network='LTE',
-                 extra_initer=None):
+                 extra_initer=None, name=None, operator_cache=None, status_report_cb=None):
         self._call_forwarder = call_forwarder
         self._sms_forwarder = sms_forwarder
+        # Called with each SMS delivery report (smspdu.StatusReport)
+        self._status_report_cb = status_report_cb
         self._modem_tty = modem_tty
         self._modem_baud = modem_baud
+        self._modem_r = self._modem_w = None
         self._extra_initer = extra_initer
         self._preferred_network = preferred_network
         self.sim_card_pin = sim_card_pin
+        self.name = name or os.path.basename(modem_tty)
+        self._logger = logger.getChild(self.name)
 
-        self._last_cmd = b''
-        self._response_q = asyncio.Queue()
         self._urc_q = asyncio.Queue()
-        self._in_call = False
-        self._call_fwd_task = None
+        self._framer = AtResponseFramer(self._on_at_response, self._urc_q.put_nowait)
+        self._at = None
+        metrics.AT_QUEUE_DEPTH.set_function(lambda: self._at.qsize() if self._at else 0,
+                                            modem=self.name, queue='command')
+        metrics.AT_QUEUE_DEPTH.set_function(self._urc_q.qsize, modem=self.name, queue='urc')
+        # +CMTI/+CDSI, handled apart from the other URCs: reading stored messages waits for
+        # the SMS being sent, and calls shouldn't wait for that
+        self._sms_urc_q = asyncio.Queue()
+        metrics.AT_QUEUE_DEPTH.set_function(self._sms_urc_q.qsize, modem=self.name,
+                                            queue='sms_urc')
+        # Call forwarding tasks by +CLCC index
+        self._calls = {}
+        self._waiting_calls = set()
+        self._concat_sms = smspdu.ConcatReassembler()
         self._cur_csq = 0
+        self._operator_cache = OperatorCache(operator_cache)
+        self._reg_status = {}
+        self._registered = asyncio.Event()
+        self._registration_changed = asyncio.Event()
+        self.ready = asyncio.Event()
+        # URCs and stored SMS wait for this, so the modem can start before the Matrix side
+        self._forwarders_attached = asyncio.Event()
+        if call_forwarder and sms_forwarder:
+            self._forwarders_attached.set()
+
+    def attach_forwarders(self, call_forwarder, sms_forwarder, status_report_cb=None):
+        self._call_forwarder = call_forwarder
+        self._sms_forwarder = sms_forwarder
+        self._status_report_cb = status_report_cb
+        self._forwarders_attached.set()
 
     async def _reset_at(self):
         self._modem_w.write(b'\rATE\r')
@@ -70,62 +588,48 @@ class QuectelModemManager:
                 break
 
     async def _tty_rx_handler(self):
-        async def getline(timeout=None):
-            rx = await asyncio.wait_for(self._modem_r.readline(), timeout=timeout)
-            return rx.strip()
-
         while True:
-            line = await getline()
-
-            # If the line isn't the echo of _last_cmd, treat it as a URC
-            if not line.startswith(self._last_cmd) and line != b'':
-                await self._urc_q.put(line.decode())
-                continue
-
-            elif line == b'':
-                continue
-
-            # Treat the line as the start of the response to _last_cmd
-            lines = []
-            while True:
-                try:
-                    # Append lines until there is a short RX timeout, or OK/ERROR
-                    while True:
-                        lines.append(await getline(timeout=AT_SHORT_TIMEOUT))
-                        if lines[-1] in (b'OK', b'ERROR'):
-                            break
-                except asyncio.exceptions.TimeoutError:
-                    pass
-
-                # Try to send a new AT command to probe if last command finished
-                self._modem_w.write(b'AT\r')
-                line = await getline(timeout=AT_SHORT_TIMEOUT)
-
-                # If we got AT back, get the OK too and finish
-                if line == b'AT':
-                    line = await getline(timeout=AT_SHORT_TIMEOUT)
-                    if line == b'OK':
-                        break
-                    else:
-                        line.append(line)
-                else:
-                    # Otherwise, this line is part of the response. Continue
-                    lines.append(line)
-
-            await self._response_q.put((b'\n'.join(lines)).decode())
-
-
-    async def do_cmd(self, cmd, timeout=AT_LONG_TIMEOUT):
-        self._last_cmd = cmd.encode()
-        self._modem_w.write(b'%s\r' % (self._last_cmd,))
-        result = await asyncio.wait_for(self._response_q.get(), timeout=timeout)
-        logger.debug('%s -> %r' % (cmd, result))
+            data = await self._modem_r.read(AT_RX_CHUNK_SIZE)
+            if not data:
+                raise AtStateError('Modem TTY closed')
+            self._framer.feed(data)
+
+    def _on_at_response(self, response):
+        self._at.on_response(response)
+
+    async def do_cmd(self, cmd, timeout=AT_LONG_TIMEOUT, priority=None, data=None):
+        '''
+        Queues cmd on the AT port, and returns its response. The priority defaults to the
+        command's (see AT_PRIORITIES). data is written after the > prompt.
+        '''
+        if self._at is None:
+            raise AtStateError('Modem is not open')
+        result = await self._at.submit(cmd, timeout, priority, data)
+        self._logger.debug('%s -> %r' % (cmd, result))
         return result
 
     def verify_ok(self, result):
         if not result.endswith('OK'):
             raise AtCommandError(result)
 
+    async def send_sms_pdu(self, pdu, length):
+        '''
+        Sends one SMS-SUBMIT (see smspdu.encode_submit). Returns its message reference,
+        that its delivery report will carry.
+        '''
+        try:
+            result = await self.do_cmd('AT+CMGS=%d' % (length,), timeout=SMS_SEND_TIMEOUT,
+                                       data=pdu)
+        except AtTimeoutError as e:
+            # The network may still take it. Sending it again would then deliver it twice
+            result = await e.late_response
+            if result is None:
+                raise
+        m = re.match(r'^\+CMGS\:\ (\d+)', result)
+        if not m or not result.endswith('OK'):
+            raise AtCommandError(result)
+        return int(m.group(1))
+
     async def get_unlock_attempts(self):
         pin_counters = await self.do_cmd('AT+QPINC?')
         left, total = re.match(r'.*\"SC\",(\d+),(\d+)', pin_counters).groups()
@@ -150,52 +654,127 @@ class QuectelModemManager:
 
         signal, unk = m.groups()
         signal, unk = int(signal), int(unk)
+        metrics.MODEM_CSQ.set(signal, modem=self.name)
         if signal != self._cur_csq:
-            logger.info('CSQ changed! %d -> %d (%d)' % (self._cur_csq, signal, unk))
+            self._logger.info('CSQ changed! %d -> %d (%d)' % (self._cur_csq, signal, unk))
             self._cur_csq = signal
 
-    async def _wait_for_network(self, disregard_pref=False):
-        connected = False
-
-        for i in range(NETWORK_COPS_ATTEMPTS):
-            await asyncio.sleep(COPS_SLEEP)
-
-            cops = await self.do_cmd('AT+COPS?')
-            m = re.match(r'^\+COPS\:\ (\d+),(\d+),(.*?),(\d+)', cops)
-            await self._measure_csq()
-
-            if not m:
-                m = re.match(r'^\+COPS\:\ (\d+)', cops)
-                if not m:
-                    logger.warning('AT+COPS bad output: %r' % (cops, ))
-                    continue
-
-                status, = m.groups()
-                if int(status) == STATUS_REJECTED:
-                    logger.warning('AT+COPS got rejected status')
-                    break
-                continue
-
-            status, _, operator, net_type = m.groups()
-            status, net_type = int(status), int(net_type)
-            logger.info('Network: %s (%s), status: %s' % (
-                operator, NET_TYPES[net_type], status)
-            )
-
-            if disregard_pref or NET_TYPES[net_type] == self._preferred_network:
-                connected = True
-                break
-
-        return connected
+    def _handle_registration(self, line, query=False):
+        '''
+        Tracks the registration state from a +CREG/+CGREG/+CEREG URC (or a line of a query
+        response, which may also be a URC). Returns False if line isn't one.
+        '''
+        m = re.match(r'^\+(C|CG|CE)REG\:\ (.*)$', line)
+        if not m:
+            return False
+        cmd = m.group(1) + 'REG'
+        fields = m.group(2).split(',')
+        if query and len(fields) > 1 and fields[1].isdigit():
+            # Query responses start with the URC mode, then the status. Anything else (a
+            # status, then the quoted location) is a URC that came in during the query
+            fields = fields[1:]
+        if not fields or not fields[0].isdigit():
+            self._logger.warning('Bad %s: %r' % (cmd, line))
+            return True
+
+        status = int(fields[0])
+        if self._reg_status.get(cmd) != status:
+            act = int(fields[3]) if len(fields) > 3 and fields[3].isdigit() else None
+            self._logger.info('%s status: %d (%s)' % (cmd, status, NET_TYPES.get(act, act)))
+        self._reg_status[cmd] = status
+
+        if any(s in (REG_STATUS_HOME, REG_STATUS_ROAMING) for s in self._reg_status.values()):
+            self._registered.set()
+        else:
+            self._registered.clear()
+        self._registration_changed.set()
+        return True
+
+    async def _query_registration(self):
+        for cmd in REGISTRATION_CMDS:
+            result = await self.do_cmd('AT+%s?' % (cmd,))
+            for line in result.split('\n'):
+                self._handle_registration(line, query=True)
+
+    def _requeue_urcs(self, urcs):
+        '''
+        Puts URCs that were taken out of order back at the front of the URC queue
+        '''
+        while not self._urc_q.empty():
+            urcs.append(self._urc_q.get_nowait())
+        for urc in urcs:
+            self._urc_q.put_nowait(urc)
+
+    async def _next_registration_change(self, timeout):
+        '''
+        Waits for a registration URC, keeping other URCs queued. Returns False on timeout
+        '''
+        held = []
+        self._registration_changed.clear()
+        deadline = time.monotonic() + timeout
+        try:
+            while not self._registration_changed.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                try:
+                    urc = await asyncio.wait_for(self._urc_q.get(), timeout=remaining)
+                except asyncio.exceptions.TimeoutError:
+                    return False
+                if not self._handle_registration(urc):
+                    held.append(urc)
+            return True
+        finally:
+            self._requeue_urcs(held)
+
+    async def _current_network(self):
+        '''
+        Returns the (operator, net type) the modem is registered on, or None
+        '''
+        cops = await self.do_cmd('AT+COPS?')
+        await self._measure_csq()
+        m = re.match(r'^\+COPS\:\ (\d+),(\d+),(.*?),(\d+)', cops)
+        if not m:
+            return None
 
-    async def _network_selection(self):
-        logger.info('Waiting for network...')
-        if await self._wait_for_network():
-            logger.info('Auto-connected!')
-            return
+        status, _, operator, net_type = m.groups()
+        net_type = int(net_type)
+        self._logger.info('Network: %s (%s), status: %s' % (
+            operator, NET_TYPES[net_type], status)
+        )
+        for rat in NET_TYPES.values():
+            metrics.MODEM_RAT.set(int(rat == NET_TYPES[net_type]), modem=self.name, rat=rat)
+        return operator, net_type
 
+    async def _wait_for_network(self, disregard_pref=False):
+        '''
+        Waits until registered (on the preferred network type, unless disregard_pref).
+        Returns whether it did.
+        '''
+        deadline = time.monotonic() + REGISTRATION_TIMEOUT
+        while True:
+            if self._registered.is_set():
+                network = await self._current_network()
+                if network and (disregard_pref or
+                                NET_TYPES[network[1]] == self._preferred_network):
+                    self._operator_cache.set_last(*network)
+                    return True
+
+            elif self._reg_status and all(status == REG_STATUS_DENIED
+                                          for status in self._reg_status.values()):
+                self._logger.warning('Registration denied')
+                return False
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not await self._next_registration_change(remaining):
+                return False
+
+    async def _scan_networks(self):
+        '''
+        Returns [(long name, short name, number, net type)] of the available networks
+        '''
         self.verify_ok(await self.do_cmd('AT+COPS=2'))
-        logger.warning('Passive scanning available networks...')
+        self._logger.warning('Passive scanning available networks...')
 
         all_cops = await self.do_cmd('AT+COPS=?', timeout=COPS_PASSIVE_SCAN_TIMEOUT)
         m = re.match(r'^\+COPS\: \((.*)\)\,\,', all_cops)
@@ -205,49 +784,70 @@ class QuectelModemManager:
         if not nets:
             raise NetworkError('Empty network list: %r' % (all_cops, ))
 
-        logger.info('Available networks:')
-        net_dict = {t: [] for t in NET_TYPES.keys()}
-
+        self._logger.info('Available networks:')
+        networks = []
         for net in nets:
             status, long_name, short_name, number, net_type = net.split(',')
-            status, net_type = int(status), int(net_type)
-            logger.info('    %s (%s) (%s) type: %s' % (
+            net_type = int(net_type)
+            self._logger.info('    %s (%s) (%s) type: %s' % (
                 long_name, short_name, number, NET_TYPES[net_type]
             ))
-            net_dict[net_type].append((long_name, short_name, number))
+            networks.append((long_name, short_name, number, net_type))
+        return networks
+
+    async def _try_network(self, long_name, net_type, disregard_pref):
+        self._logger.info('Trying %s (%s)' % (long_name, NET_TYPES[net_type]))
+        cops = await self.do_cmd('AT+COPS=1,0,%s,%d' % (long_name, net_type),
+                                 timeout=MANUAL_COPS_WAIT_SECONDS)
+        await self._measure_csq()
+        if 'ERROR' in cops:
+            return False
+        return await self._wait_for_network(disregard_pref)
+
+    async def _try_networks(self, networks):
+        net_dict = {t: [] for t in NET_TYPES.keys()}
+        for long_name, _, _, net_type in networks:
+            net_dict[net_type].append(long_name)
 
-        connected = False
         disregard_pref = False
         preferred = {v: k for k, v in NET_TYPES.items()}[self._preferred_network]
         net_types_to_try = list(sorted(NET_TYPES.keys(), reverse=True))
         net_types_to_try.remove(preferred)
         net_types_to_try.insert(0, preferred)
 
-        while True:
-            if not net_types_to_try:
-                break
-
+        while net_types_to_try:
             cur_type = net_types_to_try[0]
             if not net_dict[cur_type]:
                 net_types_to_try.remove(cur_type)
                 disregard_pref = True
                 continue
 
-            long_name, _, _ = net_dict[cur_type].pop(0)
-            logger.info('Trying %s (%s)' % (long_name, NET_TYPES[cur_type]))
+            if await self._try_network(net_dict[cur_type].pop(0), cur_type, disregard_pref):
+                self._logger.info('Finally! Connected.')
+                return True
+        return False
 
-            cops = await self.do_cmd('AT+COPS=1,0,%s,%d' % (long_name, cur_type),
-                                     timeout=MANUAL_COPS_WAIT_SECONDS)
-            await self._measure_csq()
-            if 'ERROR' in cops:
-                continue
+    async def _network_selection(self):
+        self._logger.info('Waiting for network...')
+        await self._query_registration()
+        if await self._wait_for_network():
+            self._logger.info('Auto-connected!')
+            return
 
-            if await self._wait_for_network(disregard_pref):
-                logger.info('Finally! Connected.')
-                connected = True
-                break
+        last = self._operator_cache.last
+        if last and await self._try_network(*last, disregard_pref=True):
+            self._logger.info('Connected to the last used network')
+            return
 
-        if not connected:
+        networks = self._operator_cache.networks
+        if networks:
+            self._logger.info('Trying networks from the last scan')
+            if await self._try_networks(networks):
+                return
+
+        networks = await self._scan_networks()
+        self._operator_cache.set_networks(networks)
+        if not await self._try_networks(networks):
             raise NetworkError('Failed connecting to all networks')
 
     async def _cfun_restart(self):
@@ -256,9 +856,12 @@ class QuectelModemManager:
 
         while True:
             urc = await asyncio.wait_for(self._urc_q.get(), timeout=AT_LONG_TIMEOUT)
-            logger.info('URC -> %r' % (urc,))
+            self._logger.info('URC -> %r' % (urc,))
+
+            if self._handle_registration(urc):
+                continue
 
-            if '+CPIN: SIM PIN' in urc:
+            elif '+CPIN: SIM PIN' in urc:
                 if not self.sim_card_pin:
                     raise AtStateError('SIM unlock needed but no PIN setup')
 
@@ -278,115 +881,271 @@ class QuectelModemManager:
 
         scanmode = SCANMODE_FOR_NET_TYPE[self._preferred_network]
         self.verify_ok(await self.do_cmd('AT+QCFG="nwscanmode",%d' % (scanmode, )))
+        # Registration URCs, with the access technology
+        for cmd in REGISTRATION_CMDS:
+            self.verify_ok(await self.do_cmd('AT+%s=2' % (cmd,)))
 
         await self._cfun_restart()
-        self.verify_ok(await self.do_cmd('AT+CMGF=1'))
+        self.verify_ok(await self.do_cmd('AT+CMGF=0'))
         self.verify_ok(await self.do_cmd('AT+CPMS="ME","ME","ME"'))
+        # New messages and delivery reports are stored, and indicated with +CMTI/+CDSI
+        self.verify_ok(await self.do_cmd('AT+CNMI=2,1,0,2,0'))
+        # Present +CCWA for calls that come in while another one is active
+        self.verify_ok(await self.do_cmd('AT+CCWA=1'))
 
         await self._network_selection()
         return retval
 
-    async def _handle_call(self):
+    async def _list_calls(self):
+        '''
+        Returns {index: (dir, state, mode, number)} of the current calls
+        '''
         result = await self.do_cmd('AT+CLCC')
+        calls = {}
 
         for call in [c for c in result.split('\n') if c.startswith('+CLCC')]:
-            call = call[len('+CLCC: '):]
-            idx, dir, state, mode, multiparty, number, type = call.split(',')
-            # Make sure it's a Voice call, Mobile Terminated and Incoming state
-            if mode == '0' and dir == '1' and state == '4':
-                break
-        else:
-            logger.warning('Tried to handle a bad call: %r' % ((mode, dir, state, number),))
-            return
+            idx, dir, state, mode, multiparty, number = call[len('+CLCC: '):].split(',')[:6]
+            calls[int(idx)] = (dir, state, mode, number.replace('"', ''))
+        return calls
+
+    async def _handle_calls(self, ring_time, calls=None):
+        if calls is None:
+            calls = await self._list_calls()
+
+        for idx, (dir, state, mode, number) in calls.items():
+            # Only Voice calls, Mobile Terminated, that we aren't handling already
+            if idx in self._calls or mode != CLCC_MODE_VOICE or dir != CLCC_DIR_MT:
+                continue
+
+            if state == CLCC_STATE_INCOMING:
+                self._waiting_calls.discard(idx)
+                self._start_call(idx, number, ring_time)
+
+            elif state == CLCC_STATE_WAITING and idx not in self._waiting_calls:
+                # Forwarded once the active call ends, and it turns into an incoming call
+                self._waiting_calls.add(idx)
+                self._logger.info('Call waiting #%d, number: %s' % (idx, number))
+                await self._sms_forwarder('Call waiting from GSM %s' % (number,)).send()
 
-        self._in_call = True
-        number = number.replace('"', '')
-        logger.info('Got call! #%s, number: %s, type: %s' % (idx, number, type))
+    async def _handle_hangup(self):
+        calls = await self._list_calls()
+        self._waiting_calls &= set(calls)
+
+        for idx in [idx for idx in self._calls if idx not in calls]:
+            self._logger.info('Got GSM hangup of call #%d. Cancelling call task!' % (idx,))
+            self._calls.pop(idx).cancel()
+
+        # A waiting call becomes incoming when the active one ends
+        await self._handle_calls(time.monotonic(), calls)
+
+    def _start_call(self, idx, number, ring_time):
+        self._logger.info('Got call! #%d, number: %s' % (idx, number))
 
         async def call_ended_cb():
-            self._in_call = False
-            self._call_fwd_task = None
-            logger.info('Call disconnected. Sending ATH0!')
-            self.verify_ok(await self.do_cmd('ATH0'))
+            if self._calls.pop(idx, None) is None:
+                # Already gone on the GSM side
+                return
+            if self._calls or self._waiting_calls:
+                self._logger.info('Call #%d disconnected. Releasing it!' % (idx,))
+                self.verify_ok(await self.do_cmd('AT+CHLD=1%d' % (idx,)))
+            else:
+                self._logger.info('Call disconnected. Sending ATH0!')
+                self.verify_ok(await self.do_cmd('ATH0'))
 
         async def call_connected_cb():
-            logger.info('Call connected. Sending ATA!')
+            self._logger.info('Call #%d connected. Sending ATA!' % (idx,))
             self.verify_ok(await self.do_cmd('ATA'))
 
-        self._call_fwd_task = self._call_forwarder(
-            'GSM %s' % (number,), call_connected_cb, call_ended_cb
+        self._calls[idx] = self._call_forwarder(
+            'GSM %s' % (number,), call_connected_cb, call_ended_cb, ring_time=ring_time
         ).run()
 
-    async def _handle_sms(self):
-        result = await self.do_cmd('AT+CMGL')
-        self.verify_ok(result)
-        msg_lines = [s for s in result.split('\n') if s]
-        out = []
-        orig_hex = []
-
-        head_match = re.match(r'^\+CMGL\:\ (.*?),(.*?),(.*?),(.*?),(.*?),(.*?)$',
-                              msg_lines[0])
-        if head_match:
-            head = head_match.groups()
-            head = (s.replace('"', '') for s in head)
-            _, _, number, _, date, time = head
-            out.append('SMS from %s (at %s, %s)' % (number, date, time))
+    async def _forward_sms(self, msg):
+        await self._sms_forwarder('SMS from %s (at %s)\n%s' % (
+            msg.sender, msg.timestamp.strftime('%Y-%m-%d %H:%M:%S %z'), msg.text
+        )).send()
 
+    async def _process_status_report(self, idx, pdu):
+        try:
+            report = smspdu.decode_status_report(pdu)
+        except smspdu.SmsPduError as e:
+            self._logger.warning('Undecodable delivery report #%d: %s' % (idx, e))
         else:
-            out.append(msg_lines[0])
-
-        if len(msg_lines) > 1:
-            for line in msg_lines[1:]:
-                if line == 'OK':
-                    continue
+            self._logger.info('Delivery report #%d: message %d to %s, status %d' % (
+                idx, report.reference, report.recipient, report.status
+            ))
+            if self._status_report_cb:
+                self._status_report_cb(report)
+
+    async def _delete_sms(self, indexes):
+        for idx in indexes:
+            self.verify_ok(await self.do_cmd('AT+CMGD=%d' % (idx,),
+                                             timeout=SMS_STORAGE_TIMEOUT))
+
+    async def _process_sms_pdu(self, idx, pdu):
+        try:
+            if smspdu.pdu_type(pdu) == smspdu.MTI_STATUS_REPORT:
+                await self._process_status_report(idx, pdu)
+                await self._delete_sms([idx])
+                return
+            complete = self._concat_sms.add(smspdu.decode_deliver(pdu), idx)
+        except smspdu.SmsPduError as e:
+            self._logger.warning('Undecodable SMS #%d: %s' % (idx, e))
+            await self._sms_forwarder('Undecodable SMS (PDU: %s)' % (pdu,)).send()
+            await self._delete_sms([idx])
+            return
 
-                if re.match(r'^[0-9a-fA-F]+$', line) and len(line) % 2 == 0:
-                    decoded = bytes.fromhex(line).decode('utf-16-be')
-                    out.append(decoded)
-                    orig_hex.append(line)
+        if not complete:
+            # Kept in storage until the whole message is forwarded, so that a restart
+            # reads it again (with AT+CMGL) instead of losing it
+            self._logger.info('SMS #%d is a part of a concatenated message' % (idx,))
+            return
+        msg, indexes = complete
+        await self._forward_sms(msg)
+        await self._delete_sms(indexes)
+
+    async def _handle_sms(self, urc):
+        '''
+        Handles a stored message or delivery report (+CMTI/+CDSI)
+        '''
+        m = re.match(r'^\+(?:CMTI|CDSI)\:\ "(.*?)",(\d+)', urc)
+        if not m:
+            self._logger.warning('Bad +CMTI/+CDSI: %r' % (urc,))
+            return
+        idx = int(m.groups()[1])
 
-                else:
-                    out.append(line)
+        result = await self.do_cmd('AT+CMGR=%d' % (idx,), timeout=SMS_STORAGE_TIMEOUT)
+        if result == CMS_ERROR_INVALID_INDEX:
+            # Already forwarded from storage, while this URC was held
+            self._logger.info('SMS #%d was already handled' % (idx,))
+            return
+        self.verify_ok(result)
+        lines = result.split('\n')
+        if len(lines) < 3 or not lines[0].startswith('+CMGR:'):
+            self._logger.warning('SMS #%d is gone: %r' % (idx, result))
+            return
+        await self._process_sms_pdu(idx, lines[1])
+
+    async def _handle_stored_sms(self):
+        '''
+        Forwards (and deletes) the messages that arrived while we were not running, and
+        picks up the stored parts of incomplete concatenated messages
+        '''
+        result = await self.do_cmd('AT+CMGL=%d' % (CMGL_ALL,), timeout=SMS_STORAGE_TIMEOUT)
+        self.verify_ok(result)
+        lines = result.split('\n')
 
-        if orig_hex:
-            out.append('(hex: %s)' % (' '.join(orig_hex),))
+        for header, pdu in zip(lines, lines[1:]):
+            m = re.match(r'^\+CMGL\:\ (\d+),', header)
+            if m:
+                await self._process_sms_pdu(int(m.groups()[0]), pdu)
 
-        await self._sms_forwarder('\n'.join(out)).send()
-        self.verify_ok(await self.do_cmd('AT+CMGD=1,1'))
+    async def _sms_evictor(self):
+        while True:
+            await asyncio.sleep(CONCAT_EVICT_INTERVAL)
+            for msg, indexes in self._concat_sms.evict_expired():
+                self._logger.warning('Giving up on the missing parts of an SMS from %s' % (
+                    msg.sender,
+                ))
+                await self._forward_sms(msg)
+                await self._delete_sms(indexes)
 
     async def _urc_handler(self):
         while True:
             urc = await self._urc_q.get()
-            logger.info('URC -> %r' % (urc,))
+            self._logger.info('URC -> %r' % (urc,))
+            urc_type = next((p.rstrip(':') for p in URC_PREFIXES if urc.startswith(p)), 'other')
+            metrics.URCS.inc(modem=self.name, type=urc_type)
 
-            if 'RING' == urc and not self._in_call:
-                await self._handle_call()
+            if '+CPIN: NOT READY' in urc:
+                raise AtStateError(urc)
+            if '+CMTI:' in urc or '+CDSI:' in urc:
+                self._sms_urc_q.put_nowait(urc)
+            else:
+                await self._try_urc(self._handle_urc, urc)
 
-            if 'NO CARRIER' in urc and self._in_call:
-                logger.info('Got GSM hangup. Cancelling call task!')
-                self._call_fwd_task.cancel()
+    async def _sms_urc_handler(self):
+        while True:
+            await self._try_urc(self._handle_sms, await self._sms_urc_q.get())
 
-            elif '+CMTI:' in urc:
-                await self._handle_sms()
+    async def _try_urc(self, handler, urc):
+        try:
+            await handler(urc)
+        except (AtCommandError, AtStateError, asyncio.TimeoutError) as e:
+            # One failed command doesn't take the modem down: RING repeats, and stored
+            # SMS are picked up again at the next start
+            self._logger.warning('Handling %r failed: %r' % (urc, e))
 
-            elif '+CPIN: NOT READY' in urc:
-                raise AtStateError(urc)
+    async def _handle_urc(self, urc):
+        if 'RING' == urc or urc.startswith('+CCWA:'):
+            await self._handle_calls(time.monotonic())
 
-            else:
-                logger.warning('Uhandled URC: %r' % (urc,))
+        elif 'NO CARRIER' in urc:
+            await self._handle_hangup()
+
+        elif self._handle_registration(urc):
+            if not self._registered.is_set():
+                self._logger.warning('Lost network registration')
+
+        else:
+            self._logger.warning('Uhandled URC: %r' % (urc,))
+
+    def _end_calls(self):
+        '''
+        Hangs up the Matrix side of the forwarded calls, when the modem goes away
+        '''
+        for idx in list(self._calls):
+            self._logger.info('Lost the modem. Cancelling call task #%d!' % (idx,))
+            self._calls.pop(idx).cancel()
+        self._waiting_calls.clear()
+
+    async def _open(self):
+        # Nothing of a previous run carries over: a partial response, queued commands and
+        # URCs, the registration state
+        self._framer = AtResponseFramer(self._on_at_response, self._urc_q.put_nowait)
+        for queue in (self._urc_q, self._sms_urc_q):
+            while not queue.empty():
+                queue.get_nowait()
+        self._reg_status = {}
+        self._registered.clear()
+        self._registration_changed.clear()
 
-    async def run(self):
         self._modem_r, self._modem_w = await serial_asyncio.open_serial_connection(
             url=self._modem_tty, baudrate=self._modem_baud
         )
+        self._at = AtScheduler(self._modem_w.write, self._framer, self.name)
 
         await self._reset_at()
-        rx_task = asyncio.create_task(self._tty_rx_handler())
-
-        logger.info('Got AT shell to modem. Resetting')
-        if not await self._reset():
-            return
-
-        urc_task = asyncio.create_task(self._urc_handler())
-        await asyncio.gather(rx_task, urc_task)
+        return asyncio.create_task(self._tty_rx_handler())
 
+    async def run(self):
+        '''
+        Runs the modem until it fails. Can be called again after that, to re-open it.
+        '''
+        self.ready.clear()
+        tasks = []
+        try:
+            tasks.append(await self._open())
+            self._logger.info('Got AT shell to modem. Resetting')
+            if not await self._reset():
+                return
+            self.ready.set()
+            if not self._forwarders_attached.is_set():
+                self._logger.info('Modem ready, holding URCs until forwarding is set up')
+                await self._forwarders_attached.wait()
+            await self._handle_stored_sms()
+
+            tasks.append(asyncio.create_task(self._urc_handler()))
+            tasks.append(asyncio.create_task(self._sms_urc_handler()))
+            tasks.append(asyncio.create_task(self._sms_evictor()))
+            await asyncio.gather(*tasks)
+        finally:
+            self.ready.clear()
+            for task in tasks:
+                task.cancel()
+            self._end_calls()
+            if self._at:
+                self._at.close()
+            if self._modem_w:
+                self._modem_w.close()
+                self._modem_r = self._modem_w = None
@@ -0,0 +1,330 @@
+'''
+Adapts the Opus encoding of the call audio sent to the Matrix side to the network, from
+the receiver reports of the peer (loss, jitter, round trip time in getStats())
+'''
+import math
+import asyncio
+import fractions
+import logging
+import contextlib
+import contextvars
+import collections
+
+import aiortc.rtcrtpsender
+from av import AudioFifo, AudioResampler, CodecContext
+from av.codec import Codec
+from aiortc.codecs.base import Encoder
+from aiortc.stats import RTCRemoteInboundRtpStreamStats
+
+import metrics
+
+
+RATE_CONTROL_INTERVAL = 1
+# Opus RTP is always 48 kHz (RFC 7587)
+SAMPLE_RATE = 48000
+TIME_BASE = fractions.Fraction(1, SAMPLE_RATE)
+# Speech, and narrowband at that: 32 kbit/s is as good as it gets
+OPUS_MIN_BITRATE = 12000
+OPUS_MAX_BITRATE = 32000
+OPUS_FRAME_MS = (20, 40, 60)
+# Weight of the newest report's loss in the smoothed loss (a report covers a second or
+# so, a few dozen packets)
+LOSS_SMOOTHING = 0.5
+# Loss (fraction of packets) at which in-band FEC is turned on, and below which it is off
+FEC_ON_LOSS = 0.02
+FEC_OFF_LOSS = 0.005
+# The expected loss libopus protects against, in steps of this many percent
+PACKET_LOSS_STEP = 5
+PACKET_LOSS_MAX = 30
+# Signs of congestion: more loss than FEC is worth it for, the round trip time growing
+# over the lowest seen (queueing), or jitter (in seconds)
+CONGESTION_LOSS = 0.10
+CONGESTION_DELAY = 0.15
+CONGESTION_JITTER = 0.06
+BITRATE_DECREASE = 0.7
+BITRATE_INCREASE = 4000
+# Clean intervals before each step back up
+RECOVERY_INTERVALS = 5
+
+# The rate controller whose encoder audio senders started in the current context use
+RATE_CONTROLLER = contextvars.ContextVar('rate_controller', default=None)
+
+logger = logging.getLogger('RateControl')
+
+OpusSettings = collections.namedtuple('OpusSettings', 'bitrate frame_ms fec packet_loss')
+
+
+def parse_bitrates(spec):
+    '''
+    Parses "12000-32000", or "24000" for a fixed bitrate
+    '''
+    low, _, high = str(spec).partition('-')
+    low, high = int(low), int(high or low)
+    if not 6000 <= low <= high <= 510000:
+        raise ValueError('Bad Opus bitrate range %r (6000-510000 bit/s)' % (spec,))
+    return low, high
+
+
+def libopus_has_fec():
+    '''
+    Whether libav's libopus encoder takes the fec option, which older FFmpeg doesn't have.
+    PyAV versions that don't list codec options need a newer FFmpeg anyway.
+    '''
+    descriptor = getattr(Codec('libopus', 'w'), 'descriptor', None)
+    if descriptor is None:
+        return True
+    return any(option.name == 'fec' for option in descriptor.options)
+
+
+def format_settings(settings):
+    return '%d bit/s, %d ms frames, FEC %s' % (
+        settings.bitrate, settings.frame_ms,
+        'for %d%% loss' % (settings.packet_loss,) if settings.fec else 'off'
+    )
+
+
+class AdaptiveOpusEncoder(Encoder):
+    '''
+    An Opus encoder for aiortc (libav's libopus, whichever encoder the installed aiortc
+    has) whose settings can be changed during the call. PyAV doesn't expose
+    opus_encoder_ctl, so a change re-opens libopus with the new settings between two
+    packets. The audio is framed by a FIFO so no samples are dropped when the frame size
+    changes.
+    '''
+    def __init__(self, settings):
+        self._resampler = AudioResampler(format='s16', layout='stereo', rate=SAMPLE_RATE)
+        self._fifo = AudioFifo()
+        self._codec = None
+        # Set from the event loop, applied by encode() in the executor
+        self.settings = settings
+        self._applied = None
+        self._first_pts = None
+        self._timestamp = 0
+
+    def _open(self, settings):
+        if self._codec is not None:
+            # Drains the old encoder (its lookahead, a few ms, is lost with the change)
+            self._codec.encode(None)
+        codec = CodecContext.create('libopus', 'w')
+        codec.bit_rate = settings.bitrate
+        codec.format = 's16'
+        codec.layout = 'stereo'
+        options = {
+            'application': 'voip',
+            'frame_duration': str(settings.frame_ms),
+            'packet_loss': str(settings.packet_loss),
+        }
+        # Left out when off, for libav builds without it
+        if settings.fec:
+            options['fec'] = '1'
+        codec.options = options
+        codec.sample_rate = SAMPLE_RATE
+        codec.time_base = TIME_BASE
+        self._codec = codec
+        self._applied = settings
+
+    def encode(self, frame, force_keyframe=False):
+        # Only with less than a packet buffered, so the next call still gives one packet
+        # (a smaller frame size would give several, and they'd share the RTP timestamp)
+        settings = self.settings
+        if settings != self._applied and self._fifo.samples < SAMPLE_RATE * OPUS_FRAME_MS[0] // 1000:
+            self._open(settings)
+
+        for resampled in self._resampler.resample(frame):
+            self._fifo.write(resampled)
+        packets = []
+        frame_samples = SAMPLE_RATE * self._applied.frame_ms // 1000
+        while True:
+            chunk = self._fifo.read(frame_samples)
+            if chunk is None:
+                break
+            packets += self._codec.encode(chunk)
+
+        # Calls that give no packet (buffering, or between two longer frames) still return
+        # a timestamp: older aiortc senders do arithmetic on it whatever the payloads
+        if not packets:
+            return [], self._timestamp
+        # libopus starts at a negative pts (its lookahead), which every codec it is
+        # re-opened as shares
+        if self._first_pts is None:
+            self._first_pts = packets[0].pts
+        self._timestamp = packets[0].pts - self._first_pts
+        return [bytes(packet) for packet in packets], self._timestamp
+
+    def pack(self, packet):
+        # Already encoded Opus (not from the gateway's tracks)
+        return [bytes(packet)], int(packet.pts * packet.time_base / TIME_BASE)
+
+
+class OpusRateControl:
+    '''
+    The bounds the Opus encoding of calls is adapted within. Each call gets its own
+    RateController.
+    '''
+    def __init__(self, min_bitrate=OPUS_MIN_BITRATE, max_bitrate=OPUS_MAX_BITRATE,
+                 max_frame_ms=OPUS_FRAME_MS[-1], interval=RATE_CONTROL_INTERVAL):
+        if max_frame_ms not in OPUS_FRAME_MS:
+            raise ValueError('Opus frames are %s ms' % (', '.join(map(str, OPUS_FRAME_MS)),))
+        self.min_bitrate = min_bitrate
+        self.max_bitrate = max_bitrate
+        self.frame_sizes = [ms for ms in OPUS_FRAME_MS if ms <= max_frame_ms]
+        self.interval = interval
+        self.fec = libopus_has_fec()
+        if not self.fec:
+            logger.warning('libav\'s libopus encoder has no fec option: the rate control '
+                           'adapts the bitrate and frame size only')
+
+    def controller(self, name, call_id):
+        return RateController(self, name, call_id)
+
+
+class RateController:
+    '''
+    Adapts the Opus encoder of one call to the receiver reports of the peer, every
+    interval:
+    - loss turns on in-band FEC, tuned to the loss
+    - congestion (heavy loss, growing round trip time or jitter) lowers the bitrate,
+      then (at the lowest bitrate) lengthens the frames to save packet headers
+    - a few clean intervals in a row undo one step, shorter frames first
+    '''
+    def __init__(self, limits, name, call_id):
+        self._limits = limits
+        self._name = name
+        self._call_id = call_id
+        self.settings = OpusSettings(limits.max_bitrate, limits.frame_sizes[0], False, 0)
+        self.encoder = None
+        self._loss = None
+        self._min_rtt = None
+        self._report_time = None
+        self._clean_intervals = 0
+
+    def encoder_for(self, codec):
+        self.encoder = AdaptiveOpusEncoder(self.settings)
+        return self.encoder
+
+    def _next_settings(self, loss, jitter, rtt):
+        settings = self.settings
+        limits = self._limits
+
+        if loss >= FEC_ON_LOSS:
+            settings = settings._replace(fec=limits.fec, packet_loss=min(
+                PACKET_LOSS_STEP * math.ceil(loss * 100 / PACKET_LOSS_STEP), PACKET_LOSS_MAX
+            ))
+        elif loss < FEC_OFF_LOSS:
+            settings = settings._replace(fec=False, packet_loss=0)
+
+        if rtt is not None:
+            self._min_rtt = rtt if self._min_rtt is None else min(self._min_rtt, rtt)
+        if (loss >= CONGESTION_LOSS or jitter >= CONGESTION_JITTER or
+                (rtt is not None and rtt - self._min_rtt >= CONGESTION_DELAY)):
+            self._clean_intervals = 0
+            frame_index = limits.frame_sizes.index(settings.frame_ms)
+            if settings.bitrate > limits.min_bitrate:
+                settings = settings._replace(bitrate=max(
+                    limits.min_bitrate, int(settings.bitrate * BITRATE_DECREASE)
+                ))
+            elif frame_index + 1 < len(limits.frame_sizes):
+                settings = settings._replace(frame_ms=limits.frame_sizes[frame_index + 1])
+        elif loss < FEC_ON_LOSS:
+            self._clean_intervals += 1
+            if self._clean_intervals >= RECOVERY_INTERVALS:
+                self._clean_intervals = 0
+                frame_index = limits.frame_sizes.index(settings.frame_ms)
+                if frame_index > 0:
+                    settings = settings._replace(frame_ms=limits.frame_sizes[frame_index - 1])
+                elif settings.bitrate < limits.max_bitrate:
+                    settings = settings._replace(bitrate=min(
+                        limits.max_bitrate, settings.bitrate + BITRATE_INCREASE
+                    ))
+        return settings
+
+    def _count_changes(self, old, new):
+        if new.bitrate != old.bitrate:
+            metrics.RATE_CONTROL_CHANGES.inc(
+                change='bitrate_down' if new.bitrate < old.bitrate else 'bitrate_up'
+            )
+        if new.frame_ms != old.frame_ms:
+            metrics.RATE_CONTROL_CHANGES.inc(
+                change='frame_up' if new.frame_ms > old.frame_ms else 'frame_down'
+            )
+        if new.fec != old.fec:
+            metrics.RATE_CONTROL_CHANGES.inc(change='fec_on' if new.fec else 'fec_off')
+
+    def _export(self):
+        for setting, value in self.settings._asdict().items():
+            metrics.CALL_OPUS.set(int(value), room=self._name, call_id=self._call_id,
+                                  setting=setting)
+
+    def _sample(self, stats):
+        for report in stats.values():
+            if (isinstance(report, RTCRemoteInboundRtpStreamStats) and
+                    report.timestamp != self._report_time):
+                self._report_time = report.timestamp
+                # fractionLost is the RTCP one, in 256ths
+                return report.fractionLost / 256, report.jitter / SAMPLE_RATE, report.roundTripTime
+        return None
+
+    def _decide(self, stats):
+        sample = self._sample(stats)
+        if sample is None:
+            return
+        loss, jitter, rtt = sample
+        if self._loss is not None:
+            loss = LOSS_SMOOTHING * loss + (1 - LOSS_SMOOTHING) * self._loss
+        self._loss = loss
+        settings = self._next_settings(loss, jitter, rtt)
+        if settings == self.settings:
+            return
+        logger.info('Rate control %s: loss %.1f%%, jitter %.0f ms, RTT %s -> %s' % (
+            self._name, loss * 100, jitter * 1000,
+            '%.0f ms' % (rtt * 1000,) if rtt is not None else 'unknown',
+            format_settings(settings)
+        ))
+        self._count_changes(self.settings, settings)
+        self.settings = self.encoder.settings = settings
+
+    async def run(self, pc):
+        '''
+        Adapts the encoder to the peer's receiver reports, until cancelled
+        '''
+        try:
+            while True:
+                await asyncio.sleep(self._limits.interval)
+                # Not Opus, or no audio sent yet
+                if self.encoder is not None:
+                    self._decide(await pc.getStats())
+                    self._export()
+        finally:
+            for setting in OpusSettings._fields:
+                metrics.CALL_OPUS.remove(room=self._name, call_id=self._call_id,
+                                         setting=setting)
+
+
+@contextlib.contextmanager
+def encoding_with(controller):
+    '''
+    Audio senders of peer connections connecting inside this block (that is, in
+    setRemoteDescription and addIceCandidate) encode Opus with the controller's encoder.
+    No effect if controller is None.
+    '''
+    token = RATE_CONTROLLER.set(controller)
+    try:
+        yield
+    finally:
+        RATE_CONTROLLER.reset(token)
+
+
+_get_encoder = aiortc.rtcrtpsender.get_encoder
+
+
+def _get_controlled_encoder(codec):
+    '''
+    Stands in for aiortc.rtcrtpsender.get_encoder (see RTCRtpSender._next_encoded_frame)
+    '''
+    controller = RATE_CONTROLLER.get()
+    if controller is not None and codec.mimeType.lower() == 'audio/opus':
+        return controller.encoder_for(codec)
+    return _get_encoder(codec)
+
+
+aiortc.rtcrtpsender.get_encoder = _get_controlled_encoder
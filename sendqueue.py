@@ -0,0 +1,124 @@
+import json
+import time
+import uuid
+import asyncio
+import logging
+import sqlite3
+
+from nio import RoomSendResponse
+
+import metrics
+
+
+# Rooms sent to at once. Sends to one room are always one at a time
+SEND_CONCURRENCY = 4
+# Rooms whose next send is looked up in one pass over the journal
+SEND_ROOMS_PER_PASS = 32
+SEND_BACKOFF_MIN = 1
+SEND_BACKOFF_MAX = 5 * 60
+
+logger = logging.getLogger('SendQueue')
+
+
+class MatrixSendQueue:
+    '''
+    Durable outbound queue for room messages. send() journals the message to disk and
+    returns right away, and a background task delivers the journal to the homeserver.
+    Each room's messages are sent one at a time, in order: the homeserver orders a room's
+    events by when their requests arrive, so two sends in flight to the same room could
+    swap. Up to concurrency rooms are sent to at once. Failed sends are retried with
+    exponential backoff, per room, holding back the rest of the room. The transaction ID
+    is journaled with the message, so retrying after an unknown outcome (or a restart)
+    doesn't duplicate it.
+    '''
+    def __init__(self, matrix_client, path, concurrency=SEND_CONCURRENCY):
+        self._matrix_client = matrix_client
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, room TEXT NOT NULL, type TEXT NOT NULL, '
+            'content TEXT NOT NULL, txn_id TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)'
+        )
+        self._db.commit()
+        self._concurrency = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        # Rooms with a send in flight, and rooms backing off until a (monotonic) time
+        self._busy_rooms = set()
+        self._retry_at = {}
+        metrics.SEND_QUEUE_PENDING.set_function(self.pending)
+
+        pending = self.pending()
+        if pending:
+            logger.info('Replaying %d pending sends from %s' % (pending, path))
+            self._wakeup.set()
+
+    def pending(self):
+        return self._db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+    def send(self, room, message_type, content):
+        self._db.execute(
+            'INSERT INTO outbox (room, type, content, txn_id) VALUES (?, ?, ?, ?)',
+            (room, message_type, json.dumps(content), str(uuid.uuid4()))
+        )
+        self._db.commit()
+        self._wakeup.set()
+
+    def _next_sends(self):
+        '''
+        Returns the oldest pending send of each room that isn't busy or backing off
+        '''
+        now = time.monotonic()
+        rows = self._db.execute(
+            'SELECT id, room, type, content, txn_id, attempts FROM outbox '
+            'WHERE id IN (SELECT MIN(id) FROM outbox GROUP BY room) ORDER BY id LIMIT ?',
+            (SEND_ROOMS_PER_PASS,)
+        ).fetchall()
+        return [row for row in rows
+                if row[1] not in self._busy_rooms and self._retry_at.get(row[1], 0) <= now]
+
+    async def _deliver(self, row):
+        msg_id, room, message_type, content, txn_id, attempts = row
+        try:
+            async with self._concurrency:
+                start = time.monotonic()
+                res = None
+                try:
+                    res = await self._matrix_client.room_send(
+                        room, message_type, json.loads(content), tx_id=txn_id,
+                        ignore_unverified_devices=True
+                    )
+                finally:
+                    metrics.ROOM_SEND_SECONDS.observe(
+                        time.monotonic() - start, type=message_type,
+                        result='ok' if isinstance(res, RoomSendResponse) else 'error'
+                    )
+            if not isinstance(res, RoomSendResponse):
+                raise RuntimeError(res)
+
+        except Exception as e:
+            attempts += 1
+            backoff = min(SEND_BACKOFF_MAX, SEND_BACKOFF_MIN * 2 ** (attempts - 1))
+            logger.warning('Send to %s failed (attempt %d), retrying in %ds: %r' % (
+                room, attempts, backoff, e
+            ))
+            self._retry_at[room] = time.monotonic() + backoff
+            self._db.execute('UPDATE outbox SET attempts = ? WHERE id = ?', (attempts, msg_id))
+            asyncio.get_running_loop().call_later(backoff, self._wakeup.set)
+
+        else:
+            self._retry_at.pop(room, None)
+            self._db.execute('DELETE FROM outbox WHERE id = ?', (msg_id,))
+
+        finally:
+            self._db.commit()
+            self._busy_rooms.discard(room)
+            self._wakeup.set()
+
+    async def run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            for row in self._next_sends():
+                self._busy_rooms.add(row[1])
+                asyncio.create_task(self._deliver(row))
@@ -0,0 +1,448 @@
+import time
+import datetime
+import collections
+
+
+GSM7_BASIC = (
+    '@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+    '¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà'
+)
+GSM7_EXTENSION = {
+    0x0A: '\f', 0x14: '^', 0x28: '{', 0x29: '}', 0x2F: '\\', 0x3C: '[', 0x3D: '~',
+    0x3E: ']', 0x40: '|', 0x65: '€',
+}
+GSM7_ESCAPE = 0x1B
+GSM7_ENCODE = {char: (septet,) for septet, char in enumerate(GSM7_BASIC) if septet != GSM7_ESCAPE}
+GSM7_ENCODE.update({char: (GSM7_ESCAPE, septet) for septet, char in GSM7_EXTENSION.items()})
+
+ALPHABET_GSM7 = 0
+ALPHABET_8BIT = 1
+ALPHABET_UCS2 = 2
+
+MTI_DELIVER = 0
+MTI_SUBMIT = 1
+MTI_STATUS_REPORT = 2
+FIRST_OCTET_MMS = 0x04
+FIRST_OCTET_VPF_RELATIVE = 0x10
+FIRST_OCTET_VPF_MASK = 0x18
+FIRST_OCTET_SRR = 0x20
+FIRST_OCTET_UDHI = 0x40
+# Relative validity period of the messages we send: 0xA7 is 24 hours
+VALIDITY_PERIOD_24H = 0xA7
+# TP-Status of a status report: below this the message was delivered, below
+# STATUS_PERMANENT_ERROR the service center is still trying
+STATUS_TEMPORARY_ERROR = 0x20
+STATUS_PERMANENT_ERROR = 0x40
+ADDR_TYPE_INTERNATIONAL = 0x91
+ADDR_TYPE_UNKNOWN = 0x81
+ADDR_TON_MASK = 0x70
+ADDR_TON_INTERNATIONAL = 0x10
+ADDR_TON_ALPHANUMERIC = 0x50
+IEI_CONCAT_8BIT = 0x00
+IEI_CONCAT_16BIT = 0x08
+
+# Maximum user data per single / concatenated segment, in characters (septets or octets)
+SEGMENT_LIMITS = {
+    ALPHABET_GSM7: (160, 153),
+    ALPHABET_8BIT: (140, 134),
+    ALPHABET_UCS2: (70, 67),
+}
+CONCAT_TIMEOUT = 5 * 60
+
+SmsMessage = collections.namedtuple('SmsMessage', 'sender timestamp text concat')
+SmsMessage.__doc__ = '''
+A decoded SMS-DELIVER. concat is (reference, total, sequence) for one part of a
+concatenated message, or None
+'''
+SmsSubmit = collections.namedtuple('SmsSubmit', 'recipient text concat status_report')
+SmsSubmit.__doc__ = '''
+A decoded SMS-SUBMIT (one part of a message, as sent with AT+CMGS)
+'''
+StatusReport = collections.namedtuple('StatusReport', 'reference recipient discharged status')
+StatusReport.__doc__ = '''
+A decoded SMS-STATUS-REPORT. reference is the message reference returned by AT+CMGS,
+status the TP-Status (see status_report_state)
+'''
+
+
+class SmsPduError(Exception):
+    pass
+
+
+def unpack_septets(data, count):
+    septets = []
+    acc = bits = 0
+    for byte in data:
+        acc |= byte << bits
+        bits += 8
+        while bits >= 7:
+            septets.append(acc & 0x7F)
+            acc >>= 7
+            bits -= 7
+    return septets[:count]
+
+
+def pack_septets(septets, fill_bits=0):
+    out = bytearray()
+    acc = 0
+    bits = fill_bits
+    for septet in septets:
+        acc |= septet << bits
+        bits += 7
+        while bits >= 8:
+            out.append(acc & 0xFF)
+            acc >>= 8
+            bits -= 8
+    if bits:
+        out.append(acc & 0xFF)
+    return bytes(out)
+
+
+def gsm7_decode(septets):
+    chars = []
+    escaped = False
+    for septet in septets:
+        if escaped:
+            chars.append(GSM7_EXTENSION.get(septet, ' '))
+            escaped = False
+        elif septet == GSM7_ESCAPE:
+            escaped = True
+        else:
+            chars.append(GSM7_BASIC[septet])
+    return ''.join(chars)
+
+
+def gsm7_encode(text):
+    '''
+    Returns a list of septets for each character, or None if text isn't representable
+    '''
+    try:
+        return [GSM7_ENCODE[char] for char in text]
+    except KeyError:
+        return None
+
+
+def _swap_nibbles(data):
+    return ''.join('%x%x' % (b & 0x0F, b >> 4) for b in data)
+
+
+def _semi_octet(byte):
+    return (byte & 0x0F) * 10 + (byte >> 4)
+
+
+def decode_address(data, pos):
+    '''
+    Returns (address, position after it)
+    '''
+    digits, addr_type = data[pos], data[pos + 1]
+    size = (digits + 1) // 2
+    raw = data[pos + 2:pos + 2 + size]
+
+    if addr_type & ADDR_TON_MASK == ADDR_TON_ALPHANUMERIC:
+        address = gsm7_decode(unpack_septets(raw, digits * 4 // 7))
+    else:
+        address = _swap_nibbles(raw)[:digits].upper()
+        if addr_type & ADDR_TON_MASK == ADDR_TON_INTERNATIONAL:
+            address = '+' + address
+    return address, pos + 2 + size
+
+
+def encode_address(number):
+    digits = number.lstrip('+')
+    addr_type = ADDR_TYPE_INTERNATIONAL if number.startswith('+') else ADDR_TYPE_UNKNOWN
+    padded = digits + ('F' if len(digits) % 2 else '')
+    swapped = ''.join(padded[i + 1] + padded[i] for i in range(0, len(padded), 2))
+    return bytes([len(digits), addr_type]) + bytes.fromhex(swapped)
+
+
+def decode_timestamp(data):
+    year, month, day, hour, minute, second = (_semi_octet(b) for b in data[:6])
+    year += 1900 if year >= 90 else 2000
+    quarters = ((data[6] & 0x07) * 10 + (data[6] >> 4)) * (-1 if data[6] & 0x08 else 1)
+    tz = datetime.timezone(datetime.timedelta(minutes=15 * quarters))
+    return datetime.datetime(year, month, day, hour, minute, second, tzinfo=tz)
+
+
+def encode_timestamp(when):
+    offset = when.utcoffset() or datetime.timedelta()
+    quarters = int(offset.total_seconds() // (15 * 60))
+    values = (when.year % 100, when.month, when.day, when.hour, when.minute, when.second)
+    out = bytes(((v % 10) << 4) | (v // 10) for v in values)
+    tz = abs(quarters)
+    return out + bytes([((tz % 10) << 4) | (tz // 10) | (0x08 if quarters < 0 else 0)])
+
+
+def dcs_alphabet(dcs):
+    group = dcs & 0xF0
+    if group & 0xC0 in (0x00, 0x40):
+        # General data coding (possibly marked for automatic deletion)
+        return (dcs >> 2) & 0x03
+    if group == 0xF0:
+        return ALPHABET_8BIT if dcs & 0x04 else ALPHABET_GSM7
+    if group == 0xE0:
+        return ALPHABET_UCS2
+    return ALPHABET_GSM7
+
+
+def decode_udh(udh):
+    '''
+    Returns the (reference, total, sequence) of a concatenated message, or None
+    '''
+    pos = 0
+    while pos + 2 <= len(udh):
+        iei, length = udh[pos], udh[pos + 1]
+        value = udh[pos + 2:pos + 2 + length]
+        if iei == IEI_CONCAT_8BIT and length == 3:
+            return value[0], value[1], value[2]
+        if iei == IEI_CONCAT_16BIT and length == 4:
+            return (value[0] << 8) | value[1], value[2], value[3]
+        pos += 2 + length
+    return None
+
+
+def decode_user_data(ud, udl, alphabet, udhi):
+    concat = None
+    header_len = 0
+    if udhi:
+        header_len = ud[0] + 1
+        concat = decode_udh(ud[1:header_len])
+
+    if alphabet == ALPHABET_GSM7:
+        header_septets = (header_len * 8 + 6) // 7
+        text = gsm7_decode(unpack_septets(ud, udl)[header_septets:])
+    elif alphabet == ALPHABET_UCS2:
+        text = ud[header_len:udl].decode('utf-16-be', errors='replace')
+    else:
+        text = ud[header_len:udl].hex()
+    return text, concat
+
+
+def decode_deliver(pdu_hex):
+    '''
+    Decodes an SMS-DELIVER PDU, as listed by AT+CMGR/AT+CMGL in PDU mode
+    '''
+    try:
+        data = bytes.fromhex(pdu_hex)
+        pos = data[0] + 1  # Skip SMSC info
+        first = data[pos]
+        if first & 0x03 != MTI_DELIVER:
+            raise SmsPduError('Not an SMS-DELIVER: %r' % (pdu_hex,))
+
+        sender, pos = decode_address(data, pos + 1)
+        dcs = data[pos + 1]
+        timestamp = decode_timestamp(data[pos + 2:pos + 9])
+        udl = data[pos + 9]
+        text, concat = decode_user_data(data[pos + 10:], udl, dcs_alphabet(dcs),
+                                        first & FIRST_OCTET_UDHI)
+    except (IndexError, ValueError) as e:
+        raise SmsPduError('Bad PDU %r: %r' % (pdu_hex, e))
+
+    return SmsMessage(sender, timestamp, text, concat)
+
+
+def pdu_type(pdu_hex):
+    '''
+    Returns the MTI of a PDU with SMSC info (MTI_DELIVER, MTI_STATUS_REPORT, ...)
+    '''
+    try:
+        data = bytes.fromhex(pdu_hex)
+        return data[data[0] + 1] & 0x03
+    except (IndexError, ValueError) as e:
+        raise SmsPduError('Bad PDU %r: %r' % (pdu_hex, e))
+
+
+def decode_status_report(pdu_hex):
+    '''
+    Decodes an SMS-STATUS-REPORT PDU, as read by AT+CMGR in PDU mode
+    '''
+    try:
+        data = bytes.fromhex(pdu_hex)
+        pos = data[0] + 1
+        if data[pos] & 0x03 != MTI_STATUS_REPORT:
+            raise SmsPduError('Not an SMS-STATUS-REPORT: %r' % (pdu_hex,))
+        reference = data[pos + 1]
+        recipient, pos = decode_address(data, pos + 2)
+        # The service center timestamp, then the discharge time
+        discharged = decode_timestamp(data[pos + 7:pos + 14])
+        status = data[pos + 14]
+    except (IndexError, ValueError) as e:
+        raise SmsPduError('Bad PDU %r: %r' % (pdu_hex, e))
+
+    return StatusReport(reference, recipient, discharged, status)
+
+
+def status_report_state(status):
+    '''
+    'delivered', 'pending' (the service center is still trying) or 'failed'
+    '''
+    if status < STATUS_TEMPORARY_ERROR:
+        return 'delivered'
+    if status < STATUS_PERMANENT_ERROR:
+        return 'pending'
+    return 'failed'
+
+
+def decode_submit(pdu_hex):
+    '''
+    Decodes an SMS-SUBMIT PDU without SMSC info, as written after the AT+CMGS prompt
+    '''
+    try:
+        data = bytes.fromhex(pdu_hex)
+        first = data[0]
+        if first & 0x03 != MTI_SUBMIT:
+            raise SmsPduError('Not an SMS-SUBMIT: %r' % (pdu_hex,))
+
+        recipient, pos = decode_address(data, 2)
+        dcs = data[pos + 1]
+        pos += 2
+        vpf = first & FIRST_OCTET_VPF_MASK
+        pos += 0 if not vpf else 1 if vpf == FIRST_OCTET_VPF_RELATIVE else 7
+        udl = data[pos]
+        text, concat = decode_user_data(data[pos + 1:], udl, dcs_alphabet(dcs),
+                                        first & FIRST_OCTET_UDHI)
+    except (IndexError, ValueError) as e:
+        raise SmsPduError('Bad PDU %r: %r' % (pdu_hex, e))
+
+    return SmsSubmit(recipient, text, concat, bool(first & FIRST_OCTET_SRR))
+
+
+def _user_data_segments(text, alphabet):
+    '''
+    Splits text into user data chunks: lists of septets (GSM-7) or bytes
+    '''
+    single, multi = SEGMENT_LIMITS[alphabet]
+    if alphabet == ALPHABET_GSM7:
+        units = gsm7_encode(text)
+    else:
+        # Bytes per character, so that surrogate pairs stay together
+        units = [char.encode('utf-16-be') for char in text]
+        single, multi = single * 2, multi * 2
+
+    if sum(len(u) for u in units) <= single:
+        return [[v for u in units for v in u]]
+
+    segments = [[]]
+    for unit in units:
+        # Never split an escape sequence or a UCS-2 character across segments
+        if len(segments[-1]) + len(unit) > multi:
+            segments.append([])
+        segments[-1].extend(unit)
+    return segments
+
+
+def encode_user_data(text, reference=0):
+    '''
+    Returns (dcs, [(udhi, udl, user data bytes), ...]) for text, segmented if it
+    doesn't fit in a single message
+    '''
+    alphabet = ALPHABET_GSM7 if gsm7_encode(text) is not None else ALPHABET_UCS2
+    dcs = 0x08 if alphabet == ALPHABET_UCS2 else 0x00
+    segments = _user_data_segments(text, alphabet)
+
+    out = []
+    for seq, segment in enumerate(segments, 1):
+        udh = b''
+        if len(segments) > 1:
+            udh = bytes([5, IEI_CONCAT_8BIT, 3, reference & 0xFF, len(segments), seq])
+
+        if alphabet == ALPHABET_GSM7:
+            fill_bits = (7 - (len(udh) * 8) % 7) % 7
+            ud = udh + pack_septets(segment, fill_bits)
+            udl = (len(udh) * 8 + fill_bits) // 7 + len(segment)
+        else:
+            ud = udh + bytes(segment)
+            udl = len(ud)
+        out.append((bool(udh), udl, ud))
+    return dcs, out
+
+
+def encode_deliver(sender, text, timestamp, reference=0):
+    '''
+    Builds SMS-DELIVER PDUs (hex, without SMSC info), as a modem would store them
+    '''
+    dcs, segments = encode_user_data(text, reference)
+    pdus = []
+    for udhi, udl, ud in segments:
+        first = FIRST_OCTET_MMS | (FIRST_OCTET_UDHI if udhi else 0)
+        pdu = (b'\x00' + bytes([first]) + encode_address(sender) + bytes([0, dcs]) +
+               encode_timestamp(timestamp) + bytes([udl]) + ud)
+        pdus.append(pdu.hex().upper())
+    return pdus
+
+
+def encode_submit(recipient, text, reference=0, status_report=True):
+    '''
+    Builds SMS-SUBMIT PDUs for AT+CMGS in PDU mode: returns [(hex PDU, TPDU length)],
+    one per segment. The PDUs use the SMSC stored in the SIM, and let the modem set
+    the message reference.
+    '''
+    dcs, segments = encode_user_data(text, reference)
+    pdus = []
+    for udhi, udl, ud in segments:
+        first = (MTI_SUBMIT | FIRST_OCTET_VPF_RELATIVE |
+                 (FIRST_OCTET_SRR if status_report else 0) | (FIRST_OCTET_UDHI if udhi else 0))
+        tpdu = (bytes([first, 0]) + encode_address(recipient) +
+                bytes([0, dcs, VALIDITY_PERIOD_24H, udl]) + ud)
+        pdus.append(((b'\x00' + tpdu).hex().upper(), len(tpdu)))
+    return pdus
+
+
+def encode_status_report(reference, recipient, status, discharged):
+    '''
+    Builds an SMS-STATUS-REPORT PDU (hex, without SMSC info), as a modem would store it
+    '''
+    timestamp = encode_timestamp(discharged)
+    pdu = (b'\x00' + bytes([MTI_STATUS_REPORT, reference & 0xFF]) +
+           encode_address(recipient) + timestamp + timestamp + bytes([status]))
+    return pdu.hex().upper()
+
+
+class ConcatReassembler:
+    '''
+    Joins the parts of concatenated messages. Incomplete messages are given up on
+    (and returned with their missing parts marked) after a timeout. The storage index
+    of each part is kept, so that parts can stay stored until their message is handled.
+    '''
+    def __init__(self, timeout=CONCAT_TIMEOUT):
+        self._timeout = timeout
+        self._partial = {}
+
+    def add(self, msg, idx=None):
+        '''
+        Returns (the complete message, the storage indexes of its parts), or None while
+        parts are still missing. idx is where msg is stored, if it is.
+        '''
+        if not msg.concat:
+            return msg, [] if idx is None else [idx]
+
+        reference, total, sequence = msg.concat
+        key = (msg.sender, reference, total)
+        first_seen, parts, indexes = self._partial.setdefault(key, (time.monotonic(), {}, set()))
+        parts[sequence] = msg
+        if idx is not None:
+            # A part received twice is stored twice
+            indexes.add(idx)
+
+        if len(parts) < total:
+            return None
+        del self._partial[key]
+        return self._join(parts, total), sorted(indexes)
+
+    def evict_expired(self):
+        '''
+        Returns (message, storage indexes) of the incomplete messages that timed out
+        '''
+        now = time.monotonic()
+        expired = [key for key, (first_seen, _, _) in self._partial.items()
+                   if now - first_seen > self._timeout]
+        evicted = []
+        for key in expired:
+            _, parts, indexes = self._partial.pop(key)
+            evicted.append((self._join(parts, key[2]), sorted(indexes)))
+        return evicted
+
+    def _join(self, parts, total):
+        first = parts[min(parts)]
+        text = ''.join(parts[seq].text if seq in parts else '[part %d/%d missing]' % (seq, total)
+                       for seq in range(1, total + 1))
+        return SmsMessage(first.sender, first.timestamp, text, None)
@@ -0,0 +1,280 @@
+'''
+Outbound SMS: room messages like "!sms +15555550100: text" are journaled to disk, and sent
+through the modem one at a time with AT+CMGS, paced to the carrier's rate limit. Failures
+and delivery reports are posted back to the room, in reply to the message.
+'''
+import re
+import time
+import asyncio
+import logging
+import sqlite3
+
+import metrics
+import smspdu
+from quectelmodem import AtCommandError, AtStateError
+
+
+# Carriers typically throttle or block SIMs that send faster than this
+SMS_RATE_PER_MINUTE = 20
+SMS_BURST = 5
+SMS_SEND_ATTEMPTS = 5
+SMS_BACKOFF_MIN = 10
+SMS_BACKOFF_MAX = 10 * 60
+# Sent messages are forgotten if their delivery report doesn't come in this long
+SMS_REPORT_TIMEOUT = 3 * 24 * 60 * 60
+SMS_RECIPIENTS_MAX = 100
+# +CMS ERRORs worth retrying: network out of order, temporary failure, congestion,
+# resources unavailable, no network service, network timeout
+CMS_TEMPORARY_ERRORS = (38, 41, 42, 47, 331, 332)
+
+# "!sms <recipients>: text", where recipients may be national numbers or short codes.
+# Without the command, only full international (E.164) numbers make a message an SMS, so
+# that chat like "2024: see you" isn't sent
+SMS_COMMAND_RE = re.compile(r'^\s*!sms\b\s*(.*)$', re.DOTALL | re.IGNORECASE)
+SMS_RECIPIENTS_RE = re.compile(r'^(\+?\d{3,15}(?:\s*,\s*\+?\d{3,15})*)\s*:\s*(.*\S.*)$',
+                               re.DOTALL)
+E164_SMS_RE = re.compile(r'^\s*(\+\d{8,15}(?:\s*,\s*\+\d{8,15})*)\s*:\s*(.*\S.*)$',
+                         re.DOTALL)
+
+logger = logging.getLogger('SmsQueue')
+
+
+def parse_outbound_sms(body):
+    '''
+    Returns ([recipients], text) of a message like "!sms +15555550100, 5550101: text" or
+    "+15555550100: text", or None if it isn't one. Raises ValueError for an !sms command
+    that can't be parsed.
+    '''
+    command = SMS_COMMAND_RE.match(body)
+    if command:
+        m = SMS_RECIPIENTS_RE.match(command.group(1))
+        if not m:
+            raise ValueError('To send an SMS, write "!sms +15555550100: text" (several '
+                             'recipients are separated by commas)')
+    else:
+        m = E164_SMS_RE.match(body)
+        if not m:
+            return None
+    recipients = list(dict.fromkeys(re.split(r'\s*,\s*', m.group(1))))
+    return recipients, m.group(2).strip()
+
+
+def _is_temporary(error):
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    m = re.search(r'\+CMS ERROR: (\d+)', str(error))
+    return bool(m) and int(m.group(1)) in CMS_TEMPORARY_ERRORS
+
+
+def _same_number(a, b):
+    '''
+    Whether two renderings of a number (international or national) are the same number
+    '''
+    a, b = a.lstrip('+'), b.lstrip('+')
+    return a.endswith(b[-8:]) or b.endswith(a[-8:])
+
+
+class SmsSendQueue:
+    '''
+    Durable queue of the outbound SMS of one modem. send() journals a message per recipient
+    and returns right away. Messages are sent in order, one PDU at a time, at most
+    rate_per_minute PDUs a minute (in bursts of up to burst). Temporary failures are
+    retried with exponential backoff, resuming after the parts already sent.
+    '''
+    def __init__(self, path, modem, matrix_send_queue, rate_per_minute=SMS_RATE_PER_MINUTE,
+                 burst=SMS_BURST):
+        self._modem = modem
+        self._matrix_send_queue = matrix_send_queue
+        self._rate = rate_per_minute
+        self._burst = burst
+        self._tokens = burst
+        self._refilled = time.monotonic()
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS sms_outbox ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, room TEXT NOT NULL, event_id TEXT NOT NULL, '
+            'recipient TEXT NOT NULL, text TEXT NOT NULL, queued REAL NOT NULL, '
+            'parts_sent INTEGER NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0, '
+            'sent REAL)'
+        )
+        # The message reference of each sent part, and the state of its delivery report
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS sms_parts ('
+            'msg_id INTEGER NOT NULL, reference INTEGER NOT NULL, state TEXT)'
+        )
+        self._db.commit()
+        self._wakeup = asyncio.Event()
+        metrics.SMS_OUTBOX_PENDING.set_function(self.pending, modem=modem.name)
+
+        pending = self.pending()
+        if pending:
+            logger.info('Sending %d pending SMS from %s' % (pending, path))
+            self._wakeup.set()
+
+    def pending(self):
+        return self._db.execute(
+            'SELECT COUNT(*) FROM sms_outbox WHERE sent IS NULL'
+        ).fetchone()[0]
+
+    def send(self, room, event_id, recipients, text):
+        '''
+        Queues text to each recipient. Reports go to room, in reply to event_id.
+        '''
+        if len(recipients) > SMS_RECIPIENTS_MAX:
+            self.notify(room, event_id, 'Not sending: more than %d recipients' % (
+                SMS_RECIPIENTS_MAX,
+            ))
+            return
+        now = time.time()
+        self._db.executemany(
+            'INSERT INTO sms_outbox (room, event_id, recipient, text, queued) '
+            'VALUES (?, ?, ?, ?, ?)',
+            [(room, event_id, recipient, text, now) for recipient in recipients]
+        )
+        self._db.commit()
+        self._wakeup.set()
+
+    def notify(self, room, event_id, body):
+        '''
+        Posts body to room as a notice, in reply to event_id
+        '''
+        self._matrix_send_queue.send(room, 'm.room.message', {
+            'msgtype': 'm.notice',
+            'body': body,
+            'm.relates_to': {'m.in_reply_to': {'event_id': event_id}},
+        })
+
+    async def _take_token(self):
+        '''
+        Waits until the rate limit allows another PDU
+        '''
+        if not self._rate:
+            return
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._burst,
+                               self._tokens + (now - self._refilled) * self._rate / 60)
+            self._refilled = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) * 60 / self._rate)
+
+    def _delete(self, msg_id):
+        self._db.execute('DELETE FROM sms_parts WHERE msg_id = ?', (msg_id,))
+        self._db.execute('DELETE FROM sms_outbox WHERE id = ?', (msg_id,))
+
+    def _expire_reports(self):
+        expired = self._db.execute(
+            'SELECT id FROM sms_outbox WHERE sent < ?', (time.time() - SMS_REPORT_TIMEOUT,)
+        ).fetchall()
+        for msg_id, in expired:
+            self._delete(msg_id)
+        self._db.commit()
+
+    async def _send(self, row):
+        '''
+        Sends the remaining parts of a message. Returns how long to back off for.
+        '''
+        msg_id, room, event_id, recipient, text, queued, parts_sent, attempts = row
+        pdus = smspdu.encode_submit(recipient, text, reference=msg_id)
+        try:
+            for pdu, length in pdus[parts_sent:]:
+                await self._take_token()
+                reference = await self._modem.send_sms_pdu(pdu, length)
+                parts_sent += 1
+                self._db.execute('UPDATE sms_outbox SET parts_sent = ? WHERE id = ?',
+                                 (parts_sent, msg_id))
+                self._db.execute('INSERT INTO sms_parts (msg_id, reference) VALUES (?, ?)',
+                                 (msg_id, reference))
+                self._db.commit()
+
+        except AtStateError as e:
+            # The modem went away. Sent again once it is back, without counting an attempt
+            logger.warning('SMS #%d to %s interrupted: %r' % (msg_id, recipient, e))
+            return 0
+
+        except (AtCommandError, asyncio.TimeoutError) as e:
+            attempts += 1
+            if attempts < SMS_SEND_ATTEMPTS and _is_temporary(e):
+                backoff = min(SMS_BACKOFF_MAX, SMS_BACKOFF_MIN * 2 ** (attempts - 1))
+                logger.warning('SMS #%d to %s failed (attempt %d), retrying in %ds: %r' % (
+                    msg_id, recipient, attempts, backoff, e
+                ))
+                metrics.SMS_SENT.inc(modem=self._modem.name, result='retry')
+                self._db.execute('UPDATE sms_outbox SET attempts = ? WHERE id = ?',
+                                 (attempts, msg_id))
+                self._db.commit()
+                return backoff
+
+            logger.warning('SMS #%d to %s failed: %r' % (msg_id, recipient, e))
+            metrics.SMS_SENT.inc(modem=self._modem.name, result='failed')
+            self.notify(room, event_id, 'SMS to %s could not be sent: %s' % (recipient, e))
+            self._delete(msg_id)
+            self._db.commit()
+            return 0
+
+        logger.info('SMS #%d to %s sent (%d parts)' % (msg_id, recipient, len(pdus)))
+        metrics.SMS_SENT.inc(modem=self._modem.name, result='sent')
+        metrics.SMS_QUEUE_SECONDS.observe(time.time() - queued, modem=self._modem.name)
+        self._db.execute('UPDATE sms_outbox SET sent = ? WHERE id = ?', (time.time(), msg_id))
+        self._db.commit()
+        return 0
+
+    def on_status_report(self, report):
+        '''
+        Matches a delivery report to its part, and reports the message once all of its
+        parts are delivered (or one failed)
+        '''
+        state = smspdu.status_report_state(report.status)
+        metrics.SMS_DELIVERY_REPORTS.inc(modem=self._modem.name, state=state)
+        if state == 'pending':
+            return
+
+        parts = self._db.execute(
+            'SELECT p.rowid, m.id, m.recipient FROM sms_parts p JOIN sms_outbox m '
+            'ON m.id = p.msg_id WHERE p.reference = ? AND p.state IS NULL '
+            'ORDER BY p.rowid DESC', (report.reference,)
+        ).fetchall()
+        part = next((part for part in parts if _same_number(part[2], report.recipient)), None)
+        if part is None:
+            logger.info('Delivery report for an unknown message %d to %s' % (
+                report.reference, report.recipient
+            ))
+            return
+        self._db.execute('UPDATE sms_parts SET state = ? WHERE rowid = ?', (state, part[0]))
+
+        msg_id = part[1]
+        room, event_id, recipient, sent = self._db.execute(
+            'SELECT room, event_id, recipient, sent FROM sms_outbox WHERE id = ?', (msg_id,)
+        ).fetchone()
+        states = [row[0] for row in self._db.execute(
+            'SELECT state FROM sms_parts WHERE msg_id = ?', (msg_id,)
+        )]
+        if state == 'failed':
+            self.notify(room, event_id, 'SMS to %s was not delivered (status %d)' % (
+                recipient, report.status
+            ))
+            self._delete(msg_id)
+        elif sent is not None and all(states):
+            self.notify(room, event_id, 'SMS to %s delivered' % (recipient,))
+            self._delete(msg_id)
+        self._db.commit()
+
+    async def run(self):
+        self._expire_reports()
+        while True:
+            row = self._db.execute(
+                'SELECT id, room, event_id, recipient, text, queued, parts_sent, attempts '
+                'FROM sms_outbox WHERE sent IS NULL ORDER BY id LIMIT 1'
+            ).fetchone()
+            if row is None:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                self._expire_reports()
+                continue
+
+            await self._modem.ready.wait()
+            backoff = await self._send(row)
+            if backoff:
+                await asyncio.sleep(backoff)
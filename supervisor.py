@@ -0,0 +1,75 @@
+import os
+import time
+import asyncio
+import logging
+
+import metrics
+
+
+MODEM_RESTART_BACKOFF_MIN = 1
+MODEM_RESTART_BACKOFF_MAX = 60
+# A modem that ran this long before failing is restarted with the minimum backoff again
+MODEM_STABLE_TIME = 5 * 60
+DEVICE_POLL_INTERVAL = 0.5
+
+logger = logging.getLogger('ModemSupervisor')
+
+
+class ModemSupervisor:
+    '''
+    Re-opens a modem after it fails (an AT/QMI error, the SIM resetting, the USB device
+    going away), with exponential backoff. Only the modem side is restarted: the Matrix
+    client and sync keep running. When a device node disappears, the modem is re-opened
+    as soon as it is back.
+    '''
+    def __init__(self, name, run_once, device_paths,
+                 backoff_min=MODEM_RESTART_BACKOFF_MIN, backoff_max=MODEM_RESTART_BACKOFF_MAX,
+                 stable_time=MODEM_STABLE_TIME):
+        self._name = name
+        self._run_once = run_once
+        self._device_paths = device_paths
+        self._backoff_min = backoff_min
+        self._backoff_max = backoff_max
+        self._stable_time = stable_time
+
+    async def _wait_for_devices(self, delay):
+        '''
+        Waits for delay, or until the device nodes are back if they are missing.
+        Returns whether they went away.
+        '''
+        deadline = time.monotonic() + delay
+        gone = False
+        while True:
+            missing = [path for path in self._device_paths if not os.path.exists(path)]
+            if missing and not gone:
+                logger.warning('Modem %s: %s went away, waiting for it to come back' % (
+                    self._name, ', '.join(missing)
+                ))
+                gone = True
+            elif not missing and (gone or time.monotonic() >= deadline):
+                if gone:
+                    logger.info('Modem %s: device is back' % (self._name,))
+                return gone
+            await asyncio.sleep(DEVICE_POLL_INTERVAL)
+
+    async def run(self):
+        backoff = self._backoff_min
+        while True:
+            start = time.monotonic()
+            try:
+                await self._run_once()
+                logger.info('Modem %s stopped' % (self._name,))
+                return
+            except Exception:
+                logger.exception('Modem %s failed' % (self._name,))
+            metrics.MODEM_RESTARTS.inc(modem=self._name)
+
+            if time.monotonic() - start >= self._stable_time:
+                backoff = self._backoff_min
+            logger.info('Modem %s: restarting in %ds (sooner if the device comes back)' % (
+                self._name, backoff
+            ))
+            if await self._wait_for_devices(backoff):
+                backoff = self._backoff_min
+            else:
+                backoff = min(backoff * 2, self._backoff_max)
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import ipaddress
+import contextlib
+import contextvars
+import collections
+
+import aioice.ice
+
+
+# The forwarded port that UDP sockets bound in the current context should use
+LEASED_UDP_PORT = contextvars.ContextVar('leased_udp_port', default=None)
+# The local addresses ICE gathers host candidates on in the current context (None for all)
+ICE_HOST_ADDRESSES = contextvars.ContextVar('ice_host_addresses', default=None)
+
+logger = logging.getLogger('UdpPorts')
+
+
+class PortPoolExhausted(Exception):
+    pass
+
+
+class UdpPortPool:
+    '''
+    Leases forwarded UDP ports, one per peer connection. Released ports go to the back
+    of the queue, so late packets of a finished call don't reach the next one.
+    '''
+    def __init__(self, first, last):
+        self._free = collections.deque(range(first, last + 1))
+        self._leased = set()
+
+    @classmethod
+    def parse(cls, spec):
+        '''
+        Parses "49572-49600" or "49572"
+        '''
+        first, _, last = str(spec).partition('-')
+        return cls(int(first), int(last or first))
+
+    def __len__(self):
+        return len(self._free) + len(self._leased)
+
+    def lease(self):
+        if not self._free:
+            raise PortPoolExhausted('All %d forwarded UDP ports are in use' % (
+                len(self._leased),
+            ))
+        port = self._free.popleft()
+        self._leased.add(port)
+        return port
+
+    def release(self, port):
+        if port in self._leased:
+            self._leased.remove(port)
+            self._free.append(port)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def bind_to(port):
+        '''
+        UDP sockets bound to a random port inside this block get port instead
+        '''
+        token = LEASED_UDP_PORT.set(port)
+        try:
+            yield
+        finally:
+            LEASED_UDP_PORT.reset(token)
+
+
+@contextlib.contextmanager
+def gather_on(addresses):
+    '''
+    ICE agents gathering inside this block only bind the given local addresses, instead
+    of one socket per address of every interface (docker bridges included)
+    '''
+    token = ICE_HOST_ADDRESSES.set(list(addresses) if addresses is not None else None)
+    try:
+        yield
+    finally:
+        ICE_HOST_ADDRESSES.reset(token)
+
+
+_get_all_host_addresses = aioice.ice.get_host_addresses
+
+
+def _get_host_addresses(use_ipv4, use_ipv6):
+    '''
+    Stands in for aioice.ice.get_host_addresses (see aioice/ice.py:gather_candidates)
+    '''
+    addresses = ICE_HOST_ADDRESSES.get()
+    if addresses is None:
+        return _get_all_host_addresses(use_ipv4, use_ipv6)
+    return [address for address in addresses
+            if (use_ipv4 if ipaddress.ip_address(address).version == 4 else use_ipv6)]
+
+
+aioice.ice.get_host_addresses = _get_host_addresses
+
+
+class PortBindingLoopMixin:
+    '''
+    Makes the datagram endpoints that aioice creates for its host candidates (see
+    aioice/ice.py:get_component_candidates) use the leased UDP port (for port forwarding)
+    '''
+    def create_datagram_endpoint(self, *args, **kwargs):
+        port = LEASED_UDP_PORT.get()
+        if port and 'local_addr' in kwargs and kwargs['local_addr'][1] == 0:
+            logger.debug('Binding to leased UDP port %d' % (port,))
+            kwargs['local_addr'] = (kwargs['local_addr'][0], port)
+            kwargs['reuse_port'] = True
+        return super().create_datagram_endpoint(*args, **kwargs)
+
+
+def port_binding_loop_policy(use_uvloop=False):
+    '''
+    An event loop policy whose loops bind to the leased UDP ports, on top of asyncio's
+    default loop or uvloop
+    '''
+    if use_uvloop:
+        import uvloop
+        base_loop, base_policy = uvloop.Loop, uvloop.EventLoopPolicy
+    else:
+        base_loop, base_policy = asyncio.SelectorEventLoop, asyncio.DefaultEventLoopPolicy
+    loop_class = type('PortBinding' + base_loop.__name__, (PortBindingLoopMixin, base_loop), {})
+
+    class PortBindingLoopPolicy(base_policy):
+        def new_event_loop(self):
+            return loop_class()
+
+    return PortBindingLoopPolicy()
@@ -0,0 +1,169 @@
+'''
+Voicemail for calls nobody took on the Matrix side: the modem answers, plays a greeting
+and records the caller to Ogg/Opus as the audio comes in, so the recording is ready to
+upload the moment the caller hangs up
+'''
+import os
+import time
+import asyncio
+import logging
+import fractions
+import tempfile
+
+import av
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+
+from pcmaudio import PCM_PTIME, PCM_SAMPLE_RATE, SAMPLE_WIDTH, frame_samples
+
+
+VOICEMAIL_MAX_SECONDS = 120
+# Speech only, and narrowband at that
+VOICEMAIL_BITRATE = 16000
+# libopus takes these input rates (the GSM audio is 8 or 16 kHz)
+OPUS_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)
+VOICEMAIL_MIMETYPE = 'audio/ogg'
+
+logger = logging.getLogger('Voicemail')
+
+
+def load_greeting(path, sample_rate=PCM_SAMPLE_RATE):
+    '''
+    Decodes an audio file (anything libav reads) into frames of mono s16 PCM at
+    sample_rate, once, so that playing it takes no decoding
+    '''
+    resampler = av.AudioResampler(format='s16', layout='mono', rate=sample_rate)
+    pcm = bytearray()
+    with av.open(path) as container:
+        for frame in container.decode(audio=0):
+            for resampled in resampler.resample(frame):
+                pcm += bytes(resampled.planes[0])[:resampled.samples * SAMPLE_WIDTH]
+    for resampled in resampler.resample(None):
+        pcm += bytes(resampled.planes[0])[:resampled.samples * SAMPLE_WIDTH]
+
+    frame_bytes = frame_samples(sample_rate) * SAMPLE_WIDTH
+    pcm += bytes(-len(pcm) % frame_bytes)
+    return [bytes(pcm[pos:pos + frame_bytes]) for pos in range(0, len(pcm), frame_bytes)]
+
+
+class GreetingTrack(MediaStreamTrack):
+    '''
+    Plays decoded greeting frames in real time, and ends after the last one
+    '''
+    kind = 'audio'
+
+    def __init__(self, frames, sample_rate=PCM_SAMPLE_RATE):
+        super().__init__()
+        self._frames = frames
+        self._sample_rate = sample_rate
+        self._time_base = fractions.Fraction(1, sample_rate)
+        self._start = None
+        self._index = 0
+        self.finished = asyncio.Event()
+
+    async def recv(self):
+        if self.readyState != 'live' or self._index >= len(self._frames):
+            self.finished.set()
+            self.stop()
+            raise MediaStreamError
+
+        if self._start is None:
+            self._start = time.monotonic()
+        else:
+            await asyncio.sleep(self._start + self._index * PCM_PTIME - time.monotonic())
+
+        data = self._frames[self._index]
+        frame = av.AudioFrame(format='s16', layout='mono', samples=len(data) // SAMPLE_WIDTH)
+        frame.planes[0].update(data)
+        frame.pts = self._index * frame.samples
+        frame.sample_rate = self._sample_rate
+        frame.time_base = self._time_base
+        self._index += 1
+        return frame
+
+
+class OpusRecorder:
+    '''
+    Encodes audio frames to an Ogg/Opus file as they come in. Only the encoder state is
+    kept in memory, whatever the length of the recording.
+    '''
+    def __init__(self, path, sample_rate=PCM_SAMPLE_RATE, bitrate=VOICEMAIL_BITRATE):
+        rate = min((rate for rate in OPUS_SAMPLE_RATES if rate >= sample_rate),
+                   default=OPUS_SAMPLE_RATES[-1])
+        self.path = path
+        self._container = av.open(path, 'w', format='ogg')
+        self._stream = self._container.add_stream('libopus', rate=rate, layout='mono')
+        self._stream.bit_rate = bitrate
+        self._resampler = av.AudioResampler(format='s16', layout='mono', rate=rate)
+        self._rate = rate
+        self.samples = 0
+
+    @property
+    def duration(self):
+        return self.samples / self._rate
+
+    def _encode(self, frames):
+        for frame in frames:
+            if frame is not None:
+                self.samples += frame.samples
+            for packet in self._stream.encode(frame):
+                self._container.mux(packet)
+
+    def write(self, frame):
+        self._encode(self._resampler.resample(frame))
+
+    def close(self):
+        '''
+        Flushes the encoder and finishes the file
+        '''
+        try:
+            self._encode(self._resampler.resample(None) + [None])
+        finally:
+            self._container.close()
+
+
+class Voicemail:
+    '''
+    Takes a message on the audio of an answered call: plays the greeting (if any), then
+    records the caller until the call ends or max_seconds pass
+    '''
+    def __init__(self, greeting=None, max_seconds=VOICEMAIL_MAX_SECONDS,
+                 sample_rate=PCM_SAMPLE_RATE):
+        self._greeting = load_greeting(greeting, sample_rate) if greeting else []
+        self._max_seconds = max_seconds
+        self._sample_rate = sample_rate
+
+    async def _play_greeting(self, audio):
+        track = GreetingTrack(self._greeting, self._sample_rate)
+        audio.play(track)
+        await audio.start()
+        await track.finished.wait()
+
+    async def _record(self, audio, recorder):
+        deadline = time.monotonic() + self._max_seconds
+        try:
+            while time.monotonic() < deadline:
+                recorder.write(await audio.track.recv())
+        except MediaStreamError:
+            pass
+
+    def recorder(self):
+        '''
+        A recorder writing to a new temporary file (that its user deletes)
+        '''
+        fd, path = tempfile.mkstemp(prefix='voicemail-', suffix='.ogg')
+        os.close(fd)
+        try:
+            return OpusRecorder(path, self._sample_rate)
+        except BaseException:
+            os.unlink(path)
+            raise
+
+    async def take(self, audio, recorder):
+        '''
+        Records a message from audio (see PcmAudio) with recorder. When the caller hangs
+        up, this is cancelled, and the recording so far is the message.
+        '''
+        if self._greeting:
+            await self._play_greeting(audio)
+        await self._record(audio, recorder)